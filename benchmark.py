@@ -0,0 +1,330 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse  # arg parsing
+import tempfile
+import tracemalloc
+import contextlib
+from datetime import datetime
+from typing import Callable, Dict, List  # for type hinting
+
+import numpy as np
+import pandas as pd
+
+from main import RecipeSuggester, UserManager, UserProfile
+from recipestore import CATEGORY_FILES, build_store, memory_report, read_category_csvs
+from similarity import SimilarityIndex, recall_at_k
+
+# benchmark suite for the load, classify, score and feedback hot paths
+#
+#   python benchmark.py --sizes 10000 100000 1000000 --output bench.json
+#   python benchmark.py --sizes 10000 --compare bench.json
+#   python benchmark.py --sizes 10000 100000 1000000 --shards 8   (sharded scoring and its crossover size)
+#
+# recipes are synthetic but follow the Food.com schema, so every code path sees the
+# same column types and text shapes as the real dataset
+
+COLUMNS = ['RecipeId', 'Name', 'AuthorId', 'AuthorName', 'CookTime', 'PrepTime', 'TotalTime', 'DatePublished',
+           'Description', 'Images', 'RecipeCategory', 'Keywords', 'RecipeIngredientQuantities', 'RecipeIngredientParts',
+           'AggregatedRating', 'ReviewCount', 'Calories', 'FatContent', 'SaturatedFatContent', 'CholesterolContent',
+           'SodiumContent', 'CarbohydrateContent', 'FiberContent', 'SugarContent', 'ProteinContent', 'RecipeServings',
+           'RecipeYield', 'RecipeInstructions']  # Food.com recipes.csv column order
+
+WORDS = ['chicken', 'rice', 'spicy', 'thai', 'noodles', 'garlic', 'lemon', 'butter', 'creamy', 'tomato', 'basil', 'beef',
+         'pork', 'salmon', 'tofu', 'broccoli', 'potato', 'cheese', 'onion', 'pepper', 'ginger', 'honey', 'chocolate',
+         'vanilla', 'apple', 'cinnamon', 'mushroom', 'spinach', 'bean', 'corn', 'curry', 'coconut', 'lime', 'egg', 'bacon']
+INGREDIENTS = ['chicken breast', 'white rice', 'garlic', 'onion', 'butter', 'salt', 'black pepper', 'olive oil', 'sugar',
+               'all-purpose flour', 'eggs', 'milk', 'broccoli', 'carrot', 'tomatoes', 'cheddar cheese', 'ground beef',
+               'soy sauce', 'ginger', 'lemon juice', 'cinnamon', 'vanilla', 'baking soda', 'honey', 'spinach', 'potatoes']
+CATEGORIES = {  # RecipeCategory values per category file, matching what filterdataset.py selects
+    'appetizer': ['Appetizer', 'Snack', 'Starter'],
+    'breakfast': ['Breakfast', 'Brunch'],
+    'dessert': ['Dessert', 'Cake', 'Cookie & Brownie', 'Pie'],
+    'dinner': ['Main Dish', 'One Dish Meal', 'Dinner'],
+    'lunch': ['Lunch/Snacks', 'Salad', 'Sandwich', 'Soup'],
+}
+QUERIES = ['something sweet', 'quick breakfast', 'dinner ideas', 'healthy lunch', 'main course tonight',
+           'a light dessert', 'snack for the party', "i'm hungry", 'brunch with friends', 'cake or cookie']
+
+
+def r_vector(values: List[str]) -> str:
+    # format values like the R-literal vectors in the Food.com csv
+    return 'c(' + ', '.join(f'"{v}"' for v in values) + ')'
+
+
+def generate_recipes(n: int, seed: int = 0) -> pd.DataFrame:
+    # synthetic recipes in the Food.com schema, RecipeId 1..n
+    rng = np.random.default_rng(seed)
+    py_rng = random.Random(seed)
+    words = np.array(WORDS)
+    meal_types = np.array(list(CATEGORIES))
+    meal = meal_types[rng.integers(0, len(meal_types), n)]
+    prep, cook = rng.integers(1, 90, n), rng.integers(0, 240, n)
+
+    def duration(minutes):
+        hours, mins = np.divmod(minutes, 60)
+        return ['PT' + (f'{h}H' if h else '') + (f'{m}M' if m or not h else '') for h, m in zip(hours.tolist(), mins.tolist())]
+
+    ingredient_counts = rng.integers(3, 12, n)
+    ingredients = [py_rng.sample(INGREDIENTS, k) for k in ingredient_counts.tolist()]
+    names = [' '.join(t) for t in words[rng.integers(0, len(words), (n, 3))].tolist()]
+    ratings = np.round(rng.uniform(1, 5, n) * 2) / 2
+    ratings[rng.random(n) < 0.3] = np.nan  # unrated recipes
+    df = pd.DataFrame({
+        'RecipeId': np.arange(1, n + 1, dtype=np.int64),
+        'Name': [name.title() for name in names],
+        'AuthorId': rng.integers(1, n // 10 + 2, n),
+        'AuthorName': [f'cook{a}' for a in rng.integers(1, 5000, n).tolist()],
+        'CookTime': duration(cook),
+        'PrepTime': duration(prep),
+        'TotalTime': duration(prep + cook),
+        'DatePublished': [f'{y}-{m:02d}-{d:02d}T12:00:00Z' for y, m, d in zip(rng.integers(1999, 2021, n).tolist(), rng.integers(1, 13, n).tolist(), rng.integers(1, 29, n).tolist())],
+        'Description': [f'Make and share this {name} recipe from Food.com.' for name in names],
+        'Images': 'character(0)',
+        'RecipeCategory': [py_rng.choice(CATEGORIES[m]) for m in meal.tolist()],
+        'Keywords': [r_vector(py_rng.sample(WORDS, 3) + ['< 60 Mins']) for _ in range(n)],
+        'RecipeIngredientQuantities': [r_vector([str(py_rng.randint(1, 4)) for _ in parts]) for parts in ingredients],
+        'RecipeIngredientParts': [r_vector(parts) for parts in ingredients],
+        'AggregatedRating': ratings,
+        'ReviewCount': np.where(np.isnan(ratings), np.nan, rng.integers(1, 500, n)),
+        'Calories': rng.gamma(2.0, 200.0, n).round(1),
+        'FatContent': rng.gamma(2.0, 10.0, n).round(1),
+        'SaturatedFatContent': rng.gamma(2.0, 4.0, n).round(1),
+        'CholesterolContent': rng.gamma(2.0, 40.0, n).round(1),
+        'SodiumContent': rng.gamma(2.0, 300.0, n).round(1),
+        'CarbohydrateContent': rng.gamma(2.0, 20.0, n).round(1),
+        'FiberContent': rng.gamma(2.0, 2.0, n).round(1),
+        'SugarContent': rng.gamma(2.0, 10.0, n).round(1),
+        'ProteinContent': rng.gamma(2.0, 12.0, n).round(1),
+        'RecipeServings': rng.integers(1, 12, n).astype(float),
+        'RecipeYield': np.nan,
+        'RecipeInstructions': [r_vector([f'Combine the {a}.', f'Cook for {m} minutes.', 'Serve.']) for a, m in zip(names, cook.tolist())],
+    }, columns=COLUMNS)
+    df['meal_type'] = meal
+    return df
+
+
+def write_dataset(data_dir: str, n: int, seed: int = 0) -> str:
+    # write n synthetic recipes as the five category csv files
+    os.makedirs(data_dir, exist_ok=True)
+    df = generate_recipes(n, seed)
+    for category_file in CATEGORY_FILES:
+        meal_type = category_file.split('.')[0]
+        df[df['meal_type'] == meal_type][COLUMNS].to_csv(os.path.join(data_dir, category_file), index=False)
+    return data_dir
+
+
+def generate_profile(user_id: str, recipe_ids: np.ndarray, liked: int, disliked: int, seed: int = 0) -> UserProfile:
+    # profile with large liked and disliked lists drawn from the catalog
+    rng = np.random.default_rng(seed)
+    chosen = rng.choice(recipe_ids, size=min(liked + disliked, len(recipe_ids)), replace=False)
+    profile = UserProfile(user_id)
+    for recipe_id in chosen[:liked].tolist():
+        profile.preferences['liked_recipes'].append({'recipe_id': str(recipe_id), 'recipe_name': f'Recipe {recipe_id}'})
+        profile.recipe_ratings[str(recipe_id)] += 1
+    for recipe_id in chosen[liked:].tolist():
+        profile.preferences['disliked_recipes'].append({'recipe_id': str(recipe_id), 'recipe_name': f'Recipe {recipe_id}'})
+        profile.recipe_ratings[str(recipe_id)] += 0
+    for meal_type in CATEGORIES:
+        profile.preferences['meal_type_preferences'][meal_type] = float(rng.uniform(0, 5))
+    return profile
+
+
+def time_calls(fn: Callable, repeat: int) -> List[float]:
+    # wall-clock seconds of each call, with the code under test's prints silenced
+    samples = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - start)
+    return samples
+
+
+def peak_memory(fn: Callable) -> int:
+    # peak bytes allocated during one call, numpy buffers included
+    with contextlib.redirect_stdout(io.StringIO()):
+        tracemalloc.start()
+        try:
+            fn()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+
+def summarize(samples: List[float]) -> Dict:
+    # latency percentiles in milliseconds
+    ms = np.array(samples) * 1000.0
+    return {
+        'count': len(ms),
+        'mean_ms': float(ms.mean()),
+        'min_ms': float(ms.min()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p90_ms': float(np.percentile(ms, 90)),
+        'p99_ms': float(np.percentile(ms, 99)),
+        'max_ms': float(ms.max()),
+    }
+
+
+def bench(results: Dict, name: str, fn: Callable, repeat: int):
+    # time fn, record its latency summary and peak memory under name
+    with contextlib.redirect_stdout(io.StringIO()):
+        fn()  # warm-up call outside the measurements
+    stats = summarize(time_calls(fn, repeat))
+    stats['peak_memory_bytes'] = peak_memory(fn)
+    results[name] = stats
+    print(f"  {name:<32} p50 {stats['p50_ms']:10.3f} ms  p99 {stats['p99_ms']:10.3f} ms  peak {stats['peak_memory_bytes'] / 1e6:9.1f} MB")
+
+
+def run_size(n: int, repeat: int, work_dir: str, liked: int, disliked: int, seed: int = 0, shards: int = 0) -> Dict:
+    # every hot-path benchmark against a synthetic catalog of n recipes
+    data_dir = write_dataset(os.path.join(work_dir, f'recipes_{n}'), n, seed)
+    users_dir = os.path.join(work_dir, f'users_{n}')
+    results = {}
+    load_repeat = max(1, min(repeat, 5))  # loading is slow at large sizes
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        suggester = RecipeSuggester(data_dir, use_store=False, user_manager=UserManager(users_dir))
+    bench(results, 'load_recipes_csv', suggester.load_recipes, load_repeat)
+    raw_bytes, table_bytes = memory_report(read_category_csvs(data_dir))['total'], suggester.memory_usage_report()['total']
+    results['load_recipes_csv'].update(raw_table_bytes=raw_bytes, table_bytes=table_bytes)
+    print(f"  {'recipe table memory':<32} {table_bytes / 1e6:.1f} MB (concatenated csv frames {raw_bytes / 1e6:.1f} MB)")
+    build_store(data_dir)
+    suggester.use_store = True
+    bench(results, 'load_recipes_store', suggester.load_recipes, load_repeat)
+    suggester.recipes_df = suggester.load_recipes()  # score against the store-backed table
+    bench(results, 'start_cold', lambda: RecipeSuggester(data_dir, user_manager=suggester.user_manager), load_repeat)  # state built from the store
+    RecipeSuggester(data_dir, user_manager=suggester.user_manager, use_snapshot=True)  # writes the snapshot
+    bench(results, 'start_warm', lambda: RecipeSuggester(data_dir, user_manager=suggester.user_manager, use_snapshot=True), load_repeat)
+
+    queries = iter(QUERIES * (repeat + 2))
+    bench(results, 'analyze_user_input', lambda: suggester.analyze_user_input(next(queries)), repeat)
+
+    recipe_ids = suggester.recipes_df['RecipeId'].to_numpy()
+    profile = generate_profile('bench', recipe_ids, liked, disliked, seed)
+    queries = iter(QUERIES * (repeat + 2))
+    bench(results, 'get_recipe_suggestions', lambda: suggester.get_recipe_suggestions(profile, next(queries), 10), repeat)
+    if shards:
+        run_sharded(results, data_dir, suggester.user_manager, profile, repeat, shards)
+
+    feedback_ids = iter(np.random.default_rng(seed + 1).choice(recipe_ids, size=repeat + 2).tolist())
+    bench(results, 'update_user_preference', lambda: suggester.update_user_preference(profile, str(next(feedback_ids)), 'bench', liked=True), repeat)
+    bench(results, 'save_user_profile', lambda: suggester.user_manager.save_user_profile(profile), repeat)
+    run_similarity(results, suggester.get_similarity_index(), min(repeat, 50), seed=seed)
+    return results
+
+
+def run_sharded(results: Dict, data_dir: str, user_manager: UserManager, profile: UserProfile, repeat: int, shards: int):
+    # the same suggestions scored in shards on a process pool, every partition sharded whatever its size
+    with contextlib.redirect_stdout(io.StringIO()):
+        sharded = RecipeSuggester(data_dir, user_manager=user_manager, use_snapshot=True, shards=shards)
+    sharded.shard_min_rows = 0
+    try:
+        queries = iter(QUERIES * (repeat + 2))
+        bench(results, 'get_recipe_suggestions_sharded', lambda: sharded.get_recipe_suggestions(profile, next(queries), 10), repeat)
+    finally:
+        sharded.stop_sharding()
+    speedup = results['get_recipe_suggestions']['p50_ms'] / results['get_recipe_suggestions_sharded']['p50_ms']
+    results['get_recipe_suggestions_sharded'].update(shards=shards, speedup=speedup)
+    print(f"  {'sharded speedup':<32} x{speedup:.2f} on {shards} workers")
+
+
+def shard_crossover(report: Dict):
+    # smallest catalog size at which sharded scoring beat the single core, None if it never did
+    for size, benchmarks in sorted(report['results'].items(), key=lambda item: int(item[0])):
+        if benchmarks.get('get_recipe_suggestions_sharded', {}).get('speedup', 0) > 1:
+            return int(size)
+    return None
+
+
+def run_similarity(results: Dict, index: SimilarityIndex, queries: int, k: int = 10, seed: int = 0):
+    # recall and latency of the lsh neighbor search against exact search
+    rows = np.random.default_rng(seed).choice(len(index), size=min(queries, len(index)), replace=False).tolist()
+    exact = {}
+    samples = []
+    for row in rows:
+        start = time.perf_counter()
+        exact[row] = index.exact_neighbors(row, k)[1]
+        samples.append(time.perf_counter() - start)
+    results['similarity_exact'] = dict(summarize(samples), recall=1.0)
+    memory = index.memory_per_recipe()
+    for name, probe in [('similarity_lsh', False), ('similarity_lsh_probe', True)]:
+        samples, recalls = [], []
+        for row in rows:
+            start = time.perf_counter()
+            _, similarities = index.neighbors(row, k, probe)
+            samples.append(time.perf_counter() - start)
+            recalls.append(recall_at_k(similarities, exact[row]))
+        results[name] = dict(summarize(samples), recall=float(np.mean(recalls)), bytes_per_recipe=memory['total'])
+    for name in ['similarity_exact', 'similarity_lsh', 'similarity_lsh_probe']:
+        stats = results[name]
+        print(f"  {name:<32} p50 {stats['p50_ms']:10.3f} ms  p99 {stats['p99_ms']:10.3f} ms  recall@{k} {stats['recall']:.3f}")
+    print(f"  {'similarity index memory':<32} {memory['total']:.0f} bytes/recipe "
+          f"(vectors {memory['vectors']:.0f}, codes {memory['codes']:.0f}, order {memory['order']:.0f})")
+
+
+def compare(current: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    # regressions where the p50 latency grew by more than tolerance
+    regressions = []
+    for size, benchmarks in current['results'].items():
+        for name, stats in benchmarks.items():
+            old = baseline.get('results', {}).get(size, {}).get(name)
+            if old is None:
+                continue
+            ratio = stats['p50_ms'] / old['p50_ms'] if old['p50_ms'] else float('inf')
+            marker = 'REGRESSION' if ratio > 1 + tolerance else ''
+            print(f"  {size:>8} {name:<32} {old['p50_ms']:10.3f} -> {stats['p50_ms']:10.3f} ms  x{ratio:5.2f} {marker}")
+            if marker:
+                regressions.append(f"{size}/{name}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the recipe suggester hot paths")  # create an argument parser for the script
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000], help="Synthetic catalog sizes")
+    parser.add_argument('--repeat', type=int, default=50, help="Timed calls per benchmark")
+    parser.add_argument('--liked', type=int, default=2000, help="Liked recipes in the synthetic profile")
+    parser.add_argument('--disliked', type=int, default=1000, help="Disliked recipes in the synthetic profile")
+    parser.add_argument('--work-dir', default=None, help="Where synthetic datasets are written (default: a temporary directory)")
+    parser.add_argument('--output', default=None, help="Save results as JSON (use as a baseline later)")
+    parser.add_argument('--compare', default=None, help="Baseline JSON to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed p50 slowdown before flagging a regression")
+    parser.add_argument('--shards', type=int, default=0, help="Also score in this many worker processes and report the speedup")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='recipe_bench_')
+    report = {'created': datetime.now().isoformat(), 'python': sys.version.split()[0], 'numpy': np.__version__,
+              'pandas': pd.__version__, 'repeat': args.repeat, 'results': {}}
+    try:
+        for n in args.sizes:
+            print(f"\n{n} recipes:")
+            report['results'][str(n)] = run_size(n, args.repeat, work_dir, args.liked, args.disliked, args.seed, args.shards)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    if args.shards:
+        report['shard_crossover'] = shard_crossover(report)
+        crossover = report['shard_crossover']
+        print(f"\nSharded scoring on {args.shards} workers " + (f"pays off from {crossover} recipes" if crossover else "did not pay off at these sizes"))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults saved to {args.output}")
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        print(f"\nComparison with {args.compare}:")
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+import os
+import json
+import time
+import argparse  # arg parsing
+import threading
+from collections import Counter, defaultdict
+from typing import Iterable, List, Optional, Tuple  # for type hinting
+
+import numpy as np
+
+from profilestore import make_backend
+from recipeindex import recipe_key
+
+# item-item collaborative filtering over the liked recipes of every stored profile
+#
+# two recipes are similar when the same users liked both: the cosine of their columns in the
+# user-item matrix, co_likes(a, b) / sqrt(likes(a) * likes(b)). only the TOP_N most similar
+# recipes of each recipe are kept, as csr rows of co-like counts, so new likes can add to the
+# counts without rebuilding. pairs are counted one range of items at a time, so build memory is
+# bounded by CHUNK_PAIRS whatever the number of interactions.
+#
+# layout inside the users directory, in a subdirectory so profile backends never list the model as a profile:
+#   collaborative/model.json      users, interactions and top_n of the last build
+#   collaborative/items.npy       int64 RecipeIds, sorted; item i is items[i]
+#   collaborative/likes.npy       int32 number of users who liked each item
+#   collaborative/offsets.npy     int64 row offsets, row i is neighbors[offsets[i]:offsets[i + 1]]
+#   collaborative/neighbors.npy   int32 item index of each kept neighbor, most similar first
+#   collaborative/counts.npy      int32 users who liked both recipes
+
+TOP_N = 50  # neighbors kept per recipe
+MAX_USER_ITEMS = 500  # most recent likes counted per user, bounds the pairs one heavy user adds
+CHUNK_PAIRS = 1 << 22  # pairs counted at once while building
+MERGE_PENDING = 100000  # co-likes added since the last build before they are folded into the csr rows
+ARRAYS = ['items', 'likes', 'offsets', 'neighbors', 'counts']
+MODEL_DIRNAME = 'collaborative'  # model subdirectory inside the users directory
+
+
+class CollaborativeModel:
+    def __init__(self, items: np.ndarray, likes: np.ndarray, offsets: np.ndarray, neighbors: np.ndarray, counts: np.ndarray,
+                 users: int = 0, top_n: int = TOP_N):
+        self.items = items  # sorted int64 RecipeIds
+        self.likes = likes  # users who liked each item
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.counts = counts
+        self.users = users  # profiles with at least one like at build time
+        self.top_n = top_n
+        self.pending = defaultdict(Counter)  # RecipeId -> Counter of RecipeId -> co-likes added since the build
+        self.pending_likes = Counter()  # RecipeId -> likes added since the build
+        self.pending_pairs = 0
+        self.lock = threading.RLock()  # service threads add likes while others read the model
+
+    @classmethod
+    def build(cls, liked_lists: Iterable[List], top_n: int = TOP_N) -> 'CollaborativeModel':
+        # model from each user's liked RecipeIds, oldest first
+        lengths, ids = [], []
+        for liked in liked_lists:
+            keys = [k for k in (recipe_key(r) for r in liked[-MAX_USER_ITEMS:]) if k is not None]
+            keys = np.unique(np.array(keys, dtype=np.int64))
+            if len(keys):
+                lengths.append(len(keys))
+                ids.append(keys)
+        items = np.unique(np.concatenate(ids + [np.zeros(0, dtype=np.int64)]))
+        user_items = np.searchsorted(items, np.concatenate(ids + [np.zeros(0, dtype=np.int64)])).astype(np.int32)  # user-major
+        lengths = np.array(lengths, dtype=np.int64)
+        likes = np.bincount(user_items, minlength=len(items)).astype(np.int32)
+
+        # item-major view: the users of every item, to count one range of items at a time
+        users = np.repeat(np.arange(len(lengths)), lengths)
+        order = np.argsort(user_items, kind='stable')
+        item_users = users[order]
+        item_offsets = np.zeros(len(items) + 1, dtype=np.int64)
+        np.cumsum(likes, out=item_offsets[1:])
+        user_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=user_offsets[1:])
+
+        # pairs starting at each item, then ranges of items holding about CHUNK_PAIRS pairs each
+        item_pairs = np.bincount(user_items, weights=np.repeat(lengths - 1, lengths), minlength=len(items))
+        bounds = np.searchsorted(np.cumsum(item_pairs), np.arange(CHUNK_PAIRS, item_pairs.sum() + CHUNK_PAIRS, CHUNK_PAIRS), side='right')
+        bounds = np.unique(np.concatenate([[0], np.minimum(bounds, len(items)), [len(items)]]))
+
+        parts = []
+        for lo, hi in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            start, stop = item_offsets[lo], item_offsets[hi]
+            a = np.repeat(np.arange(lo, hi), likes[lo:hi])  # item of each interaction in the range
+            u = item_users[start:stop]
+            m = lengths[u]
+            firsts = np.repeat(user_offsets[u] - (np.cumsum(m) - m), m)  # gather every item of each interaction's user
+            b = user_items[firsts + np.arange(m.sum())]
+            a = np.repeat(a, m)
+            keep = a != b
+            keys, counts = np.unique(a[keep].astype(np.int64) * len(items) + b[keep], return_counts=True)
+            parts.append(prune_pairs(keys // len(items), keys % len(items), counts, likes, top_n))
+        return cls(items, likes, *csr_rows(parts, len(items)), users=len(lengths), top_n=top_n)
+
+    @classmethod
+    def from_profiles(cls, backend, top_n: int = TOP_N) -> 'CollaborativeModel':
+        # model from every profile a storage backend holds
+        def liked_lists():
+            for username in backend.list_users():
+                data = backend.load(username)
+                if data is not None:
+                    yield [entry['recipe_id'] for entry in data['preferences']['liked_recipes']]
+        return cls.build(liked_lists(), top_n)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def item_likes(self, ids: np.ndarray) -> np.ndarray:
+        # users who liked each RecipeId, new likes included
+        with self.lock:
+            slots = np.searchsorted(self.items, ids).clip(max=max(len(self.items) - 1, 0))
+            likes = np.where(self.items[slots] == ids, self.likes[slots], 0) if len(self.items) else np.zeros(len(ids), dtype=np.int64)
+            if self.pending_likes:
+                likes = likes + np.array([self.pending_likes.get(i, 0) for i in ids.tolist()], dtype=np.int64)
+            return likes
+
+    def related(self, seeds: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # RecipeIds related to any seed RecipeId and the sum of their similarities to the seeds
+        with self.lock:
+            seeds = np.unique(np.asarray(seeds, dtype=np.int64))
+            slots = np.searchsorted(self.items, seeds).clip(max=max(len(self.items) - 1, 0))
+            known = slots[self.items[slots] == seeds] if len(self.items) else slots[:0]
+            starts, lengths = self.offsets[known], self.offsets[known + 1] - self.offsets[known]
+            positions = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())  # every kept pair of the seeds
+            seed_ids = np.repeat(self.items[known], lengths)
+            other_ids = self.items[self.neighbors[positions]]
+            counts = self.counts[positions].astype(np.int64)
+            if self.pending:  # co-likes added since the build, summed with the stored ones below
+                extra = [(seed, other, count) for seed in seeds.tolist() for other, count in self.pending.get(seed, {}).items()]
+                if extra:
+                    seed_ids = np.concatenate([seed_ids, np.array([e[0] for e in extra], dtype=np.int64)])
+                    other_ids = np.concatenate([other_ids, np.array([e[1] for e in extra], dtype=np.int64)])
+                    counts = np.concatenate([counts, np.array([e[2] for e in extra], dtype=np.int64)])
+            if not len(counts):
+                return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+            pair_ids, inverse = np.unique(np.stack([seed_ids, other_ids]), axis=1, return_inverse=True)
+            counts = np.bincount(inverse.reshape(-1), weights=counts)
+            similarity = cosine(counts, self.item_likes(pair_ids[0]), self.item_likes(pair_ids[1]))
+            ids, inverse = np.unique(pair_ids[1], return_inverse=True)
+            return ids, np.bincount(inverse.reshape(-1), weights=similarity)
+
+    def add_like(self, recipe_id, liked_ids: Iterable):
+        # record that a user liked recipe_id, having already liked liked_ids
+        with self.lock:
+            key = recipe_key(recipe_id)
+            if key is None:
+                return
+            self.pending_likes[key] += 1
+            for other in liked_ids:
+                if other != key:
+                    self.pending[key][other] += 1
+                    self.pending[other][key] += 1
+                    self.pending_pairs += 2
+            if self.pending_pairs >= MERGE_PENDING:
+                self.merge()
+
+    def merge(self):
+        # fold pending likes into the csr rows and prune every row to top_n again
+        # a pair pruned at the last build starts counting from zero, the usual cost of keeping only top_n
+        with self.lock:
+            if not self.pending and not self.pending_likes:
+                return
+            extra_ids = np.fromiter(set(self.pending_likes) | set(self.pending), dtype=np.int64)
+            items = np.union1d(self.items, extra_ids)
+            likes = np.zeros(len(items), dtype=np.int64)
+            likes[np.searchsorted(items, self.items)] = self.likes
+            pending_likes = np.array(list(self.pending_likes.items()), dtype=np.int64).reshape(-1, 2)
+            np.add.at(likes, np.searchsorted(items, pending_likes[:, 0]), pending_likes[:, 1])
+
+            rows = np.repeat(np.arange(len(self.items)), np.diff(self.offsets))
+            pending = np.array([(a, b, c) for a, others in self.pending.items() for b, c in others.items()], dtype=np.int64).reshape(-1, 3)
+            a = np.concatenate([np.searchsorted(items, self.items[rows]), np.searchsorted(items, pending[:, 0])])
+            b = np.concatenate([np.searchsorted(items, self.items[self.neighbors]), np.searchsorted(items, pending[:, 1])])
+            keys, inverse = np.unique(a.astype(np.int64) * len(items) + b, return_inverse=True)
+            counts = np.bincount(inverse.reshape(-1), weights=np.concatenate([self.counts, pending[:, 2]])).astype(np.int64)
+            part = prune_pairs(keys // len(items), keys % len(items), counts, likes, self.top_n)
+            self.items, self.likes = items, likes.astype(np.int32)
+            self.offsets, self.neighbors, self.counts = csr_rows([part], len(items))
+            self.pending, self.pending_likes, self.pending_pairs = defaultdict(Counter), Counter(), 0
+
+    def memory_bytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in ARRAYS)
+
+    def save(self, directory: str):
+        # each file is replaced atomically, so processes reading the old arrays through a memory map keep working
+        with self.lock:  # the arrays written belong to one merge
+            self.merge()
+            model_dir = os.path.join(directory, MODEL_DIRNAME)
+            os.makedirs(model_dir, exist_ok=True)
+            for name in ARRAYS:
+                tmp_path = os.path.join(model_dir, f"{name}.tmp.npy")
+                np.save(tmp_path, getattr(self, name))
+                os.replace(tmp_path, os.path.join(model_dir, f"{name}.npy"))
+            with open(os.path.join(model_dir, 'model.json'), 'w') as f:
+                json.dump({'users': self.users, 'interactions': int(self.likes.sum()), 'top_n': self.top_n}, f)
+
+    @classmethod
+    def load(cls, directory: str) -> Optional['CollaborativeModel']:
+        # memory-mapped model, None when none was built for this directory
+        model_dir = os.path.join(directory, MODEL_DIRNAME)
+        meta_path = os.path.join(model_dir, 'model.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        arrays = [np.load(os.path.join(model_dir, f"{name}.npy"), mmap_mode='r') for name in ARRAYS]
+        return cls(*arrays, users=meta['users'], top_n=meta['top_n'])
+
+
+def cosine(counts: np.ndarray, likes_a: np.ndarray, likes_b: np.ndarray) -> np.ndarray:
+    # co_likes / sqrt(likes(a) * likes(b)); a pending pair can name an item liked before the model existed, whose like was
+    # never counted, so each end counts at least the pair's co-likes, which keeps the similarity finite and at most 1
+    counts = counts.astype(np.float64)
+    return counts / np.sqrt(np.maximum(np.maximum(likes_a, counts) * np.maximum(likes_b, counts), 1))
+
+
+def prune_pairs(a: np.ndarray, b: np.ndarray, counts: np.ndarray, likes: np.ndarray, top_n: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # the top_n most similar (a, b, count) pairs of every item a, sorted by a, most similar first
+    similarity = cosine(counts, likes[a], likes[b])
+    order = np.lexsort((b, -similarity, a))
+    a, b, counts = a[order], b[order], counts[order]
+    starts = np.flatnonzero(np.concatenate([[True], a[1:] != a[:-1]])) if len(a) else np.zeros(0, dtype=np.int64)
+    rank = np.arange(len(a)) - np.repeat(starts, np.diff(np.concatenate([starts, [len(a)]])))
+    keep = rank < top_n
+    return a[keep], b[keep], counts[keep]
+
+
+def csr_rows(parts: List[Tuple[np.ndarray, np.ndarray, np.ndarray]], n: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # (offsets, neighbors, counts) from pruned pair parts that are in item order
+    a = np.concatenate([p[0] for p in parts] + [np.zeros(0, dtype=np.int64)])
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(a, minlength=n), out=offsets[1:])
+    neighbors = np.concatenate([p[1] for p in parts] + [np.zeros(0, dtype=np.int64)]).astype(np.int32)
+    counts = np.concatenate([p[2] for p in parts] + [np.zeros(0, dtype=np.int64)]).astype(np.int32)
+    return offsets, neighbors, counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the item-item collaborative model from stored profiles")  # create an argument parser for the script
+    parser.add_argument('--users-dir', default='users', help="Directory holding the profiles; the model is written there")
+    parser.add_argument('--profiles', choices=['json', 'sqlite'], default='json', help="Profile storage backend")
+    parser.add_argument('--top-n', type=int, default=TOP_N, help="Neighbors kept per recipe")
+    args = parser.parse_args()
+
+    backend = make_backend(args.profiles, args.users_dir)
+    start = time.perf_counter()
+    model = CollaborativeModel.from_profiles(backend, args.top_n)
+    seconds = time.perf_counter() - start
+    model.save(args.users_dir)
+    backend.close()
+    print(f"Built {len(model)} recipes, {len(model.neighbors)} pairs from {int(model.likes.sum())} likes of {model.users} users "
+          f"in {seconds:.2f}s ({model.memory_bytes() / 1e6:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,47 +1,123 @@
 import os
+import re
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List  # for type hinting
+
+import numpy as np
 import pandas as pd
+from recipestore import build_store, dedupe_recipes, read_category_csvs
 #download original dataset from link and put in same dir as script
 #original dataset- https://www.kaggle.com/datasets/irkaal/foodcom-recipes-and-reviews
 
-def filter_and_save_data(df, keywords_list, meal_type, output_dir, limit=None):
-    # create regex pattern from keywords list
-    meal_type_keywords = '|'.join(keywords_list)
-    
-     # filter recipes based on keywords in RecipeCategory and Keywords columns from dataset
-    filtered_df = df[
-        df['RecipeCategory'].str.contains(meal_type_keywords, case=False, na=False) | 
-        df['Keywords'].str.contains(meal_type_keywords, case=False, na=False)
-    ]
-    
-    print(f"Filtered {meal_type.capitalize()}: {filtered_df.shape[0]} records found.")  # Debugging line
-    
-     # If filtered_df not empty then save it
-    if not filtered_df.empty:
-        if limit:
-            filtered_df = filtered_df.head(limit)
-        file_path = os.path.join(output_dir, f"{meal_type.lower()}.csv")
-        filtered_df.to_csv(file_path, index=False)
-        print(f"{meal_type.capitalize()} dataset saved to {file_path}")
-    else:
-        print(f"No records found for {meal_type.capitalize()}. Skipping.")
+CATEGORIES = {
+    'breakfast': ['breakfast', 'brunch', 'morning'],
+    'lunch': ['lunch', 'sandwich', 'salad', 'soup'],
+    'dinner': ['dinner', 'supper', 'main course', 'entree', 'meal', 'dish'],
+    'appetizer': ['appetizer', 'starter', 'hors d\'oeuvre', 'snack'],
+    'dessert': ['dessert', 'sweet', 'cake', 'pie', 'cookie', 'pastry']
+}  # meal types and the keywords matched against RecipeCategory and Keywords, can add more??
+MATCH_COLUMNS = ['RecipeCategory', 'Keywords']  # columns searched for keywords
+CHUNK_SIZE = 20000  # source rows held in memory at once
+
+
+class CategoryClassifier:
+    # matches every category's keywords in one scan per row
+    def __init__(self, categories: Dict[str, List[str]]):
+        self.meal_types = list(categories)
+        keywords = sorted({k.casefold() for words in categories.values() for k in words}, key=len, reverse=True)  # longest first
+        # a zero-width lookahead finds a keyword starting at every position, so matches may overlap
+        self.pattern = re.compile('(?=(' + '|'.join(re.escape(k) for k in keywords) + '))', re.IGNORECASE)
+        # at one position only the longest keyword is reported, so it also stands for the keywords that prefix it
+        self.bits = {}
+        for keyword in keywords:
+            self.bits[keyword] = 0
+            for bit, words in enumerate(categories.values()):
+                if any(keyword.startswith(w.casefold()) for w in words):
+                    self.bits[keyword] |= 1 << bit
+
+    def mask(self, text: str) -> int:
+        # bit i is set when the text matches a keyword of meal type i
+        mask = 0
+        for keyword in self.pattern.findall(text):
+            mask |= self.bits[keyword.casefold()]
+        return mask
+
+    def masks(self, columns: List[List[str]]) -> np.ndarray:
+        # category bitmask of every row, a row matches when any column matches
+        return np.fromiter((self.mask('\n'.join(values)) for values in zip(*columns)), dtype=np.int64, count=len(columns[0]))
+
+
+def read_chunks(source: str, chunk_size: int = CHUNK_SIZE):
+    # source rows as text, so values are written back exactly as read
+    return pd.read_csv(source, chunksize=chunk_size, dtype=str, keep_default_na=False)
+
+
+def classified_chunks(chunks, classifier: CategoryClassifier, workers: int = 1):
+    # (chunk, masks) in source order; with workers > 1 a bounded window of chunks is classified in a process pool
+    if workers <= 1:
+        for chunk in chunks:
+            yield chunk, classifier.masks([chunk[c].tolist() for c in MATCH_COLUMNS])
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        window = deque()  # at most 2 * workers chunks in memory
+        for chunk in chunks:
+            window.append((chunk, executor.submit(classifier.masks, [chunk[c].tolist() for c in MATCH_COLUMNS])))
+            if len(window) >= 2 * workers:
+                chunk, future = window.popleft()
+                yield chunk, future.result()
+        while window:
+            chunk, future = window.popleft()
+            yield chunk, future.result()
+
+
+def build_category_files(source: str, output_dir: str, categories: Dict[str, List[str]] = CATEGORIES, limit: int = None,
+                         chunk_size: int = CHUNK_SIZE, workers: int = 1) -> Dict[str, int]:
+    # stream the source once, appending every row to the file of each meal type it matches
+    classifier = CategoryClassifier(categories)
+    paths = {meal_type: os.path.join(output_dir, f"{meal_type.lower()}.csv") for meal_type in categories}
+    for path in paths.values():
+        if os.path.exists(path):
+            os.remove(path)  # files are appended to, start from scratch
+    written = dict.fromkeys(categories, 0)
+
+    for chunk, masks in classified_chunks(read_chunks(source, chunk_size), classifier, workers):
+        for bit, meal_type in enumerate(classifier.meal_types):
+            rows = chunk[(masks >> bit) & 1 == 1]
+            if limit is not None:
+                rows = rows.head(limit - written[meal_type])
+            if len(rows):
+                rows.to_csv(paths[meal_type], mode='a', header=written[meal_type] == 0, index=False)
+                written[meal_type] += len(rows)
+        if limit is not None and all(count >= limit for count in written.values()):
+            break  # every file is full, stop reading the source
+
+    for meal_type, count in written.items():
+        if count:
+            print(f"{meal_type.capitalize()} dataset saved to {paths[meal_type]}: {count} records.")
+        else:
+            print(f"No records found for {meal_type.capitalize()}. Skipping.")
+    return written
 
 
 def combine_min_files(min_dir, output_file):
-    # get all csvs
-    csv_files = [os.path.join(min_dir, f) for f in os.listdir(min_dir) if f.endswith('.csv')]
-    # combine into dataframe
-    combined_df = pd.concat([pd.read_csv(f) for f in csv_files], ignore_index=True)
+    # combine the category files into one csv with one row per recipe and a meal_types bitmask
+    combined_df = dedupe_recipes(read_category_csvs(min_dir))
     combine_dir = os.path.join(min_dir, 'combine') #create dir if not exist
     os.makedirs(combine_dir, exist_ok=True)
     #save combine version
-    combined_file_path = os.path.join(combine_dir, 'combined_recipes.csv')
+    combined_file_path = os.path.join(combine_dir, output_file)
     combined_df.to_csv(combined_file_path, index=False)
     print(f"Combined CSV saved to {combined_file_path}")
 
 
 def main():
-    file_path = 'recipes.csv'  
-    df = pd.read_csv(file_path)
+    parser = argparse.ArgumentParser(description="Build the per-meal-type recipe files from recipes.csv")
+    parser.add_argument('--source', default='recipes.csv', help="Food.com recipes.csv")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="Rows read into memory at once")
+    parser.add_argument('--workers', type=int, default=1, help="Processes classifying chunks")
+    args = parser.parse_args()
     
     # user choice for dataset generation
     print("Choose dataset generation option:")
@@ -60,18 +136,9 @@ def main():
         return
     # create output directory 
     os.makedirs(output_dir, exist_ok=True)
-    # define categories and associated keywords can add more??
-    categories = {
-        'breakfast': ['breakfast', 'brunch', 'morning'],
-        'lunch': ['lunch', 'sandwich', 'salad', 'soup'],
-        'dinner': ['dinner', 'supper', 'main course', 'entree', 'meal', 'dish'],
-        'appetizer': ['appetizer', 'starter', 'hors d\'oeuvre', 'snack'],
-        'dessert': ['dessert', 'sweet', 'cake', 'pie', 'cookie', 'pastry']
-    }
-
-    # filter data for each meal type and save
-    for meal_type, keywords in categories.items():
-        filter_and_save_data(df, keywords, meal_type, output_dir, limit)
+
+    # filter data for all meal types in one streaming pass
+    build_category_files(args.source, output_dir, CATEGORIES, limit, args.chunk_size, args.workers)
 
     # ask user if wants to combine all min/ csv files into one medium dataset.
     if choice == '1':
@@ -79,5 +146,9 @@ def main():
         if combine_choice == 'yes':
             combine_min_files(output_dir, 'combined_recipes.csv')
 
+    # convert the category csv files into the columnar store main.py loads at startup
+    store_dir = build_store(output_dir)
+    print(f"Recipe store saved to {store_dir}")
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,159 @@
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple  # for type hinting
+
+# keyword matcher for meal type detection, compiled once from meal_keywords
+#
+# keywords are split into tokens and stored in a token trie, so multi-word phrases
+# like "main course" match as a unit and a query is scanned in one pass over its tokens
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")  # lowercase words and numbers; punctuation separates tokens
+MATCH = object()  # trie key holding the meal types a phrase ends in
+INGREDIENT_CLAUSE = re.compile(r"\b(?:with|using|containing)\b(.*)", re.IGNORECASE)  # "dinner with chicken and rice"
+CLAUSE_END = re.compile(r"[.;!?]|\b(?:for|in|under|over|above|below|less|more|fewer|within|at|up|max|min|without|that|which|please|tonight|today)\b", re.IGNORECASE)  # words ending the ingredient list
+TERM_SEPARATOR = re.compile(r",|&|\+|\b(?:and|or|plus)\b", re.IGNORECASE)  # separators between ingredients
+NUTRIENTS = r"protein|saturated fat|fat|carbohydrates?|carbs?|sugars?|fib(?:er|re)|sodium|salt|cholesterol"
+RANGE_PHRASE = re.compile(
+    r"\b(?:(?P<timer>prep|cook|total)(?:\s+time)?\s+)?(?:(?P<before>" + NUTRIENTS + r")\s+)?"
+    r"(?P<op>under|below|less than|fewer than|at most|up to|within|max(?:imum)?|over|above|more than|at least|min(?:imum)?)\s+"
+    r"(?P<value>\d+(?:\.\d+)?)\s*(?P<unit>minutes?|mins?|hours?|hrs?|h|kcal|calories|cals?|mg|grams?|g)\b"
+    r"(?:\s+(?:of\s+)?(?P<after>" + NUTRIENTS + r")\b)?", re.IGNORECASE)  # "under 20 minutes", "over 30g protein"
+UPPER_BOUNDS = {'under', 'below', 'less than', 'fewer than', 'at most', 'up to', 'within', 'max', 'maximum'}  # the rest are lower bounds
+NUTRIENT_COLUMNS = {'protein': 'ProteinContent', 'saturated fat': 'SaturatedFatContent', 'fat': 'FatContent',
+                    'carb': 'CarbohydrateContent', 'sugar': 'SugarContent', 'fib': 'FiberContent', 'sodium': 'SodiumContent',
+                    'salt': 'SodiumContent', 'cholesterol': 'CholesterolContent'}  # nutrient word prefix -> column
+FILLER_WORDS = {'a', 'an', 'the', 'some', 'my', 'leftover', 'leftovers', 'fresh'}  # dropped from ingredient terms
+
+
+def tokenize(text: str) -> List[str]:
+    # split text into lowercase word tokens
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def ingredient_terms(text: str) -> List[str]:
+    # ingredients named after "with", "using" or "containing", in order ("from scratch" is not an ingredient)
+    clause = INGREDIENT_CLAUSE.search(text)
+    if clause is None:
+        return []
+    clause = CLAUSE_END.split(clause.group(1), maxsplit=1)[0]
+    terms = []
+    for part in TERM_SEPARATOR.split(clause):
+        words = [word for word in tokenize(part) if word not in FILLER_WORDS]
+        if words and ' '.join(words) not in terms:
+            terms.append(' '.join(words))
+    return terms
+
+
+def range_constraints(text: str) -> List[Tuple[str, Optional[float], Optional[float]]]:
+    # (column, low, high) filters from phrases like "under 20 minutes" or "over 30g protein"
+    constraints = []
+    for match in RANGE_PHRASE.finditer(text):
+        unit = match.group('unit').lower()
+        value = float(match.group('value'))
+        if unit.startswith('h'):  # hours, hrs, h
+            column, value = {'prep': 'PrepTime', 'cook': 'CookTime'}.get((match.group('timer') or '').lower(), 'TotalTime'), value * 60
+        elif unit.startswith('m') and unit != 'mg':  # minutes, mins
+            column = {'prep': 'PrepTime', 'cook': 'CookTime'}.get((match.group('timer') or '').lower(), 'TotalTime')
+        elif unit in ('kcal', 'calories', 'cal', 'cals'):
+            column = 'Calories'
+        else:  # grams or milligrams of a named nutrient
+            nutrient = (match.group('after') or match.group('before') or '').lower()
+            column = next((c for prefix, c in NUTRIENT_COLUMNS.items() if nutrient.startswith(prefix)), None)
+            if column is None:
+                continue
+        if match.group('op').lower() in UPPER_BOUNDS:
+            constraints.append((column, None, value))
+        else:
+            constraints.append((column, value, None))
+    return constraints
+
+
+def strip_range_phrases(text: str) -> str:
+    # the input without its range phrases, so numbers and units are not searched as recipe text
+    return RANGE_PHRASE.sub(' ', text)
+
+
+class KeywordMatcher:
+    def __init__(self, meal_keywords: Dict[str, List[str]]):
+        self.trie = {}  # token -> child node; MATCH -> meal types ending here
+        for meal_type, keywords in meal_keywords.items():
+            for keyword in keywords:
+                tokens = tokenize(keyword)
+                if not tokens:
+                    continue
+                node = self.trie
+                for token in tokens:
+                    node = node.setdefault(token, {})
+                node.setdefault(MATCH, [])
+                if meal_type not in node[MATCH]:
+                    node[MATCH].append(meal_type)
+
+    def matches(self, tokens: List[str]) -> Iterable[Tuple[int, str]]:
+        # (start token, meal type) for every keyword phrase found, in order of position
+        for start in range(len(tokens)):
+            node = self.trie
+            for token in tokens[start:]:
+                node = node.get(token)
+                if node is None:
+                    break
+                for meal_type in node.get(MATCH, ()):
+                    yield start, meal_type
+
+    def score_tokens(self, tokens: List[str]) -> Dict[str, float]:
+        # number of keyword matches per meal type, in order of first match
+        meal_scores = {}
+        for _, meal_type in self.matches(tokens):
+            meal_scores[meal_type] = meal_scores.get(meal_type, 0) + 1
+        return meal_scores
+
+    def score(self, text: str) -> Dict[str, float]:
+        # keyword match counts per meal type for raw text
+        return self.score_tokens(tokenize(text))
+
+
+def normalize_query(text: str) -> str:
+    # cache key of an input: case and spacing do not change its tokens or lemmas
+    return ' '.join(text.lower().split())
+
+
+class ClassificationCache:
+    # bounded lru cache from normalized input text to meal type, valid for one matcher and nlp mode
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity  # maximum number of cached inputs
+        self.entries = OrderedDict()  # key -> meal type, least recently used first
+        self.owner = None  # (matcher, nlp mode) the entries were classified with
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def bind(self, owner: Tuple):
+        # drop every entry when the keywords or the nlp mode changed since they were cached
+        with self.lock:
+            if self.owner != owner:
+                self.entries.clear()
+                self.owner = owner
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            meal_type = self.entries.get(key)
+            if meal_type is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)  # mark as most recently used
+            self.hits += 1
+            return meal_type
+
+    def put(self, key: str, meal_type: str):
+        with self.lock:
+            self.entries[key] = meal_type
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> Dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.entries), 'capacity': self.capacity, 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
@@ -1,20 +1,71 @@
+import numpy as np
 import pandas as pd  
-import spacy  
 import json  
 from collections import defaultdict 
-from typing import Dict, List  # for type hinting
+from typing import Dict, List, Optional  # for type hinting
 from datetime import datetime, timedelta  # for datetime operations
 import os  
 import argparse  # arg parsing
 import random  
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from metrics import REGISTRY  # stage timers and counters, no-ops unless enabled
+from profilestore import (  # json and sqlite profile storage, live profile cache
+    SAVED_STATES, JSONProfileBackend, ProfileCache, make_backend,
+)
+from keywordmatcher import (  # compiled meal keyword matcher
+    ClassificationCache, KeywordMatcher, ingredient_terms, normalize_query, range_constraints,
+    strip_range_phrases, tokenize,
+)
+from recipeindex import (  # RecipeId -> row position index
+    IngredientIndex, RangeFilter, RecipeIdIndex, duration_minutes, range_columns, recipe_key,
+)
+from scoring import (  # numpy scoring engine
+    PARTITION_ARRAYS, MealTypePartition, ProfileBatch, SuggestionCursor, append_partitions,
+    base_scores, bitmap_mask, blend_similarity, build_partitions, draw_uniform,
+    exclusion_candidates, profile_rating_arrays, profile_recipe_ids, row_bitmap, score_candidates,
+    sparse_lookup, top_k_positions,
+)
+from textsearch import TextIndex, frame_documents, text_terms  # tf-idf retrieval over recipe text
+from similarity import SimilarityIndex  # content-vector lsh for "more like this"
+from collaborative import CollaborativeModel  # item-item co-like model over all profiles
+from sharding import SHARD_MIN_ROWS, ShardedCursor, ShardedScorer  # multi-core scoring of large partitions
+from segments import (  # recipes ingested after the store was built
+    compact_segments, list_segments, read_segment, segments_dir,
+)
+from recipestore import (  # columnar recipe store
+    CATEGORY_FILES, MEAL_TYPES, STORE_DIRNAME, RecipeStore, build_store, compact_frame,
+    dedupe_recipes, memory_report, read_snapshot, snapshot_key, snapshot_path, store_is_current,
+    write_snapshot,
+)
 
-# load spaCy model globally to avoid repeated loading
-nlp = spacy.load("en_core_web_sm")
+# spaCy is only loaded when the richer nlp mode is used, and only once
+_nlp = None
+NLP_MODES = ['keyword', 'spacy']  # keyword: compiled keyword matcher only, spacy: match on spaCy lemmas
+
+
+def get_nlp():
+    # load the spaCy model on first use, without the pipes lemmatization does not need
+    global _nlp
+    if _nlp is None:
+        import spacy  # imported lazily so keyword mode never pays for it
+        _nlp = spacy.load("en_core_web_sm", disable=['parser', 'ner'])
+    return _nlp
 
 # constants
 MAX_WEIGHT = 5.0  # maximum cap for any meal type weight
 DECAY_FACTOR = 0.9  # decay factor to reduce weight by 10%
 DECAY_INTERVAL_DAYS = 30  # apply decay every 30 days
+TEXT_WEIGHT = 1.0  # text similarity can at most double a recipe's score
+NEIGHBOR_WEIGHT = 0.5  # a recipe just like a liked one scores up to 50% higher
+LIKED_SEEDS = 8  # most recently liked recipes whose neighbors are boosted
+NEIGHBORS_PER_SEED = 20  # neighbors looked up per liked recipe
+NEIGHBOR_CACHE_SIZE = 4096  # liked recipes whose neighbor lists are kept in memory
+COLLABORATIVE_WEIGHT = 0.5  # a recipe most co-liked with the user's likes scores up to 50% higher
+COLLABORATIVE_SEEDS = 50  # most recently liked recipes the collaborative boost starts from
+QUERY_CACHE_SIZE = 4096  # distinct inputs whose meal type is remembered
+INDEX_ATTRIBUTES = ['ingredient_index', 'range_filters', 'text_index', 'similarity_index']  # lazily loaded indexes extended by segments
 
 class UserProfile:
     def __init__(self, user_id: str):
@@ -31,6 +82,42 @@ class UserProfile:
         self.total_suggestions_received = 0  # track total suggestions received
         self.total_interactions = 0  # track total user interactions
         self.last_decay_date = datetime.now().isoformat()  # track when decay was last applied
+        self._decay_anchor = (None, None)  # (last_decay_date string, parsed datetime)
+        self.version = 0  # bumped on every preference change, cached masks built for an older version are rebuilt
+        self._id_sets = {}  # 'liked_recipes'/'disliked_recipes' -> (list, length, int id set) derived from the lists
+        self._bitmaps = None  # (key, liked bitmap, disliked bitmap) over the recipe table, see RecipeSuggester.profile_bitmaps
+
+    def recipe_ids(self, kind: str) -> set:
+        # int RecipeIds in preferences[kind], rebuilt only if the list was replaced or changed length outside add_recipe
+        entries = self.preferences[kind]
+        cached = self._id_sets.get(kind)
+        if cached is None or cached[0] is not entries or cached[1] != len(entries):
+            ids = {key for key in (recipe_key(entry['recipe_id']) for entry in entries) if key is not None}
+            self._id_sets[kind] = cached = (entries, len(entries), ids)
+            self.version += 1
+        return cached[2]
+
+    def liked_ids(self) -> set:
+        return self.recipe_ids('liked_recipes')
+
+    def disliked_ids(self) -> set:
+        return self.recipe_ids('disliked_recipes')
+
+    def add_recipe(self, kind: str, recipe_id: str, recipe_name: str) -> bool:
+        # append a recipe to preferences[kind] unless it is already there, in constant time
+        ids = self.recipe_ids(kind)
+        key = recipe_key(recipe_id)
+        if key is not None and key in ids:
+            return False
+        if key is None and any(r['recipe_id'] == recipe_id for r in self.preferences[kind]):  # ids that are not numbers
+            return False
+        self.preferences[kind].append({"recipe_id": recipe_id, "recipe_name": recipe_name})
+        if key is not None:
+            ids.add(key)
+        entries, _, _ = self._id_sets[kind]
+        self._id_sets[kind] = (entries, len(entries), ids)
+        self.version += 1
+        return True
 
     def to_dict(self) -> Dict:
         #convert profile to dictionary for storage
@@ -66,61 +153,220 @@ class UserProfile:
         profile.last_decay_date = data.get('last_decay_date', datetime.now().isoformat())  # load last decay date
         return profile  # return the profile object
 
-    def apply_decay(self):
-        #apply decay to weights if enough time has passed
-        last_decay_date = datetime.fromisoformat(self.last_decay_date)  # parse last decay date
-        current_date = datetime.now()  # get current date
-        days_since_decay = (current_date - last_decay_date).days  # calculate days since last decay
+    def decay_steps(self, now: datetime = None) -> int:
+        # whole decay intervals elapsed since last_decay_date
+        if self._decay_anchor[0] != self.last_decay_date:  # parse the stored date once per change
+            self._decay_anchor = (self.last_decay_date, datetime.fromisoformat(self.last_decay_date))
+        days = ((now or datetime.now()) - self._decay_anchor[1]).days
+        return max(days // DECAY_INTERVAL_DAYS, 0)
+
+    def meal_type_weight(self, meal_type: str, now: datetime = None) -> float:
+        # stored weight with the pending decay applied in closed form, without modifying the profile
+        weight = self.preferences['meal_type_preferences'].get(meal_type, 0)
+        steps = self.decay_steps(now) if weight else 0
+        return weight * DECAY_FACTOR ** steps if steps else weight
 
-        if days_since_decay >= DECAY_INTERVAL_DAYS:  # check if decay interval is met
-            for meal_type in self.preferences['meal_type_preferences']:  # iterate through meal types
-                self.preferences['meal_type_preferences'][meal_type] *= DECAY_FACTOR  # apply decay factor
-            self.last_decay_date = current_date.isoformat()  # update last decay date
+    def meal_type_weights(self, now: datetime = None) -> Dict[str, float]:
+        # every meal type weight as of now, see meal_type_weight
+        factor = DECAY_FACTOR ** self.decay_steps(now)
+        return {meal_type: weight * factor for meal_type, weight in self.preferences['meal_type_preferences'].items()}
+
+    def apply_decay(self, now: datetime = None) -> bool:
+        # fold the pending decay into the stored weights, one DECAY_FACTOR step per elapsed interval
+        steps = self.decay_steps(now)
+        if not steps:
+            return False
+        factor = DECAY_FACTOR ** steps
+        for meal_type in self.preferences['meal_type_preferences']:  # iterate through meal types
+            self.preferences['meal_type_preferences'][meal_type] *= factor  # apply decay factor
+        # the anchor moves by whole intervals only, so reads before and after this call agree
+        self.last_decay_date = (self._decay_anchor[1] + timedelta(days=steps * DECAY_INTERVAL_DAYS)).isoformat()
+        self.version += 1
+        return True
 
     def update_weight(self, meal_type: str):
         #update the weight for a meal type, applying cap and decay
         self.apply_decay()  # apply decay before updating
         new_weight = self.preferences['meal_type_preferences'].get(meal_type, 0) + 1.0  # increase weight
         self.preferences['meal_type_preferences'][meal_type] = min(new_weight, MAX_WEIGHT)  # apply cap
+        self.version += 1
+
+
+def decay_profile_files(users_dir: str, usernames: List[str], now: str) -> int:
+    # bulk decay worker: apply pending decay to json profiles, rewriting only those whose weights changed
+    backend = JSONProfileBackend(users_dir)
+    changed = 0
+    for username in usernames:
+        data = backend.load(username)
+        if data is None:
+            continue
+        profile = UserProfile.from_dict(data)
+        if profile.apply_decay(datetime.fromisoformat(now)):
+            backend.save(profile.to_dict())
+            changed += 1
+    return changed
 
 class UserManager:
-    def __init__(self, users_dir: str = "users"):
+    def __init__(self, users_dir: str = "users", backend: str = 'json', batch_size: int = 32, cache_size: int = 0, flush_interval: float = None):
         self.users_dir = users_dir  # set the directory for user profiles
         os.makedirs(users_dir, exist_ok=True)  # create directory if it doesn't exist
+        self.backend = make_backend(backend, users_dir, batch_size, cache_size or SAVED_STATES)  # json files or a sqlite database in users_dir
+        self.cache = ProfileCache(cache_size, self.write_user_profile) if cache_size > 0 else None  # live profiles, written back when dirty
+        self._stop_flush = threading.Event()  # stops the background flush thread
+        self._flush_thread = None
+        if self.cache is not None and flush_interval:  # periodically write dirty profiles in the background
+            self._flush_thread = threading.Thread(target=self._flush_loop, args=(flush_interval,), daemon=True)
+            self._flush_thread.start()
 
     def get_user_profile_path(self, username: str) -> str:
         return os.path.join(self.users_dir, f"{username.lower()}.json")  # return path to user profile file
 
-    def load_user_profile(self, username: str) -> UserProfile:
-        profile_path = self.get_user_profile_path(username)  # get profile path
-        if os.path.exists(profile_path):  # check if profile exists
-            with open(profile_path, 'r') as f:  # open profile file
-                data = json.load(f)  # load data from json
+    def find_user_profile(self, username: str) -> Optional[UserProfile]:
+        # the stored profile, None for an unknown user; nothing is created or saved
+        profile = self.cache.get(username.lower()) if self.cache is not None else None
+        if profile is not None:
+            return profile
+        with REGISTRY.timer('profile_io_seconds', op='load'):
+            data = self.backend.load(username)
+        if data is None:
+            return None
+        profile = UserProfile.from_dict(data)
+        if self.cache is not None:
+            self.cache.put(username.lower(), profile)  # keep the clean profile for later requests
+        return profile
+
+    def load_user_profile(self, username: str, login: bool = True) -> UserProfile:
+        # login=False fetches the profile quietly, without recording a new login
+        profile = self.cache.get(username.lower()) if self.cache is not None else None  # live profile if cached
+        if profile is not None:
+            REGISTRY.inc('profile_cache_lookups', result='hit')
+            if login:
+                print(f"Welcome back, {username}! Last login: {profile.last_login}")  # print welcome message
+                profile.last_login = datetime.now().isoformat()  # update last login
+                self.save_user_profile(profile)  # marks the cached profile dirty
+            return profile
+
+        REGISTRY.inc('profile_cache_lookups', result='miss' if self.cache is not None else 'uncached')
+        with REGISTRY.timer('profile_io_seconds', op='load'):
+            data = self.backend.load(username)  # load stored profile data, None if the user is new
+        if data is not None:  # check if profile exists
             profile = UserProfile.from_dict(data)  # create profile from data
-            profile.last_login = datetime.now().isoformat()  # update last login
-            self.save_user_profile(profile)  # save updated profile
-            print(f"Welcome back, {username}! Last login: {data['last_login']}")  # print welcome message
+            if login:
+                profile.last_login = datetime.now().isoformat()  # update last login
+                self.save_user_profile(profile)  # save updated profile
+                print(f"Welcome back, {username}! Last login: {data['last_login']}")  # print welcome message
+            elif self.cache is not None:
+                self.cache.put(username.lower(), profile)  # keep the clean profile for later requests
         else:
             profile = UserProfile(username)  # create new profile
-            print(f"Welcome, {username}! Created new profile.")  # print creation message
+            if login:
+                print(f"Welcome, {username}! Created new profile.")  # print creation message
             self.save_user_profile(profile)  # save new profile immediately
         return profile  # return user profile
 
     def save_user_profile(self, profile: UserProfile):
-        profile_path = self.get_user_profile_path(profile.user_id)  # get profile path
+        if self.cache is not None:  # defer the write until flush or eviction
+            self.cache.put(profile.user_id.lower(), profile, dirty=True)
+            return
+        self.write_user_profile(profile)
+
+    def write_user_profile(self, profile: UserProfile) -> bool:
         try:
-            with open(profile_path, 'w') as f:  # open file for writing
-                json.dump(profile.to_dict(), f, indent=2)  # save profile as json
+            with REGISTRY.timer('profile_io_seconds', op='save'):
+                self.backend.save(profile.to_dict())  # json rewrites the file atomically, sqlite writes only the changes
             print(f"Profile saved successfully for user {profile.user_id}")  # print success message
+            return True
         except Exception as e:
             print(f"Error saving profile for user {profile.user_id}: {e}")  # print error message
+            return False
+
+    def flush(self):
+        if self.cache is not None:
+            for profile in self.cache.take_dirty():  # write every profile changed since its last write
+                if not self.write_user_profile(profile):
+                    self.cache.put(profile.user_id.lower(), profile, dirty=True)  # keep it dirty for the next flush
+                self.cache.written(profile.user_id.lower(), profile)
+        with REGISTRY.timer('profile_io_seconds', op='flush'):
+            self.backend.flush()  # commit any batched profile writes
+
+    def _flush_loop(self, interval: float):
+        while not self._stop_flush.wait(interval):
+            self.flush()
+
+    def decay_all_profiles(self, workers: int = None, chunk_size: int = 256, now: datetime = None) -> Dict:
+        # offline maintenance: fold pending decay into every stored profile, rewriting only the changed ones
+        # json profiles are swept by a process pool; sqlite shares one connection, so it is swept in this process
+        self.flush()  # cached edits reach storage first; profiles decay in closed form, so later writes stay consistent
+        now = (now or datetime.now()).isoformat()
+        usernames = self.backend.list_users()
+        start = time.perf_counter()
+        if isinstance(self.backend, JSONProfileBackend):
+            chunks = [usernames[i:i + chunk_size] for i in range(0, len(usernames), chunk_size)]
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                changed = sum(pool.map(decay_profile_files, [self.users_dir] * len(chunks), chunks, [now] * len(chunks)))
+        else:
+            changed = 0
+            for username in usernames:
+                profile = UserProfile.from_dict(self.backend.load(username))
+                if profile.apply_decay(datetime.fromisoformat(now)):
+                    self.backend.save(profile.to_dict())
+                    changed += 1
+            self.backend.flush()
+        seconds = time.perf_counter() - start
+        return {'profiles': len(usernames), 'rewritten': changed, 'seconds': seconds,
+                'profiles_per_second': len(usernames) / seconds if seconds > 0 else 0.0}
+
+    def cache_stats(self) -> Dict:
+        # hit, miss and eviction counts for sizing the profile cache
+        return self.cache.stats() if self.cache is not None else {}
+
+    def close(self):
+        self._stop_flush.set()  # stop the background flush before the final one
+        if self._flush_thread is not None:
+            self._flush_thread.join()
+        self.flush()  # forced flush of dirty profiles at shutdown
+        self.backend.close()  # release the storage backend
 
 class RecipeSuggester:
-    def __init__(self, data_dir: str, debug: bool = False):
+    def __init__(self, data_dir: str, debug: bool = False, use_store: bool = True, store_dir: str = None, nlp_mode: str = 'keyword', user_manager: UserManager = None,
+                 use_snapshot: bool = False, shards: int = 0):
         self.debug = debug  # enable or disable debug mode
+        self.nlp_mode = nlp_mode  # how user input is analyzed, one of NLP_MODES
         self.data_dir = data_dir  # set the directory for recipe data
+        self.use_store = use_store  # prefer the columnar store over csv parsing when it is current
+        self.store_dir = store_dir or os.path.join(data_dir, STORE_DIRNAME)  # location of the columnar store
+        self.use_snapshot = use_snapshot  # map prepared state from a snapshot in the store, rebuilding both when the csv files change
+        self.ingredient_index = None  # ingredient -> rows inverted index, loaded on the first ingredient query
+        self.range_filters = None  # column -> sorted minutes or nutrient values, loaded on the first range query
+        self.text_index = None  # tf-idf index over recipe text, loaded on the first free-text query
+        self.similarity_index = None  # content-vector nearest-neighbor index, loaded on the first liked-recipe boost
+        self.neighbor_cache = {}  # row -> (neighbor rows, similarities) of recently used liked recipes
+        self.state_lock = threading.Lock()  # serializes segment swaps with the first load of each index
+        self.segment_df = None  # every column of the rows appended from segments, which follow the store's rows
+        self.segment_seq = 0  # last ingest sequence number appended
+        self.table_generation = 0  # bumped whenever recipe_ids is replaced, keys caches over the recipe table
+        self._stop_segments = threading.Event()  # stops the background segment watcher
+        self._segment_thread = None
+        self.shards = shards  # worker processes scoring large partitions in shards, 0 scores on the calling core
+        self.shard_min_rows = SHARD_MIN_ROWS  # smaller partitions are not worth the dispatch
+        self.sharded_scorer = None  # shared-memory partitions and their process pool, started on the first sharded query
+        start = time.perf_counter()
+        self.store = None  # set by load_recipes when the columnar store is used
         self.recipes_df = self.load_recipes()  # load all recipes from the specified directory
-        self.user_manager = UserManager()  # initialize the user manager to handle user profiles
+        self.start_type = self.prepare_state()  # RecipeId index and per-meal-type arrays: 'warm' from a snapshot, 'cold' when built
+        self.refresh_segments()  # recipes ingested since the store was built
+        self.start_seconds = time.perf_counter() - start  # time to a ready suggester
+        REGISTRY.observe('suggester_start_seconds', self.start_seconds, start=self.start_type)
+        if self.debug:  # if debug mode is enabled
+            print(f"{self.start_type.capitalize()} start in {self.start_seconds * 1000:.1f} ms")  # print the startup time
+        self.text_weight = TEXT_WEIGHT  # how strongly text similarity boosts a recipe's score
+        self.user_manager = user_manager or UserManager()  # initialize the user manager to handle user profiles
+        self.collaborative_model = None  # item-item model built from every profile, loaded on the first liked-recipe boost
+        self._collaborative_loaded = False  # the model is optional, remember that it was looked for
+        self.query_cache = ClassificationCache(QUERY_CACHE_SIZE)  # normalized input -> meal type of repeated inputs
+        self.base_score_cache = {}  # meal type -> (partition, read-only base score vector)
+        self.base_score_hits = 0
+        self.base_score_misses = 0
         self.meal_keywords = {  # define keywords for identifying meal types from user input
             'appetizer': ['appetizer', 'starter', 'snack'],
             'breakfast': ['breakfast', 'brunch', 'morning'],
@@ -136,8 +382,29 @@ class RecipeSuggester:
         ]
 
     def load_recipes(self) -> pd.DataFrame:
+        if self.use_store and self.use_snapshot and not store_is_current(self.data_dir, self.store_dir):  # the csv files changed
+            with REGISTRY.timer('recipe_load_seconds', source='rebuild'):
+                build_store(self.data_dir, self.store_dir)
+        if self.use_store and store_is_current(self.data_dir, self.store_dir):  # a store built from the current csv files exists
+            with REGISTRY.timer('recipe_load_seconds', source='store'):
+                recipes = self.load_recipes_from_store()
+        else:
+            with REGISTRY.timer('recipe_load_seconds', source='csv'):
+                recipes = self.load_recipes_from_csv()
+        REGISTRY.inc('recipes_loaded', len(recipes))
+        return recipes
+
+    def load_recipes_from_store(self) -> pd.DataFrame:
+        self.store = RecipeStore(self.store_dir)  # map the store; text columns stay on disk until shown
+        if self.debug:  # if debug mode is enabled
+            print(f"Loaded recipe store from: {self.store_dir}")  # print the store location
+        return self.store.frame()  # only the columns scoring needs
+
+    def load_recipes_from_csv(self) -> pd.DataFrame:
+        # fall back to parsing the category csv files
+        self.store = None
         dfs = []  # list to store dataframes of recipes
-        for category_file in ['appetizer.csv', 'breakfast.csv', 'dessert.csv', 'dinner.csv', 'lunch.csv']:  # iterate over all recipe categories
+        for category_file in CATEGORY_FILES:  # iterate over all recipe categories
             file_path = os.path.join(self.data_dir, category_file)  # construct the file path for the category
             if os.path.exists(file_path):  # check if the file exists
                 df = pd.read_csv(file_path)  # read the CSV file into a dataframe
@@ -145,99 +412,641 @@ class RecipeSuggester:
                 dfs.append(df)  # add the dataframe to the list
                 if self.debug:  # if debug mode is enabled
                     print(f"Loaded recipes from: {file_path}")  # print the file path of the loaded file
-        return pd.concat(dfs, ignore_index=True)  # combine all dataframes into one and return it
+        return compact_frame(dedupe_recipes(pd.concat(dfs, ignore_index=True)))  # one compact row per recipe across all files
+
+    def prepare_state(self) -> str:
+        # set recipe_index, recipe_ids and partitions, mapped from the snapshot when its key matches the csv files
+        key = snapshot_key(self.data_dir) if self.use_snapshot and self.store is not None else None
+        arrays = read_snapshot(snapshot_path(self.store_dir, key), key) if key else None
+        if arrays is not None:  # views of one read-only memory map, pages shared by every process mapping it
+            self.recipe_ids = arrays['recipe_ids']
+            self.table_generation += 1
+            self.recipe_index = RecipeIdIndex.from_sorted(arrays['sorted_ids'], arrays['sorted_rows'])
+            self.partitions = {meal_type: MealTypePartition(*(arrays[f"{meal_type}.{name}"] for name in PARTITION_ARRAYS))
+                               for meal_type in MEAL_TYPES if f"{meal_type}.rows" in arrays}
+            return 'warm'
+
+        self.recipe_index = RecipeIdIndex(self.recipes_df['RecipeId'].to_numpy())  # build the RecipeId -> row index once
+        self.recipe_ids = self.recipes_df['RecipeId'].to_numpy(dtype=np.int64)  # RecipeId of every row
+        self.table_generation += 1
+        self.partitions = build_partitions(self.recipes_df, MEAL_TYPES)  # per-meal-type id and rating arrays for scoring
+        if key:
+            self.save_snapshot(key)
+        return 'cold'
+
+    def save_snapshot(self, key: str):
+        # write the prepared state next to the store for the next start
+        arrays = {'recipe_ids': self.recipe_ids, 'sorted_ids': self.recipe_index.sorted_ids, 'sorted_rows': self.recipe_index.sorted_rows}
+        for meal_type, partition in self.partitions.items():
+            # the RecipeId sort order is built now so warm starts never sort
+            for name, values in zip(PARTITION_ARRAYS, [partition.rows, partition.recipe_ids, partition.ratings, partition.sort_order()]):
+                arrays[f"{meal_type}.{name}"] = values
+        try:
+            write_snapshot(snapshot_path(self.store_dir, key), key, arrays)
+        except OSError as e:  # a read-only data directory only costs the next start its warm path
+            print(f"Could not write snapshot to {self.store_dir}: {e}")
+
+    def refresh_segments(self) -> int:
+        # append the recipes of segments ingested since the last refresh, returns the number of rows added
+        with self.state_lock:
+            pending = [(last, path) for _, last, path in list_segments(segments_dir(self.data_dir)) if last > self.segment_seq]
+            if not pending:
+                return 0
+            try:
+                frames = [read_segment(path) for _, path in pending]
+            except FileNotFoundError:  # compacted after listing, the merged segment is read on the next refresh
+                return 0
+            with REGISTRY.timer('segment_swap_seconds'):
+                added = self.append_recipes(pd.concat(frames, ignore_index=True))
+            self.segment_seq = max(last for last, _ in pending)
+        REGISTRY.inc('segment_rows_loaded', added)
+        if self.debug and added:  # if debug mode is enabled
+            print(f"Appended {added} recipes from {len(pending)} segments")  # print the number of new recipes
+        return added
+
+    def append_recipes(self, frame: pd.DataFrame) -> int:
+        # add recipes after the last row without rebuilding anything; call with state_lock held
+        # the new state is built beside the old one and swapped in attribute by attribute, hydration sources first
+        # and the partitions requests start from last, so a request in flight only ever reaches rows every
+        # structure it reads already covers
+        ids = frame['RecipeId'].to_numpy(dtype=np.int64)
+        new = ~np.isin(ids, self.recipe_index.sorted_ids) & ~frame['RecipeId'].duplicated().to_numpy()  # a known RecipeId keeps its first row
+        columns = self.recipe_columns()
+        frame = compact_frame(frame[new].reindex(columns=columns + ['meal_type', 'meal_types']).reset_index(drop=True))
+        if not len(frame):
+            return 0
+        start = len(self.recipe_ids)
+        indexes = self.extend_indexes({name: getattr(self, name) for name in INDEX_ATTRIBUTES if getattr(self, name) is not None}, frame, start)
+        recipe_ids = np.concatenate([self.recipe_ids, frame['RecipeId'].to_numpy(dtype=np.int64)])
+        recipe_index = self.recipe_index.extend(frame['RecipeId'].to_numpy(), start)
+        partitions = append_partitions(self.partitions, build_partitions(frame, MEAL_TYPES, start))
+
+        self.segment_df = frame if self.segment_df is None else compact_frame(pd.concat([self.segment_df, frame], ignore_index=True))
+        self.recipes_df = compact_frame(pd.concat([self.recipes_df, frame[self.recipes_df.columns]], ignore_index=True))
+        for name, index in indexes.items():
+            setattr(self, name, index)
+        self.neighbor_cache = {}  # cached neighbor lists never include the new rows
+        self.recipe_ids, self.recipe_index = recipe_ids, recipe_index
+        self.table_generation += 1
+        self.partitions = partitions
+        return len(frame)
+
+    def recipe_columns(self) -> List[str]:
+        # source columns of the recipe table, in csv order
+        if self.store is not None:
+            return list(self.store.meta['columns'])
+        return [c for c in self.recipes_df.columns if c not in ('meal_type', 'meal_types')]
+
+    def extend_indexes(self, indexes: Dict, frame: pd.DataFrame, start: int) -> Dict:
+        # copies of loaded indexes with the frame's rows appended from table row start, the given ones stay usable
+        extended = {}
+        for name, index in indexes.items():
+            if name == 'ingredient_index':
+                extended[name] = index.extend(frame['RecipeIngredientParts'] if 'RecipeIngredientParts' in frame.columns else [''] * len(frame), start)
+            elif name == 'range_filters':
+                values = range_columns(frame)
+                extended[name] = {column: index[column].extend(values[column], start) for column in index}
+            elif name == 'text_index':
+                extended[name] = index.copy()
+                extended[name].add_documents(frame_documents(frame))
+            elif name == 'similarity_index':
+                extended[name] = index.extend(frame)
+        return extended
+
+    def with_segments(self, name: str, index):
+        # an index loaded from the store, extended with the rows appended from segments
+        if index is None or self.store is None or self.segment_df is None:
+            return index
+        return self.extend_indexes({name: index}, self.segment_df, self.store.rows)[name]
+
+    def watch_segments(self, interval: float):
+        # refresh and compact segments every interval seconds in a background thread
+        self._segment_thread = threading.Thread(target=self._segment_loop, args=(interval,), daemon=True)
+        self._segment_thread.start()
+
+    def _segment_loop(self, interval: float):
+        while not self._stop_segments.wait(interval):
+            try:
+                self.refresh_segments()
+                compact_segments(self.data_dir)
+            except (OSError, ValueError, KeyError) as e:  # a bad segment must not stop the service
+                print(f"Could not refresh segments in {segments_dir(self.data_dir)}: {e}")
+
+    def stop_watching_segments(self):
+        self._stop_segments.set()
+        if self._segment_thread is not None:
+            self._segment_thread.join()
+
+    def memory_usage_report(self) -> Dict[str, int]:
+        # bytes of the in-memory recipe table by column; with the store, text columns stay on disk
+        return memory_report(self.recipes_df)
+
+    def get_recipe_record(self, row: int) -> Dict:
+        # full recipe row by position, reading text columns from the store when it is in use
+        return self.get_recipe_records([row])[0]
+
+    def get_recipe_records(self, rows) -> List[Dict]:
+        # full recipe rows by position, in the given order
+        records = self.recipes_df.iloc[list(rows)].to_dict('records')  # columns held in memory
+        if self.store is not None:  # the store frame holds only scoring columns
+            records = [{**self.stored_record(row), **record} for row, record in zip(rows, records)]  # decode only these recipes' text
+        return records
+
+    def stored_record(self, row: int) -> Dict:
+        # every column of a row from the store, or from the segment rows appended after it
+        if row < self.store.rows:
+            return self.store.record(row)
+        return self.segment_df.iloc[row - self.store.rows].to_dict()
+
+    def get_recipe_row(self, recipe_id):
+        # row position of a recipe id through the primary-key index, None if unknown
+        return self.recipe_index.row(recipe_id)
+
+    def get_recipe_field(self, recipe_id, column: str):
+        # single column value for a recipe id, None if the recipe is unknown
+        row = self.get_recipe_row(recipe_id)
+        if row is None:
+            return None
+        if column in self.recipes_df.columns:  # scoring columns are in memory
+            return self.recipes_df[column].iat[row]
+        if row >= self.store.rows:  # appended from a segment
+            return self.segment_df[column].iat[row - self.store.rows]
+        return self.store.value(column, row)  # text columns are read from the store
+
+    def get_recipe_instructions(self, recipe_id):
+        # instructions for a recipe id, fetched only when the recipe is shown
+        return self.get_recipe_field(recipe_id, 'RecipeInstructions')
+
+    def get_ingredient_index(self) -> IngredientIndex:
+        # ingredient index from the store, or parsed once from the ingredient column
+        if self.ingredient_index is None:
+            with self.state_lock:  # a segment swap never misses an index that is being loaded
+                if self.ingredient_index is None:
+                    index = self.with_segments('ingredient_index', self.store.ingredient_index()) if self.store is not None else None
+                    if index is None:
+                        index = IngredientIndex.build(self.recipes_df['RecipeIngredientParts'] if 'RecipeIngredientParts' in self.recipes_df.columns else [])
+                    self.ingredient_index = index
+        return self.ingredient_index
+
+    def profile_bitmaps(self, profile: UserProfile):
+        # packed bitmaps of the liked and disliked rows of the recipe table, rebuilt only when the profile changed
+        recipe_ids, generation = self.recipe_ids, self.table_generation  # an id() can be reused once a swap frees the old table
+        key = (generation, len(recipe_ids), len(profile.liked_ids()), len(profile.disliked_ids()), profile.version)
+        cached = profile._bitmaps
+        if cached is None or cached[0] != key:
+            liked = row_bitmap(np.isin(recipe_ids, np.fromiter(profile.liked_ids(), dtype=np.int64)))
+            disliked = row_bitmap(np.isin(recipe_ids, np.fromiter(profile.disliked_ids(), dtype=np.int64)))
+            profile._bitmaps = cached = (key, liked, disliked)
+        return cached[1], cached[2]
+
+    def get_range_filters(self) -> Dict[str, RangeFilter]:
+        # range filters from the store, or parsed once from the duration and nutrition columns
+        if self.range_filters is None:
+            with self.state_lock:
+                if self.range_filters is None:
+                    if self.store is not None:
+                        self.range_filters = self.with_segments('range_filters', self.store.range_filters())
+                    else:
+                        self.range_filters = {column: RangeFilter.build(values) for column, values in range_columns(self.recipes_df).items()}
+        return self.range_filters
+
+    def get_text_index(self) -> TextIndex:
+        # tf-idf index from the store, or built once from the text columns
+        if self.text_index is None:
+            with self.state_lock:
+                if self.text_index is None:
+                    index = self.with_segments('text_index', self.store.text_index()) if self.store is not None else None
+                    self.text_index = index if index is not None else TextIndex.build(frame_documents(self.recipes_df))
+        return self.text_index
+
+    def text_similarity(self, text: str):
+        # cosine similarity of every recipe row to the words of the input beyond the meal keywords, None if there are none
+        terms = [term for term in text_terms(strip_range_phrases(text)) if term not in self.meal_keyword_terms]
+        if not terms:
+            return None
+        return self.get_text_index().similarity(text, terms)
+
+    def get_similarity_index(self) -> SimilarityIndex:
+        # nearest-neighbor index from the store, or built once from the recipe table
+        if self.similarity_index is None:
+            with self.state_lock:
+                if self.similarity_index is None:
+                    index = self.with_segments('similarity_index', self.store.similarity_index()) if self.store is not None else None
+                    self.similarity_index = index if index is not None else SimilarityIndex.build(self.recipes_df)
+        return self.similarity_index
+
+    def recipe_neighbors(self, row: int):
+        # approximate nearest rows of one recipe row, remembered for repeated use
+        neighbors = self.neighbor_cache.get(row)
+        if neighbors is None:
+            if len(self.neighbor_cache) >= NEIGHBOR_CACHE_SIZE:
+                self.neighbor_cache.clear()  # bound the memory held for old users' likes
+            neighbors = self.get_similarity_index().neighbors(row, NEIGHBORS_PER_SEED, probe=False)
+            self.neighbor_cache[row] = neighbors
+        return neighbors
+
+    def liked_neighbor_similarity(self, profile: UserProfile, rows: np.ndarray):
+        # for each recipe row, its highest similarity to a recently liked recipe, None without likes
+        pairs = self.liked_neighbor_pairs(profile)
+        return sparse_lookup(*pairs, rows) if pairs is not None else None
+
+    def liked_neighbor_pairs(self, profile: UserProfile):
+        # sorted neighbor rows of the recently liked recipes and each row's best similarity, None without likes
+        liked = [entry['recipe_id'] for entry in profile.preferences['liked_recipes'][-LIKED_SEEDS:]]
+        seeds = self.recipe_index.rows(liked)
+        seeds = seeds[seeds >= 0]
+        if not len(seeds):
+            return None
+        neighbor_rows, similarities = zip(*(self.recipe_neighbors(int(seed)) for seed in seeds))
+        neighbor_rows, similarities = np.concatenate(neighbor_rows), np.concatenate(similarities)
+        if not len(neighbor_rows):
+            return None
+        order = np.lexsort((-similarities, neighbor_rows))  # by row, best similarity first
+        neighbor_rows, similarities = neighbor_rows[order], similarities[order]
+        first = np.concatenate([[True], neighbor_rows[1:] != neighbor_rows[:-1]])  # keep each row's best
+        return neighbor_rows[first], np.clip(similarities[first], 0, 1)
+
+    def get_collaborative_model(self) -> CollaborativeModel:
+        # model saved next to the profiles by collaborative.py, None until one is built
+        if not self._collaborative_loaded:
+            with self.state_lock:  # service threads may ask at once, load it once
+                if not self._collaborative_loaded:
+                    self.collaborative_model = CollaborativeModel.load(self.user_manager.users_dir)
+                    self._collaborative_loaded = True
+        return self.collaborative_model
+
+    def collaborative_similarity(self, profile: UserProfile, rows: np.ndarray):
+        # for each recipe row, how strongly other users co-liked it with this user's likes, in [0, 1]
+        pairs = self.collaborative_pairs(profile)
+        return sparse_lookup(*pairs, self.recipe_ids[rows]) if pairs is not None else None
+
+    def collaborative_pairs(self, profile: UserProfile):
+        # sorted RecipeIds co-liked with the user's likes and their similarity scaled to [0, 1], None without any
+        model = self.get_collaborative_model()
+        if model is None or not profile.preferences['liked_recipes']:
+            return None
+        seeds = [recipe_key(entry['recipe_id']) for entry in profile.preferences['liked_recipes'][-COLLABORATIVE_SEEDS:]]
+        ids, similarity = model.related(np.array([k for k in seeds if k is not None], dtype=np.int64))
+        if not len(ids):
+            return None
+        return ids, similarity / similarity.max()
+
+    def save_collaborative_model(self):
+        # persist likes recorded since the model was loaded
+        model = self.collaborative_model
+        if model is not None and (model.pending or model.pending_likes):
+            model.save(self.user_manager.users_dir)
+
+    def boost_scores(self, profile: UserProfile, text: str, rows: np.ndarray, scores: np.ndarray) -> np.ndarray:
+        # raise the scores of recipes matching the input text and of recipes like the ones the user liked
+        with REGISTRY.timer('suggest_stage_seconds', stage='text'):
+            similarity = self.text_similarity(text)  # free-text words like "spicy thai noodles"
+            if similarity is not None:
+                scores = blend_similarity(scores, similarity[rows], self.text_weight)
+        with REGISTRY.timer('suggest_stage_seconds', stage='neighbors'):
+            similarity = self.liked_neighbor_similarity(profile, rows)  # "more like this" for liked recipes
+            if similarity is not None:
+                scores = blend_similarity(scores, similarity, NEIGHBOR_WEIGHT)
+        with REGISTRY.timer('suggest_stage_seconds', stage='collaborative'):
+            similarity = self.collaborative_similarity(profile, rows)  # "users who liked this also liked"
+            if similarity is not None:
+                scores = blend_similarity(scores, similarity, COLLABORATIVE_WEIGHT)
+        return scores
+
+    def analyze_constraints(self, text: str):
+        # ingredients and (column, low, high) ranges the user asked for,
+        # e.g. ['chicken'] and [('Calories', None, 600.0)] for "dinner with chicken under 600 calories"
+        terms, ranges = ingredient_terms(text), range_constraints(text)
+        if self.debug and (terms or ranges):  # if debug mode is enabled
+            print(f"Constraints in '{text}':", terms, ranges)  # print the parsed ingredients and ranges
+        return terms, ranges
+
+    def query_mask(self, partition, terms: List[str], ranges: List):
+        # partition mask of recipes meeting every constraint, None when there are none
+        mask = None
+        if ranges:
+            filters = self.get_range_filters()
+            for column, low, high in ranges:
+                if column in filters:
+                    rows = filters[column].mask(len(self.recipes_df), low, high)  # binary search over the sorted column
+                    mask = rows if mask is None else mask & rows
+            mask = mask[partition.rows] if mask is not None else None
+        if terms:
+            rows = self.get_ingredient_index().rows_with(terms)  # posting list intersection, None when no term is an ingredient
+            if rows is not None:
+                found = np.isin(partition.rows, rows, assume_unique=True)
+                mask = found if mask is None else mask & found
+        return mask
+
+    def input_tokens(self, text: str) -> List[str]:
+        # tokens matched against meal keywords: plain words, or spaCy lemmas in spacy mode
+        if self.nlp_mode == 'spacy':
+            return self.doc_tokens(get_nlp()(text.lower()))
+        return tokenize(text)
+
+    def doc_tokens(self, doc) -> List[str]:
+        # lemma tokens of a processed spaCy doc
+        return [tok for token in doc for tok in tokenize(token.lemma_ or token.text)]
+
+    @property
+    def meal_keywords(self) -> Dict[str, List[str]]:
+        return self._meal_keywords
+
+    @meal_keywords.setter
+    def meal_keywords(self, meal_keywords: Dict[str, List[str]]):
+        # replace the meal keywords, recompiling the matcher; meal types cached for the old keywords are dropped
+        self._meal_keywords = meal_keywords
+        self.compile_meal_keywords()
+
+    def compile_meal_keywords(self):
+        self.compiled_keywords = {meal_type: list(keywords) for meal_type, keywords in self._meal_keywords.items()}  # copy, so in-place edits are noticed
+        self.keyword_matcher = KeywordMatcher(self.compiled_keywords)  # compile the keywords into a phrase trie once
+        self.meal_keyword_terms = {term for keywords in self.compiled_keywords.values() for k in keywords for term in text_terms(k)}  # already used to pick the meal type
+
+    def classification_cache(self) -> ClassificationCache:
+        # the query cache, emptied first if the keywords, the matcher or the nlp mode changed since it was filled
+        if self._meal_keywords != self.compiled_keywords:  # meal_keywords was edited in place rather than assigned
+            self.compile_meal_keywords()
+        self.query_cache.bind((self.keyword_matcher, self.nlp_mode))
+        return self.query_cache
 
-   
     def analyze_user_input(self, text: str) -> str:
-        # determine the meal type based on user input
-        doc = nlp(text.lower())  # process the input text using spaCy for NLP
-        meal_scores = defaultdict(float)  # initialize a default dictionary to store scores for meal types
-        for token in doc:  # iterate through each token in the processed text
-            for meal_type, keywords in self.meal_keywords.items():  # check each meal type and its associated keywords
-                if token.text in keywords:  # if the token matches a keyword
-                    meal_scores[meal_type] += 1  # increment the score for that meal type
+        # determine the meal type based on user input, remembered for repeated inputs
+        cache = self.classification_cache()
+        key = normalize_query(text)
+        meal_type = cache.get(key)
+        if meal_type is None:
+            meal_type = self.classify_tokens(text, self.input_tokens(text))
+            cache.put(key, meal_type)
+        return meal_type
+
+    def analyze_user_inputs(self, texts: List[str]) -> List[str]:
+        # determine the meal type for many inputs in one pass, analyzing only the ones not cached
+        cache = self.classification_cache()
+        keys = [normalize_query(text) for text in texts]
+        meal_types = [cache.get(key) for key in keys]
+        missing = [i for i, meal_type in enumerate(meal_types) if meal_type is None]
+        if self.nlp_mode == 'spacy':  # let spaCy batch the documents
+            tokens = (self.doc_tokens(doc) for doc in get_nlp().pipe(texts[i].lower() for i in missing))
+        else:
+            tokens = (tokenize(texts[i]) for i in missing)
+        for i, input_tokens in zip(missing, tokens):
+            meal_types[i] = self.classify_tokens(texts[i], input_tokens)
+            cache.put(keys[i], meal_types[i])
+        return meal_types
+
+    def base_scores(self, meal_type: str, partition: MealTypePartition) -> np.ndarray:
+        # read-only base score vector of a partition, computed once per partition object, so partitions
+        # replaced by a reload or a segment swap never get another partition's vector
+        cached = self.base_score_cache.get(meal_type)
+        if cached is not None and cached[0] is partition:
+            self.base_score_hits += 1
+            return cached[1]
+        self.base_score_misses += 1
+        base = base_scores(partition)
+        self.base_score_cache[meal_type] = (partition, base)
+        return base
+
+    def cache_stats(self) -> Dict:
+        # hit rates of the query classification and base score caches
+        lookups = self.base_score_hits + self.base_score_misses
+        return {'query_classification': self.query_cache.stats(),
+                'base_scores': {'size': len(self.base_score_cache), 'hits': self.base_score_hits, 'misses': self.base_score_misses,
+                                'hit_rate': self.base_score_hits / lookups if lookups else 0.0}}
+
+    def classify_tokens(self, text: str, tokens: List[str]) -> str:
+        # pick the meal type with the most keyword matches among the input tokens
+        meal_scores = self.keyword_matcher.score_tokens(tokens)  # count keyword phrase matches per meal type
         if self.debug:  # if debug mode is enabled
             print(f"Meal type scores from user input '{text}':", meal_scores)  # print the scores for each meal type
         if any(meal_scores.values()):  # check if there are any non-zero scores
             return max(meal_scores.items(), key=lambda x: x[1])[0]  # return the meal type with the highest score
         return "dinner"  # default to 'dinner' if no keywords match
 
-    def get_recipe_suggestions(self, profile: UserProfile, text: str, num_suggestions: int = 3, include_liked_probability: float = 0.2) -> List[Dict]:
+    def get_recipe_suggestions(self, profile: UserProfile, text: str, num_suggestions: int = 3, include_liked_probability: float = 0.2, rng=None) -> List[Dict]:
         # generate recipe suggestions based on user input and profile preferences
-        meal_type = self.analyze_user_input(text)  # determine the meal type from user input
-        meal_recipes = self.recipes_df[self.recipes_df['meal_type'] == meal_type].copy()  # filter recipes by meal type
-
-        # exclude disliked recipes
-        disliked_recipe_ids = {r['recipe_id'] for r in profile.preferences['disliked_recipes']}  # get ids of disliked recipes
-        meal_recipes = meal_recipes[~meal_recipes['RecipeId'].astype(str).isin(disliked_recipe_ids)]  # filter out disliked recipes
-
-        # exclude liked recipes, but allow some to reappear based on the probability
-        liked_recipe_ids = {r['recipe_id'] for r in profile.preferences['liked_recipes']}  # get ids of liked recipes
-        meal_recipes['include_liked'] = meal_recipes['RecipeId'].astype(str).apply(  # decide whether to include liked recipes
-            lambda x: (x not in liked_recipe_ids) or (random.random() < include_liked_probability)  # include liked recipes probabilistically
-        )
-        meal_recipes = meal_recipes[meal_recipes['include_liked']]  # filter recipes to include liked recipes based on the probability
-
-        # scoring based on meal type preferences and ratings
-        meal_recipes['score'] = meal_recipes.apply(  # calculate the score for each recipe
-            lambda x: (
-                profile.recipe_ratings.get(str(x['RecipeId']), 0.5) *  # base score from recipe rating
-                (1 + profile.preferences['meal_type_preferences'].get(meal_type, 0))  # add weight based on meal type preferences
-            ),
-            axis=1
-        )
-        
-        # multiply by the recipe's aggregate rating if available
-        meal_recipes['score'] *= meal_recipes['AggregatedRating'].fillna(1)  # factor in aggregated rating
+        with REGISTRY.timer('suggest_seconds'):
+            cursor = self._suggestion_cursor(profile, text, include_liked_probability, rng)
+            return self._next_suggestions(profile, cursor, num_suggestions)
+
+    def suggestion_cursor(self, profile: UserProfile, text: str, include_liked_probability: float = 0.2, rng=None) -> SuggestionCursor:
+        # rank every candidate for the input once; pages are then read with next_suggestions
+        with REGISTRY.timer('suggest_seconds'):
+            return self._suggestion_cursor(profile, text, include_liked_probability, rng)
+
+    def next_suggestions(self, profile: UserProfile, cursor: SuggestionCursor, num_suggestions: int = 3) -> List[Dict]:
+        # the next page of a cursor, without filtering or scoring again
+        if not cursor.is_current(profile):
+            raise ValueError("Suggestion cursor is out of date, the profile changed since it was ranked")
+        with REGISTRY.timer('suggest_page_seconds'):
+            return self._next_suggestions(profile, cursor, num_suggestions)
+
+    def _suggestion_cursor(self, profile: UserProfile, text: str, include_liked_probability: float, rng):
+        REGISTRY.inc('suggest_requests')
+        with REGISTRY.timer('suggest_stage_seconds', stage='classify'):
+            meal_type = self.analyze_user_input(text)  # determine the meal type from user input
+        with REGISTRY.timer('suggest_stage_seconds', stage='filter'):
+            partition = self.partitions.get(meal_type)  # pre-partitioned arrays for this meal type, never copied
+            terms, ranges = self.analyze_constraints(text)  # ingredients, times and nutrition limits named in the input
+            allowed = self.query_mask(partition, terms, ranges) if partition is not None else None  # recipes meeting all of them
+
+        if partition is not None and self.shards and len(partition) >= self.shard_min_rows:  # large partitions are scored in parallel
+            cursor = self.sharded_cursor(profile, text, meal_type, partition, allowed, include_liked_probability, rng)
+            REGISTRY.inc('suggest_candidates_scored', len(cursor))
+            return cursor
 
+        # exclude disliked recipes and reintroduce liked ones by probability, then score the rest
+        if partition is not None:
+            with REGISTRY.timer('suggest_stage_seconds', stage='exclusion'):
+                liked_bits, disliked_bits = self.profile_bitmaps(profile)
+                liked, disliked = bitmap_mask(liked_bits, partition.rows), bitmap_mask(disliked_bits, partition.rows)
+                candidates = exclusion_candidates(partition, liked, disliked, include_liked_probability, rng, allowed)
+            with REGISTRY.timer('suggest_stage_seconds', stage='scoring'):
+                scores = score_candidates(partition, candidates, profile, meal_type, self.base_scores(meal_type, partition))
+            rows = partition.rows[candidates]  # row positions in the recipe table
+            scores = self.boost_scores(profile, text, rows, scores)
+        else:
+            rows, scores = np.zeros(0, dtype=np.int64), np.zeros(0)
+        REGISTRY.inc('suggest_candidates_scored', len(rows))
+        return SuggestionCursor(rows, scores, meal_type, profile.version)
+
+    def get_sharded_scorer(self) -> ShardedScorer:
+        # pool over shared-memory copies of the partitions, rebuilt when a reload or segment swap replaces them
+        with self.state_lock:
+            scorer = self.sharded_scorer
+            if scorer is None or scorer.partitions is not self.partitions:
+                if scorer is not None:
+                    scorer.close()  # cursors ranked on the old partitions finish on the calling core
+                partitions = self.partitions
+                bases = {meal_type: self.base_scores(meal_type, partition) for meal_type, partition in partitions.items()}
+                self.sharded_scorer = scorer = ShardedScorer(partitions, bases, len(self.recipe_ids), self.shards)
+        return scorer
+
+    def stop_sharding(self):
+        # stop the scoring workers and release their shared memory
+        with self.state_lock:
+            scorer, self.sharded_scorer = self.sharded_scorer, None
+        if scorer is not None:
+            scorer.close()
+
+    def sharded_cursor(self, profile: UserProfile, text: str, meal_type: str, partition: MealTypePartition, allowed,
+                       include_liked_probability: float, rng) -> ShardedCursor:
+        # the single-core ranking computed by the shards: exclusions, draws and boosts are settled here, the scan runs in the pool
+        with REGISTRY.timer('suggest_stage_seconds', stage='exclusion'):
+            disliked = np.unique(partition.locate(profile_recipe_ids(profile.disliked_ids()))[1])
+            liked = np.unique(partition.locate(profile_recipe_ids(profile.liked_ids()))[1])
+            liked = liked[~np.isin(liked, disliked)]
+            if allowed is not None:
+                liked = liked[allowed[liked]]
+            keep = draw_uniform(len(liked), rng) < include_liked_probability  # the draws exclusion_candidates makes, in the same order
+            rated_ids, rated_values = profile_rating_arrays(profile.recipe_ratings)
+            which, rated_positions = partition.locate(rated_ids)
+            query = {'meal_type': meal_type, 'weight': 1 + profile.meal_type_weight(meal_type), 'excluded': np.union1d(disliked, liked[~keep]),
+                     'rated_positions': rated_positions, 'rated_values': rated_values[which],
+                     'neighbors': self.liked_neighbor_pairs(profile), 'collaborative': self.collaborative_pairs(profile),
+                     'boost_weights': (self.text_weight, NEIGHBOR_WEIGHT, COLLABORATIVE_WEIGHT)}
+            similarity = self.text_similarity(text)
+        with REGISTRY.timer('suggest_stage_seconds', stage='sharded'):
+            return ShardedCursor(self.get_sharded_scorer(), partition, self.base_scores(meal_type, partition), query, profile.version, allowed, similarity)
+
+    def _next_suggestions(self, profile: UserProfile, cursor: SuggestionCursor, num_suggestions: int) -> List[Dict]:
         # update interaction metrics
         profile.total_suggestions_received += num_suggestions  # increment the total suggestions received
         profile.total_interactions += 1  # increment the total interactions
 
-        # sort and select top recipes based on score
-        suggestions = meal_recipes.nlargest(num_suggestions, 'score')  # get the top 'num_suggestions' recipes
+        # select top recipes based on score without sorting every candidate
+        with REGISTRY.timer('suggest_stage_seconds', stage='topk'):
+            rows, scores = cursor.next_page(num_suggestions)  # the next 'num_suggestions' best candidates
+        with REGISTRY.timer('suggest_stage_seconds', stage='hydrate'):
+            suggestions = self.get_recipe_records(rows)  # load full rows only for the recipes being shown
+        for suggestion, score in zip(suggestions, scores):
+            suggestion['score'] = float(score)  # keep the score alongside the recipe as before
+            suggestion['meal_type'] = cursor.meal_type  # the meal type it was suggested for, recipes can have several
 
         if self.debug:  # if debug mode is enabled
-            print(f"Meal type for suggestion: {meal_type}")  # print the determined meal type
+            print(f"Meal type for suggestion: {cursor.meal_type}")  # print the determined meal type
             print("Top scored recipes with optional liked reintroduction:")  # print debug message
-            print(meal_recipes[['Name', 'score']].head(num_suggestions))  # print the top scored recipes
+            for suggestion in suggestions:
+                print(f"  {suggestion['Name']}: {suggestion['score']}")  # print the top scored recipes
+
+        return suggestions  # return the top recipes as a list of dictionaries
 
-        return suggestions.to_dict('records')  # return the top recipes as a list of dictionaries
+    def get_recipe_suggestions_batch(self, profiles: List[UserProfile], texts: List[str], num_suggestions: int = 3, include_liked_probability: float = 0.2, rng=None) -> List[List[Dict]]:
+        # suggestions for many users at once, same results as calling get_recipe_suggestions for each in order
+        with REGISTRY.timer('suggest_batch_seconds'):
+            return self._get_recipe_suggestions_batch(profiles, texts, num_suggestions, include_liked_probability, rng)
+
+    def _get_recipe_suggestions_batch(self, profiles: List[UserProfile], texts: List[str], num_suggestions: int, include_liked_probability: float, rng) -> List[List[Dict]]:
+        REGISTRY.inc('suggest_requests', len(profiles))
+        meal_types = self.analyze_user_inputs(texts)  # classify every input in one pass
+
+        # group users by meal type so each group is scored as one users-by-recipes matrix
+        groups = defaultdict(list)
+        for i, meal_type in enumerate(meal_types):
+            if meal_type in self.partitions:
+                groups[meal_type].append(i)
+        constraints = [self.analyze_constraints(text) for text in texts]  # ingredient and range constraints per input
+        batches = {}
+        for meal_type, users in groups.items():
+            partition = self.partitions[meal_type]
+            allowed = [self.query_mask(partition, *constraints[i]) for i in users]
+            batches[meal_type] = ProfileBatch(partition, [profiles[i] for i in users], meal_type, allowed, self.base_scores(meal_type, partition))
+
+        # draw liked-recipe coin flips in input order, as sequential calls would
+        liked_counts = np.zeros(len(profiles), dtype=np.int64)
+        for meal_type, users in groups.items():
+            liked_counts[users] = batches[meal_type].liked_counts
+        draws = draw_uniform(int(liked_counts.sum()), rng)
+        offsets = np.concatenate([[0], np.cumsum(liked_counts)])
+
+        results = [[] for _ in profiles]
+        for meal_type, users in groups.items():
+            batch = batches[meal_type]
+            batch_draws = np.concatenate([draws[offsets[i]:offsets[i + 1]] for i in users])
+            for i, (candidates, scores) in zip(users, batch.score(batch_draws, include_liked_probability)):
+                scores = self.boost_scores(profiles[i], texts[i], batch.partition.rows[candidates], scores)
+                top = top_k_positions(scores, num_suggestions)
+                results[i] = self.get_recipe_records(batch.partition.rows[candidates[top]])
+                for suggestion, score in zip(results[i], scores[top]):
+                    suggestion['score'] = float(score)
+                    suggestion['meal_type'] = meal_type
+
+        # update interaction metrics
+        for profile in profiles:
+            profile.total_suggestions_received += num_suggestions  # increment the total suggestions received
+            profile.total_interactions += 1  # increment the total interactions
+        return results  # top recipes for every user, in input order
 
     def update_user_preference(self, profile: UserProfile, recipe_id: str, recipe_name: str, liked: bool):
         # update user preferences for a recipe, including meal type preference
+        recipe_id = str(recipe_id)  # profiles key recipes by string id
         if liked:
-            if not any(r['recipe_id'] == recipe_id for r in profile.preferences['liked_recipes']):
-                profile.preferences['liked_recipes'].append({"recipe_id": recipe_id, "recipe_name": recipe_name})
+            if profile.add_recipe('liked_recipes', recipe_id, recipe_name):  # set lookup instead of scanning the list
+                model = self.get_collaborative_model()
+                if model is not None:
+                    model.add_like(recipe_id, profile.liked_ids())  # co-likes update the model right away
 
             # Retrieve recipe details using RecipeId
-            recipe = self.recipes_df[self.recipes_df['RecipeId'].astype(str) == str(recipe_id)]
-            if not recipe.empty:
-                meal_type = recipe['meal_type'].iloc[0]  # Ensure meal_type exists
+            meal_type = self.get_recipe_field(recipe_id, 'meal_type')  # constant-time lookup through the RecipeId index
+            if meal_type is not None:
 
                 # Update meal type preference
                 profile.update_weight(meal_type)
-                print(f"Updated meal type preference for '{meal_type}' to {profile.preferences['meal_type_preferences'][meal_type]}")
+                print(f"Updated meal type preference for '{meal_type}' to {profile.meal_type_weight(meal_type)}")
             else:
                 print(f"Error: Recipe with ID '{recipe_id}' not found.")
         else:
-            if not any(r['recipe_id'] == recipe_id for r in profile.preferences['disliked_recipes']):
-                profile.preferences['disliked_recipes'].append({"recipe_id": recipe_id, "recipe_name": recipe_name})
+            profile.add_recipe('disliked_recipes', recipe_id, recipe_name)
 
         profile.recipe_ratings[recipe_id] += 1 if liked else 0
+        profile.version += 1
         self.user_manager.save_user_profile(profile)
 
         if self.debug:
             print(f"Updated preferences for user '{profile.user_id}': {'Liked' if liked else 'Disliked'} recipe '{recipe_id}' - {recipe_name}")
-            print(f"Updated meal_type_preferences: {profile.preferences['meal_type_preferences']}")
+            print(f"Updated meal_type_preferences: {profile.meal_type_weights()}")
 
 
+def format_duration(value) -> str:
+    # "1 h 35 min" for an iso-8601 duration like PT1H35M, 'N/A' when missing
+    minutes = int(duration_minutes(pd.Series([value]))[0])
+    if minutes < 0:
+        return 'N/A'
+    hours, minutes = divmod(minutes, 60)
+    return ' '.join(part for part in [f"{hours} h" if hours else '', f"{minutes} min" if minutes else ''] if part)
+
 def main():
             parser = argparse.ArgumentParser(description="Recipe Suggestion System")  # create an argument parser for the script
             parser.add_argument('--debug', action='store_true', help="Enable debug mode")  # add an optional debug mode argument
+            parser.add_argument('--profiles', choices=['json', 'sqlite'], default='json', help="Profile storage backend")  # where user profiles are kept
+            parser.add_argument('--nlp', choices=NLP_MODES, default='keyword', help="Input analysis mode (spacy needs en_core_web_sm)")  # optional spaCy lemma matching
+            parser.add_argument('--metrics', action='store_true', help="Collect stage timings; printed at exit, served at /metrics with --serve")  # instrumentation
+            parser.add_argument('--serve', action='store_true', help="Run the HTTP service instead of the interactive prompt")  # service mode
+            parser.add_argument('--host', default='127.0.0.1', help="Address the HTTP service binds to")
+            parser.add_argument('--port', type=int, default=8080, help="Port the HTTP service listens on")
+            parser.add_argument('--segment-interval', type=float, default=30.0, help="Seconds between checks for ingested recipes with --serve (0 disables)")
+            parser.add_argument('--shards', type=int, default=0, help="Score large meal types in this many worker processes (0 uses one core)")
+            parser.add_argument('--decay-profiles', action='store_true', help="Apply pending weight decay to every stored profile and exit")  # offline maintenance
+            parser.add_argument('--workers', type=int, default=None, help="Worker processes for --decay-profiles (default: one per CPU)")
             args = parser.parse_args()  # parse the command-line arguments
+            REGISTRY.enabled = args.metrics  # instrumentation costs nothing unless enabled
+
+            if args.decay_profiles:  # sweep stored profiles without loading any recipes
+                user_manager = UserManager(backend=args.profiles)
+                report = user_manager.decay_all_profiles(workers=args.workers)
+                user_manager.close()
+                print(f"Decayed {report['rewritten']} of {report['profiles']} profiles in {report['seconds']:.2f}s "
+                      f"({report['profiles_per_second']:.0f} profiles/s)")
+                return
+
+            if args.serve:  # many concurrent users share one suggester and a cached profile store
+                from server import serve
+                user_manager = UserManager(backend=args.profiles, cache_size=1024, flush_interval=5.0)
+                serve(RecipeSuggester('dataset/min', debug=args.debug, nlp_mode=args.nlp, user_manager=user_manager, use_snapshot=True, shards=args.shards), args.host, args.port,
+                      segment_interval=args.segment_interval)
+                return
 
-            suggester = RecipeSuggester('dataset/min', debug=args.debug)  # initialize the RecipeSuggester with the dataset directory and debug mode
+            suggester = RecipeSuggester('dataset/min', debug=args.debug, nlp_mode=args.nlp, user_manager=UserManager(backend=args.profiles), use_snapshot=True, shards=args.shards)  # initialize the RecipeSuggester with the dataset directory and debug mode
             username = input("Please enter your username: ").strip()  # prompt the user to enter their username
             profile = suggester.user_manager.load_user_profile(username)  # load the user's profile based on their username
 
@@ -255,71 +1064,82 @@ def main():
                     print(f"Total suggestions received: {profile.total_suggestions_received}")  # display total suggestions received
                     print(f"Total interactions: {profile.total_interactions}")  # display total interactions
                     print(f"Liked recipes: {len(profile.preferences['liked_recipes'])}")  # display count of liked recipes
-                    print(f"Meal type preferences: {dict(profile.preferences['meal_type_preferences'])}")  # display meal type preferences
+                    print(f"Meal type preferences: {profile.meal_type_weights()}")  # display meal type preferences
                     continue  # skip to the next iteration of the loop
 
-                # get recipe suggestions based on the user input
-                suggestions = suggester.get_recipe_suggestions(profile, command)  # fetch suggestions based on the command
+                # rank the matches once, 'more' then pages through the same ranking
+                cursor = suggester.suggestion_cursor(profile, command)  # filter and score based on the command
+                suggestions = suggester.next_suggestions(profile, cursor)  # first page of suggestions
 
                 if not suggestions:  # if no suggestions are found
                     print("No matching recipes found.")  # inform the user
                     continue  # skip to the next iteration of the loop
 
-                for i, recipe in enumerate(suggestions, 1):  # iterate over the suggested recipes
-                    print(f"\n{i}. {recipe['Name']}")  # display the recipe name with its index
-                    print(f"   Preparation Time: {recipe.get('PrepTime', 'N/A')}")  # display the preparation time or 'N/A' if not available
-                    if pd.notna(recipe.get('AggregatedRating')):  # if the aggregated rating exists
-                        print(f"   Rating: {recipe['AggregatedRating']:.1f}/5.0")  # display the rating
-                    if pd.notna(recipe.get('ReviewCount')):  # if the review count exists
-                        print(f"   Number of Reviews: {recipe['ReviewCount']}")  # display the number of reviews
-
-                while True:  # enter a loop to handle user feedback
-                    feedback = input("\nDid you like any of these recipes? (Enter recipe number, 'n' for none, or 'more' for more options): ").strip().lower()  # prompt for feedback
-                    if feedback.isdigit() and 1 <= int(feedback) <= len(suggestions):  # if feedback is a valid recipe number
-                        recipe = suggestions[int(feedback) - 1]  # get the selected recipe
-
-                        # Display recipe instructions immediately after selection
-                        recipe_id = recipe['RecipeId']
-                        recipe_name = recipe['Name']
-                        instructions = suggester.recipes_df[suggester.recipes_df['RecipeId'].astype(str) == str(recipe_id)]['RecipeInstructions'].iloc[0]
-
-                        print(f"\nRecipe Instructions for '{recipe_name}':")
-                        print(instructions if instructions else "No instructions available.")  # Print the instructions or fallback message
-
-                        # ask if the user liked or disliked the selected recipe
-                        like_dislike = input(f"\nDid you like {recipe_name}? (yes or no): ").strip().lower()  # ask for a like/dislike response
-                        liked = like_dislike == 'yes'  # determine if the response is 'yes'
-
-                        # update the user's preference based on their feedback
-                        suggester.update_user_preference(profile, recipe_id, recipe_name, liked=liked)  # update preferences
-
-                        # thank the user for their feedback
-                        if liked:  # if the user liked the recipe
-                            print(f"Great! {recipe_name} has been added to your liked recipes.")  # confirm addition to liked recipes
-                        else:  # if the user disliked the recipe
-                            print(f"{recipe_name} has been marked as disliked.")  # confirm marking as disliked
-                        break  # exit the feedback loop
-
-                    elif feedback == 'n':  # if the user indicates they liked none of the recipes
-                        print("Got it. Let's find more options for you.")  # acknowledge and move on
-                        break  # exit the feedback loop
-                    elif feedback == 'more':  # if the user requests more suggestions
-                        print("Fetching more options...")  # indicate that more suggestions are being fetched
-                        break  # exit the feedback loop
-                    else:  # if the input is invalid
-                        print("Please enter a valid option.")  # prompt the user to try again
-
-
-                # if user requests more, continue with new suggestions in the next loop iteration
-                if feedback == 'more':  # if the user asked for more options
-                    continue  # skip to the next iteration
-                elif feedback == 'n':  # if the user liked none of the suggestions
+                while True:  # show pages until the user picks a recipe, declines, or runs out of matches
+                    for i, recipe in enumerate(suggestions, 1):  # iterate over the suggested recipes
+                        print(f"\n{i}. {recipe['Name']}")  # display the recipe name with its index
+                        print(f"   Preparation Time: {format_duration(recipe.get('PrepTime'))}")  # display the preparation time or 'N/A' if not available
+                        print(f"   Total Time: {format_duration(recipe.get('TotalTime'))}")  # display the total time or 'N/A' if not available
+                        if pd.notna(recipe.get('AggregatedRating')):  # if the aggregated rating exists
+                            print(f"   Rating: {recipe['AggregatedRating']:.1f}/5.0")  # display the rating
+                        if pd.notna(recipe.get('ReviewCount')):  # if the review count exists
+                            print(f"   Number of Reviews: {recipe['ReviewCount']}")  # display the number of reviews
+
+                    while True:  # enter a loop to handle user feedback
+                        feedback = input("\nDid you like any of these recipes? (Enter recipe number, 'n' for none, or 'more' for more options): ").strip().lower()  # prompt for feedback
+                        if feedback.isdigit() and 1 <= int(feedback) <= len(suggestions):  # if feedback is a valid recipe number
+                            recipe = suggestions[int(feedback) - 1]  # get the selected recipe
+
+                            # Display recipe instructions immediately after selection
+                            recipe_id = recipe['RecipeId']
+                            recipe_name = recipe['Name']
+                            instructions = suggester.get_recipe_instructions(recipe_id)  # fetch the instructions text on demand
+
+                            print(f"\nRecipe Instructions for '{recipe_name}':")
+                            print(instructions if isinstance(instructions, str) and instructions else "No instructions available.")  # Print the instructions or fallback message
+
+                            # ask if the user liked or disliked the selected recipe
+                            like_dislike = input(f"\nDid you like {recipe_name}? (yes or no): ").strip().lower()  # ask for a like/dislike response
+                            liked = like_dislike == 'yes'  # determine if the response is 'yes'
+
+                            # update the user's preference based on their feedback
+                            suggester.update_user_preference(profile, recipe_id, recipe_name, liked=liked)  # update preferences
+
+                            # thank the user for their feedback
+                            if liked:  # if the user liked the recipe
+                                print(f"Great! {recipe_name} has been added to your liked recipes.")  # confirm addition to liked recipes
+                            else:  # if the user disliked the recipe
+                                print(f"{recipe_name} has been marked as disliked.")  # confirm marking as disliked
+                            break  # exit the feedback loop
+
+                        elif feedback == 'n':  # if the user indicates they liked none of the recipes
+                            print("Got it. Let's find more options for you.")  # acknowledge and move on
+                            break  # exit the feedback loop
+                        elif feedback == 'more':  # if the user requests more suggestions
+                            print("Fetching more options...")  # indicate that more suggestions are being fetched
+                            break  # exit the feedback loop
+                        else:  # if the input is invalid
+                            print("Please enter a valid option.")  # prompt the user to try again
+
+                    if feedback != 'more':
+                        break
+                    suggestions = suggester.next_suggestions(profile, cursor)  # next page from the cursor, nothing is re-scored
+                    if not suggestions:
+                        print("No more matching recipes.")  # the ranking is exhausted
+                        break
+
+                if feedback == 'n':  # if the user liked none of the suggestions
                     print("No more suggestions available at this time.")  # inform the user
                     break  # exit the loop
 
             # save the user's profile before exiting the program
             suggester.user_manager.save_user_profile(profile)  # persist the updated profile
+            suggester.user_manager.close()  # commit any batched writes
+            suggester.save_collaborative_model()  # keep the likes of this session in the collaborative model
+            suggester.stop_sharding()  # stop the scoring workers
             print(f"\nGoodbye {username}! Your profile has been saved.")  # print a farewell message
+            if args.metrics:  # dump the collected timings
+                print(REGISTRY.to_prometheus())
 
 if __name__ == "__main__":
     main()  # execute the main function
@@ -0,0 +1,370 @@
+import os
+import json
+import sqlite3
+import argparse  # arg parsing
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional  # for type hinting
+
+# storage backends for user profiles
+#
+# both backends take and return the dictionaries produced by UserProfile.to_dict:
+#   json    one users/<name>.json file per user, rewritten atomically on save
+#   sqlite  one local database in WAL mode; likes, dislikes, ratings and weights are
+#           rows, a save writes only what changed since the last save, and saves are
+#           grouped into batched transactions
+
+
+class JSONProfileBackend:
+    def __init__(self, users_dir: str):
+        self.users_dir = users_dir  # directory of <name>.json files
+        os.makedirs(users_dir, exist_ok=True)
+
+    def path(self, username: str) -> str:
+        path = os.path.join(self.users_dir, f"{username.lower()}.json")  # path to the user's profile file
+        if os.path.dirname(os.path.abspath(path)) != os.path.abspath(self.users_dir):  # a name such as ../x would leave users_dir
+            raise ValueError(f"Invalid username: {username!r}")
+        return path
+
+    def load(self, username: str) -> Optional[Dict]:
+        return read_profile(self.path(username))
+
+    def save(self, data: Dict):
+        # write to a temporary file and rename it over the profile so a crash never leaves a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.users_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, indent=2)
+            os.replace(tmp_path, self.path(data['user_id']))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def list_users(self) -> List[str]:
+        # names of the profile files, other json files in the directory are skipped
+        return sorted(f[:-len('.json')] for f in os.listdir(self.users_dir)
+                      if f.endswith('.json') and read_profile(os.path.join(self.users_dir, f)) is not None)
+
+    def flush(self):
+        pass  # every save is already on disk
+
+    def close(self):
+        pass
+
+
+def read_profile(path: str) -> Optional[Dict]:
+    # a stored profile dictionary, None when the file is missing or holds something else
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    return data if isinstance(data, dict) and 'user_id' in data and 'preferences' in data else None
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_key TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    last_login TEXT,
+    total_suggestions_received INTEGER NOT NULL DEFAULT 0,
+    total_interactions INTEGER NOT NULL DEFAULT 0,
+    last_decay_date TEXT,
+    dietary_restrictions TEXT NOT NULL DEFAULT '[]',
+    favorite_cuisines TEXT NOT NULL DEFAULT '[]'
+);
+CREATE TABLE IF NOT EXISTS recipe_feedback (
+    user_key TEXT NOT NULL,
+    liked INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    recipe_id TEXT NOT NULL,
+    recipe_name TEXT,
+    PRIMARY KEY (user_key, liked, position)
+);
+CREATE TABLE IF NOT EXISTS recipe_ratings (
+    user_key TEXT NOT NULL,
+    recipe_id TEXT NOT NULL,
+    rating REAL NOT NULL,
+    PRIMARY KEY (user_key, recipe_id)
+);
+CREATE TABLE IF NOT EXISTS meal_type_weights (
+    user_key TEXT NOT NULL,
+    meal_type TEXT NOT NULL,
+    weight REAL NOT NULL,
+    PRIMARY KEY (user_key, meal_type)
+);
+"""
+
+SAVED_STATES = 1024  # default number of users whose last written state is kept for deltas
+SCALAR_FIELDS = ['user_id', 'last_login', 'total_suggestions_received', 'total_interactions', 'last_decay_date']  # columns of the users row
+
+
+class SQLiteProfileBackend:
+    def __init__(self, db_path: str, batch_size: int = 32, saved_size: int = SAVED_STATES):
+        self.db_path = db_path  # sqlite database file
+        self.batch_size = batch_size  # saves grouped into one transaction
+        self.saved_size = max(saved_size, 1)  # users whose last written state is kept, the rest are read back before a save
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)  # transactions are managed explicitly
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')  # WAL keeps committed batches consistent without an fsync per commit
+        self.conn.executescript(SCHEMA)
+        self.lock = threading.Lock()  # one connection shared by all threads
+        self.pending = 0  # saves in the open transaction
+        self.saved = OrderedDict()  # user key -> last state written, used to compute deltas, least recently used first
+
+    def load(self, username: str) -> Optional[Dict]:
+        with self.lock:
+            return self._load(username.lower())
+
+    def _load(self, key: str) -> Optional[Dict]:
+        row = self.conn.execute(
+            'SELECT user_id, last_login, total_suggestions_received, total_interactions, last_decay_date, '
+            'dietary_restrictions, favorite_cuisines FROM users WHERE user_key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        feedback = {True: [], False: []}
+        for liked, recipe_id, recipe_name in self.conn.execute(
+                'SELECT liked, recipe_id, recipe_name FROM recipe_feedback WHERE user_key = ? ORDER BY liked, position', (key,)):
+            feedback[bool(liked)].append({'recipe_id': recipe_id, 'recipe_name': recipe_name})
+        ratings = dict(self.conn.execute('SELECT recipe_id, rating FROM recipe_ratings WHERE user_key = ?', (key,)).fetchall())
+        weights = dict(self.conn.execute('SELECT meal_type, weight FROM meal_type_weights WHERE user_key = ?', (key,)).fetchall())
+        data = {
+            'user_id': row[0],
+            'preferences': {
+                'liked_recipes': feedback[True],
+                'disliked_recipes': feedback[False],
+                'dietary_restrictions': json.loads(row[5]),
+                'favorite_cuisines': json.loads(row[6]),
+                'meal_type_preferences': weights,
+            },
+            'recipe_ratings': ratings,
+            'last_login': row[1],
+            'total_suggestions_received': row[2],
+            'total_interactions': row[3],
+            'last_decay_date': row[4],
+        }
+        self.remember(key, snapshot(data))
+        return data
+
+    def save(self, data: Dict):
+        key = data['user_id'].lower()
+        new = snapshot(data)
+        with self.lock:
+            old = self.saved.get(key)
+            if old is None:  # not loaded or saved recently, compare against what is stored
+                stored = self._load(key)
+                old = snapshot(stored) if stored is not None else None
+            if self.pending == 0:
+                self.conn.execute('BEGIN')
+            self.conn.execute('SAVEPOINT profile_save')  # a failed save is undone without losing the rest of the batch
+            try:
+                self._write_delta(key, old, new)
+            except BaseException:
+                self.conn.execute('ROLLBACK TO profile_save')
+                self.conn.execute('RELEASE profile_save')
+                raise
+            self.conn.execute('RELEASE profile_save')
+            self.remember(key, new)
+            self.pending += 1
+            if self.pending >= self.batch_size:
+                self._commit()
+
+    def remember(self, key: str, state: Dict):
+        # keep the last written state of a user, dropping the least recently used beyond saved_size
+        self.saved[key] = state
+        self.saved.move_to_end(key)
+        while len(self.saved) > self.saved_size:
+            self.saved.popitem(last=False)
+
+    def _write_delta(self, key: str, old: Optional[Dict], new: Dict):
+        # write only the parts of the profile that differ from the last saved state
+        if old is None:  # new user, insert the whole row
+            fields = list(new['scalars'])
+            self.conn.execute(f"INSERT INTO users (user_key, {', '.join(fields)}) VALUES ({', '.join('?' * (len(fields) + 1))})",
+                              [key] + [new['scalars'][field] for field in fields])
+            old = dict(snapshot(None), scalars=new['scalars'])
+        changed = [field for field in new['scalars'] if new['scalars'][field] != old['scalars'].get(field)]
+        if changed:
+            self.conn.execute(f"UPDATE users SET {', '.join(f'{field} = ?' for field in changed)} WHERE user_key = ?",
+                              [new['scalars'][field] for field in changed] + [key])
+
+        for liked, field in [(1, 'liked_recipes'), (0, 'disliked_recipes')]:
+            old_list, new_list = old[field], new[field]
+            if new_list[:len(old_list)] != old_list:  # not a pure append, rewrite this list
+                self.conn.execute('DELETE FROM recipe_feedback WHERE user_key = ? AND liked = ?', (key, liked))
+                old_list = []
+            self.conn.executemany('INSERT INTO recipe_feedback VALUES (?, ?, ?, ?, ?)',
+                                  [(key, liked, i, recipe_id, name) for i, (recipe_id, name) in enumerate(new_list) if i >= len(old_list)])
+
+        for table, column, field in [('recipe_ratings', 'recipe_id', 'recipe_ratings'), ('meal_type_weights', 'meal_type', 'meal_type_preferences')]:
+            old_map, new_map = old[field], new[field]
+            self.conn.executemany(f"INSERT OR REPLACE INTO {table} VALUES (?, ?, ?)",
+                                  [(key, name, value) for name, value in new_map.items() if old_map.get(name) != value])
+            self.conn.executemany(f"DELETE FROM {table} WHERE user_key = ? AND {column} = ?",
+                                  [(key, name) for name in old_map if name not in new_map])
+
+    def _commit(self):
+        if self.pending:
+            self.conn.execute('COMMIT')
+            self.pending = 0
+
+    def list_users(self) -> List[str]:
+        with self.lock:
+            return [row[0] for row in self.conn.execute('SELECT user_key FROM users ORDER BY user_key')]
+
+    def flush(self):
+        # commit the open batch of saves
+        with self.lock:
+            self._commit()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+def snapshot(data: Optional[Dict]) -> Dict:
+    # comparable copy of a profile dictionary, split the way the tables store it
+    if data is None:
+        return {'scalars': {}, 'liked_recipes': [], 'disliked_recipes': [], 'recipe_ratings': {}, 'meal_type_preferences': {}}
+    preferences = data['preferences']
+    scalars = {field: data.get(field) for field in SCALAR_FIELDS}
+    scalars['dietary_restrictions'] = json.dumps(sorted(preferences['dietary_restrictions']))
+    scalars['favorite_cuisines'] = json.dumps(sorted(preferences['favorite_cuisines']))
+    return {
+        'scalars': scalars,
+        'liked_recipes': [(str(r['recipe_id']), r.get('recipe_name')) for r in preferences['liked_recipes']],
+        'disliked_recipes': [(str(r['recipe_id']), r.get('recipe_name')) for r in preferences['disliked_recipes']],
+        'recipe_ratings': {str(k): float(v) for k, v in data['recipe_ratings'].items()},
+        'meal_type_preferences': {str(k): float(v) for k, v in preferences['meal_type_preferences'].items()},
+    }
+
+
+class ProfileCache:
+    # bounded lru cache of live profile objects with a dirty flag per entry
+
+    def __init__(self, capacity: int, write: Callable):
+        self.capacity = capacity  # maximum number of cached profiles
+        self.write = write  # called with a dirty profile when it is evicted
+        self.entries = OrderedDict()  # key -> [profile, dirty], least recently used first
+        self.writing = {}  # key -> [profile, writes in progress]; served from here until stored, so no reload sees the old file
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.writing.get(key)  # evicted or flushed, and its write has not finished
+                if entry is None:
+                    self.misses += 1
+                    return None
+            else:
+                self.entries.move_to_end(key)  # mark as most recently used
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: str, profile, dirty: bool = False):
+        evicted = []
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry[0] = profile
+                entry[1] = entry[1] or dirty
+                self.entries.move_to_end(key)
+            else:
+                self.entries[key] = [profile, dirty]
+            while len(self.entries) > self.capacity:
+                old_key, (old_profile, old_dirty) = self.entries.popitem(last=False)
+                self.evictions += 1
+                if old_dirty:
+                    self._start_write(old_key, old_profile)
+                    evicted.append((old_key, old_profile))
+        for old_key, old_profile in evicted:  # write outside the lock so lookups are not blocked on disk
+            try:
+                self.write(old_profile)
+            finally:
+                self.written(old_key, old_profile)
+
+    def take_dirty(self) -> List:
+        # profiles modified since they were last written, clearing their dirty flags
+        # each stays readable through get until the caller reports it with written()
+        with self.lock:
+            dirty = []
+            for key, entry in self.entries.items():
+                if entry[1]:
+                    entry[1] = False
+                    self._start_write(key, entry[0])
+                    dirty.append(entry[0])
+        return dirty
+
+    def _start_write(self, key: str, profile):
+        entry = self.writing.get(key)
+        if entry is not None and entry[0] is profile:
+            entry[1] += 1
+        else:
+            self.writing[key] = [profile, 1]
+
+    def written(self, key: str, profile):
+        # a write started by put or take_dirty finished
+        with self.lock:
+            entry = self.writing.get(key)
+            if entry is not None and entry[0] is profile:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.writing[key]
+
+    def stats(self) -> Dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'capacity': self.capacity,
+                'dirty': sum(1 for entry in self.entries.values() if entry[1]),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+def make_backend(backend: str, users_dir: str, batch_size: int = 32, saved_size: int = SAVED_STATES):
+    # construct a backend by name
+    if backend == 'json':
+        return JSONProfileBackend(users_dir)
+    if backend == 'sqlite':
+        return SQLiteProfileBackend(os.path.join(users_dir, 'profiles.db'), batch_size=batch_size, saved_size=saved_size)
+    raise ValueError(f"Unknown profile backend: {backend}")
+
+
+def migrate_json_to_sqlite(users_dir: str, db_path: str, batch_size: int = 256) -> int:
+    # import every users/<name>.json profile into the sqlite backend
+    source = JSONProfileBackend(users_dir)
+    target = SQLiteProfileBackend(db_path, batch_size=batch_size)
+    count = 0
+    for username in source.list_users():
+        target.save(source.load(username))
+        count += 1
+    target.close()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="User profile storage tools")  # create an argument parser for the script
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    migrate = subparsers.add_parser('migrate', help="Import JSON profiles into the SQLite backend")
+    migrate.add_argument('--users-dir', default='users', help="Directory of <name>.json profiles")
+    migrate.add_argument('--db', default=None, help="SQLite database (defaults to <users-dir>/profiles.db)")
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        db_path = args.db or os.path.join(args.users_dir, 'profiles.db')
+        count = migrate_json_to_sqlite(args.users_dir, db_path)
+        print(f"Migrated {count} profiles into {db_path}")
+
+
+if __name__ == "__main__":
+    main()
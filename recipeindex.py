@@ -0,0 +1,232 @@
+import os
+import re
+import json
+from typing import Dict, Iterable, List, Optional  # for type hinting
+
+import numpy as np
+import pandas as pd
+
+# lookup indexes built once over the loaded recipe table
+
+R_STRING = re.compile(r'"((?:[^"\\]|\\.)*)"')  # one quoted element of an R character vector literal
+WORD = re.compile(r"[a-z0-9]+")  # ingredient words; punctuation separates them
+ISO_DURATION = r'^P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+(?:\.\d+)?)S)?)?$'  # PT1H35M, P1DT2H, PT0S
+DURATION_COLUMNS = ['PrepTime', 'CookTime', 'TotalTime']  # iso-8601 durations, filtered in minutes
+NUTRITION_COLUMNS = ['Calories', 'FatContent', 'SaturatedFatContent', 'CholesterolContent', 'SodiumContent',
+                     'CarbohydrateContent', 'FiberContent', 'SugarContent', 'ProteinContent']  # filtered as float32
+MISSING_MINUTES = -1  # duration that is absent, unparsable or zero (Food.com writes PT0S when no time was given)
+
+
+def recipe_key(recipe_id) -> Optional[int]:
+    # normalize a recipe id (str, int or numpy int) to the int64 index key
+    try:
+        return int(recipe_id)
+    except (TypeError, ValueError):
+        return None
+
+
+class RecipeIdIndex:
+    def __init__(self, recipe_ids: np.ndarray = None):
+        ids = np.asarray(recipe_ids if recipe_ids is not None else [], dtype=np.int64)  # int64 keys regardless of the source dtype
+        self.sorted_ids, first_rows = np.unique(ids, return_index=True)  # sorted keys and the first row holding each
+        self.sorted_rows = first_rows.astype(np.int64)  # row positions aligned with sorted_ids
+        self._positions = None  # key -> row position, built on the first single-id lookup
+
+    @classmethod
+    def from_sorted(cls, sorted_ids: np.ndarray, sorted_rows: np.ndarray) -> 'RecipeIdIndex':
+        # index over arrays built earlier, e.g. mapped from a snapshot
+        index = cls()
+        index.sorted_ids, index.sorted_rows = sorted_ids, sorted_rows
+        return index
+
+    def extend(self, recipe_ids: np.ndarray, start: int) -> 'RecipeIdIndex':
+        # new index with rows start, start + 1, ... added; ids already indexed keep their first row
+        added = RecipeIdIndex(recipe_ids)
+        new = ~np.isin(added.sorted_ids, self.sorted_ids, assume_unique=True)
+        slots = np.searchsorted(self.sorted_ids, added.sorted_ids[new])
+        return RecipeIdIndex.from_sorted(np.insert(self.sorted_ids, slots, added.sorted_ids[new]),
+                                         np.insert(self.sorted_rows, slots, added.sorted_rows[new] + start))
+
+    @property
+    def positions(self) -> Dict[int, int]:
+        if self._positions is None:
+            self._positions = dict(zip(self.sorted_ids.tolist(), self.sorted_rows.tolist()))
+        return self._positions
+
+    def __len__(self) -> int:
+        return len(self.sorted_ids)
+
+    def __contains__(self, recipe_id) -> bool:
+        return recipe_key(recipe_id) in self.positions
+
+    def row(self, recipe_id) -> Optional[int]:
+        # row position of a single recipe, None if it is not in the table
+        return self.positions.get(recipe_key(recipe_id))
+
+    def rows(self, recipe_ids: Iterable) -> np.ndarray:
+        # bulk lookup through the sorted array, -1 marks ids that are not in the table
+        keys = [recipe_key(recipe_id) for recipe_id in recipe_ids]
+        valid = np.array([k is not None for k in keys], dtype=bool)  # ids that parse as integers
+        keys = np.array([k if k is not None else 0 for k in keys], dtype=np.int64)
+        if len(self.sorted_ids) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        idx = np.searchsorted(self.sorted_ids, keys).clip(max=len(self.sorted_ids) - 1)  # candidate slot for every key
+        found = valid & (self.sorted_ids[idx] == keys)  # slot actually holds the key
+        return np.where(found, self.sorted_rows[idx], -1)
+
+
+def parse_r_vector(text) -> List[str]:
+    # elements of an R literal like c("chicken", "rice"), "rice" or character(0)
+    if not isinstance(text, str):
+        return []
+    return [value.replace('\\"', '"') for value in R_STRING.findall(text)]
+
+
+def stem(word: str) -> str:
+    # light plural stemming so "tomatoes" finds "tomato" and "berries" finds "berry"
+    if len(word) > 4 and word.endswith('ies'):
+        return word[:-3] + 'y'
+    if len(word) > 4 and word.endswith(('oes', 'ches', 'shes', 'xes', 'sses')):
+        return word[:-2]
+    if len(word) > 3 and word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+        return word[:-1]
+    return word
+
+
+def ingredient_words(name: str) -> List[str]:
+    # normalized words of one ingredient name or query term
+    return [stem(word) for word in WORD.findall(name.lower())]
+
+
+class IngredientIndex:
+    # inverted index from normalized ingredient word to the sorted rows whose ingredients contain it,
+    # stored as one concatenated postings array with per-word offsets
+
+    def __init__(self, words: List[str], offsets: np.ndarray, postings: np.ndarray):
+        self.words = {word: i for i, word in enumerate(words)}  # word -> slot in offsets
+        self.offsets = offsets  # int64, len(words) + 1 entries
+        self.postings = postings  # int64 row positions, sorted within each word
+
+    @classmethod
+    def build(cls, ingredient_parts: Iterable) -> 'IngredientIndex':
+        # parse every row's ingredient vector once and invert it
+        rows_by_word = {}
+        for row, text in enumerate(ingredient_parts):
+            for word in {w for name in parse_r_vector(text) for w in ingredient_words(name)}:
+                rows_by_word.setdefault(word, []).append(row)  # rows arrive in order, so every list is sorted
+        words = sorted(rows_by_word)
+        offsets = np.zeros(len(words) + 1, dtype=np.int64)
+        np.cumsum([len(rows_by_word[w]) for w in words], out=offsets[1:])
+        postings = np.fromiter((row for w in words for row in rows_by_word[w]), dtype=np.int64, count=int(offsets[-1]))
+        return cls(words, offsets, postings)
+
+    def extend(self, ingredient_parts: Iterable, start: int) -> 'IngredientIndex':
+        # new index with rows start, start + 1, ... appended; old postings are merged, not re-parsed
+        added = IngredientIndex.build(ingredient_parts)
+        words = sorted(set(self.words) | set(added.words))
+        slots = {word: i for i, word in enumerate(words)}
+        old_slots = np.array([slots[w] for w in sorted(self.words, key=self.words.get)], dtype=np.int64)
+        new_slots = np.array([slots[w] for w in sorted(added.words, key=added.words.get)], dtype=np.int64)
+        word_of = np.concatenate([np.repeat(old_slots, np.diff(self.offsets)), np.repeat(new_slots, np.diff(added.offsets))])
+        postings = np.concatenate([self.postings, added.postings + start])
+        order = np.argsort(word_of, kind='stable')  # old rows first within a word, added rows are all larger
+        offsets = np.zeros(len(words) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(word_of, minlength=len(words)), out=offsets[1:])
+        return IngredientIndex(words, offsets, postings[order])
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    def rows_for_word(self, word: str) -> np.ndarray:
+        # posting list of one normalized word
+        slot = self.words.get(word)
+        if slot is None:
+            return np.zeros(0, dtype=np.int64)
+        return self.postings[self.offsets[slot]:self.offsets[slot + 1]]
+
+    def rows_with(self, ingredients: List[str]) -> Optional[np.ndarray]:
+        # sorted rows containing every ingredient, a multi-word ingredient needs all of its words
+        # words no recipe uses ("with a kick") are not ingredients and are ignored; None when no word is known
+        lists = [self.rows_for_word(word) for name in ingredients for word in ingredient_words(name) if word in self.words]
+        if not lists:
+            return None
+        lists.sort(key=len)  # intersect from the rarest word up
+        rows = lists[0]
+        for postings in lists[1:]:
+            if not len(rows):
+                break
+            rows = np.intersect1d(rows, postings, assume_unique=True)
+        return np.asarray(rows, dtype=np.int64)
+
+    def save(self, directory: str):
+        with open(os.path.join(directory, 'ingredients.words.json'), 'w') as f:
+            json.dump(sorted(self.words, key=self.words.get), f)
+        np.save(os.path.join(directory, 'ingredients.offsets.npy'), self.offsets)
+        np.save(os.path.join(directory, 'ingredients.postings.npy'), self.postings)
+
+    @classmethod
+    def load(cls, directory: str) -> 'IngredientIndex':
+        # posting arrays are memory-mapped, only the word table is read into memory
+        with open(os.path.join(directory, 'ingredients.words.json'), 'r') as f:
+            words = json.load(f)
+        offsets = np.load(os.path.join(directory, 'ingredients.offsets.npy'), mmap_mode='r')
+        postings = np.load(os.path.join(directory, 'ingredients.postings.npy'), mmap_mode='r')
+        return cls(words, offsets, postings)
+
+
+def duration_minutes(values: pd.Series) -> np.ndarray:
+    # int16 minutes of iso-8601 durations, parsed column-wide without a python loop
+    parts = values.astype('string').str.extract(ISO_DURATION).astype('float64')
+    minutes = (parts[0].fillna(0) * 1440 + parts[1].fillna(0) * 60 + parts[2].fillna(0) + parts[3].fillna(0) / 60).to_numpy()
+    minutes = np.where(parts.notna().any(axis=1).to_numpy() & (minutes > 0), np.ceil(minutes), MISSING_MINUTES)
+    return np.clip(minutes, MISSING_MINUTES, np.iinfo(np.int16).max).astype(np.int16)  # longer than ~22 days saturates
+
+
+def range_columns(df: pd.DataFrame) -> Dict[str, np.ndarray]:
+    # compact filterable columns: int16 minutes per duration, float32 per nutrient (nan where missing)
+    columns = {c: duration_minutes(df[c]) for c in DURATION_COLUMNS if c in df.columns}
+    columns.update({c: pd.to_numeric(df[c], errors='coerce').to_numpy(dtype=np.float32) for c in NUTRITION_COLUMNS if c in df.columns})
+    return columns
+
+
+class RangeFilter:
+    # one column's values in sorted order with the rows they came from, for binary-search range queries
+
+    def __init__(self, sorted_values: np.ndarray, order: np.ndarray):
+        self.sorted_values = sorted_values  # ascending; missing minutes (-1) sort first, nan sorts last
+        self.order = order  # int32 row of every sorted value
+        self.start = int(np.searchsorted(sorted_values, 0, side='left'))  # first present value
+        self.end = int(np.searchsorted(sorted_values, np.inf, side='right')) if sorted_values.dtype.kind == 'f' else len(sorted_values)  # end of present values
+
+    @classmethod
+    def build(cls, values: np.ndarray) -> 'RangeFilter':
+        order = np.argsort(values, kind='stable').astype(np.int32)
+        return cls(values[order], order)
+
+    def extend(self, values: np.ndarray, start: int) -> 'RangeFilter':
+        # new filter with rows start, start + 1, ... merged into the sorted order, equal values keep row order
+        order = np.argsort(values, kind='stable')
+        slots = np.searchsorted(self.sorted_values, values[order], side='right')
+        return RangeFilter(np.insert(self.sorted_values, slots, values[order]),
+                           np.insert(self.order, slots, (order + start).astype(np.int32)))
+
+    def rows_between(self, low: Optional[float] = None, high: Optional[float] = None) -> np.ndarray:
+        # rows whose value lies in [low, high], missing values never match
+        lo = self.start if low is None else max(self.start, int(np.searchsorted(self.sorted_values, low, side='left')))
+        hi = self.end if high is None else min(self.end, int(np.searchsorted(self.sorted_values, high, side='right')))
+        return self.order[lo:max(lo, hi)]
+
+    def mask(self, rows: int, low: Optional[float] = None, high: Optional[float] = None) -> np.ndarray:
+        # boolean mask over the table's rows
+        mask = np.zeros(rows, dtype=bool)
+        mask[self.rows_between(low, high)] = True
+        return mask
+
+    def save(self, directory: str, column: str):
+        np.save(os.path.join(directory, f"range.{column}.values.npy"), self.sorted_values)
+        np.save(os.path.join(directory, f"range.{column}.order.npy"), self.order)
+
+    @classmethod
+    def load(cls, directory: str, column: str) -> 'RangeFilter':
+        return cls(np.load(os.path.join(directory, f"range.{column}.values.npy"), mmap_mode='r'),
+                   np.load(os.path.join(directory, f"range.{column}.order.npy"), mmap_mode='r'))
@@ -0,0 +1,346 @@
+import os
+import json
+import hashlib
+import shutil
+import argparse  # arg parsing
+from typing import Dict, List, Optional  # for type hinting
+
+import numpy as np
+import pandas as pd
+
+from recipeindex import IngredientIndex, RangeFilter, range_columns
+from textsearch import TextIndex, frame_documents
+from similarity import SimilarityIndex
+
+# columnar binary recipe store, built once from the category csv files so startup
+# does not have to re-parse the free-text columns on every run
+#
+# a recipe listed in several category files is one row, its meal types kept as a bitmask
+#
+# layout of a store directory:
+#   meta.json               row count, column lists, meal type names, source file stats
+#   <column>.npy            numeric columns, opened memory-mapped
+#   meal_type.npy           uint8 codes into meta['meal_types'] of each recipe's first meal type
+#   meal_types.npy          uint8 bitmask of every meal type a recipe belongs to, bit i is meta['meal_types'][i]
+#   <column>.blob           utf-8 text of a text column, all rows concatenated
+#   <column>.offsets.npy    int64 byte offsets into the blob (rows + 1 entries)
+#   <column>.null.npy       bool mask of missing values for the text column
+#   ingredients.*           inverted ingredient index over RecipeIngredientParts (recipeindex.IngredientIndex)
+#   text.*                  tf-idf postings over the recipe text (textsearch.TextIndex)
+#   similarity.*            content vectors and lsh tables for "more like this" (similarity.SimilarityIndex)
+#   range.<column>.*        sorted int16 minutes / float32 nutrients and their rows (recipeindex.RangeFilter)
+#   snapshot-<key>.bin      prepared suggester state (id index, meal type partitions) as aligned arrays,
+#                           keyed by a hash of the category files' names, sizes and mtimes (write_snapshot)
+
+CATEGORY_FILES = ['appetizer.csv', 'breakfast.csv', 'dessert.csv', 'dinner.csv', 'lunch.csv']  # category files in load order
+STORE_DIRNAME = 'store'  # default store directory inside the data directory
+STORE_VERSION = 7  # bump when the on-disk layout changes
+SCORING_COLUMNS = ['RecipeId', 'AggregatedRating']  # numeric columns mapped into the scoring frame
+MEAL_TYPES = [category_file.split('.')[0] for category_file in CATEGORY_FILES]  # bit i of a meal_types mask is MEAL_TYPES[i]
+ID_COLUMNS = {'RecipeId', 'AuthorId'}  # integer ids, stored as int32
+EXACT_COLUMNS = {'AggregatedRating'}  # float columns scores are computed from, kept float64
+CATEGORICAL_RATIO = 0.5  # text columns with at most this share of distinct values become categoricals
+SNAPSHOT_MAGIC = b'RSNAP001'  # first bytes of a snapshot file, bump the digits when its layout changes
+SNAPSHOT_ALIGN = 64  # byte alignment of every array in a snapshot
+
+
+def source_stats(data_dir: str) -> Dict[str, Dict]:
+    # size and mtime of every category file, used to detect a stale store
+    stats = {}
+    for category_file in CATEGORY_FILES:
+        file_path = os.path.join(data_dir, category_file)
+        if os.path.exists(file_path):
+            st = os.stat(file_path)
+            stats[category_file] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    return stats
+
+
+def read_category_csvs(data_dir: str) -> pd.DataFrame:
+    # parse all category csv files into one frame with a meal_type column
+    dfs = []
+    for category_file in CATEGORY_FILES:
+        file_path = os.path.join(data_dir, category_file)
+        if os.path.exists(file_path):
+            df = pd.read_csv(file_path)
+            df['meal_type'] = category_file.split('.')[0]
+            dfs.append(df)
+    return pd.concat(dfs, ignore_index=True)
+
+
+def dedupe_recipes(df: pd.DataFrame) -> pd.DataFrame:
+    # one row per RecipeId from the concatenated category files, in first-seen order;
+    # meal_type keeps the first category, meal_types is the bitmask of all of them
+    ids, first = np.unique(df['RecipeId'].to_numpy(), return_index=True)
+    slots = np.searchsorted(ids, df['RecipeId'].to_numpy())
+    masks = np.zeros(len(ids), dtype=np.uint8)
+    np.bitwise_or.at(masks, slots, (1 << pd.Categorical(df['meal_type'], categories=MEAL_TYPES).codes).astype(np.uint8))
+    order = np.argsort(first, kind='stable')
+    deduped = df.iloc[first[order]].reset_index(drop=True)
+    deduped['meal_types'] = masks[order]
+    return deduped
+
+
+def compact_frame(df: pd.DataFrame) -> pd.DataFrame:
+    # int32 ids, downcast numerics and categoricals for repetitive text columns
+    columns = {}
+    for column in df.columns:
+        values = df[column]
+        if column == 'meal_type':
+            values = pd.Categorical(values, categories=MEAL_TYPES)
+        elif column == 'meal_types':
+            pass  # already a uint8 bitmask
+        elif column in ID_COLUMNS and len(values) and values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max:
+            values = values.astype(np.int32)  # Food.com ids fit int32
+        elif pd.api.types.is_integer_dtype(values) and column not in ID_COLUMNS:
+            values = pd.to_numeric(values, downcast='integer')
+        elif pd.api.types.is_float_dtype(values) and column not in EXACT_COLUMNS:
+            values = values.astype(np.float32)
+        elif not pd.api.types.is_numeric_dtype(values) and values.nunique() <= CATEGORICAL_RATIO * len(values):
+            values = values.astype('category')  # durations, categories, yields, authors
+        columns[column] = values
+    return pd.DataFrame(columns)
+
+
+def load_recipe_table(data_dir: str) -> pd.DataFrame:
+    # the deduplicated, compacted recipe table both the store and csv loading use
+    return compact_frame(dedupe_recipes(read_category_csvs(data_dir)))
+
+
+def memory_report(df: pd.DataFrame) -> Dict[str, int]:
+    # bytes held by each column, strings and categories included, plus the total
+    usage = df.memory_usage(deep=True, index=False)
+    report = {column: int(size) for column, size in usage.items()}
+    report['total'] = int(usage.sum())
+    return report
+
+
+def build_store(data_dir: str, store_dir: Optional[str] = None) -> str:
+    # one-time conversion of the category csv files into a columnar store
+    store_dir = store_dir or os.path.join(data_dir, STORE_DIRNAME)
+    sources = source_stats(data_dir)  # taken before reading so a concurrent edit marks the store stale
+    df = load_recipe_table(data_dir)
+
+    tmp_dir = store_dir.rstrip(os.sep) + '.tmp'  # build next to the target and swap in when complete
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    codes = pd.Categorical(df['meal_type'], categories=MEAL_TYPES).codes.astype(np.uint8)
+    np.save(os.path.join(tmp_dir, 'meal_type.npy'), codes)
+    np.save(os.path.join(tmp_dir, 'meal_types.npy'), df['meal_types'].to_numpy(dtype=np.uint8))
+
+    numeric_columns, text_columns = [], []
+    for column in df.columns:
+        if column in ('meal_type', 'meal_types'):
+            continue
+        if pd.api.types.is_numeric_dtype(df[column]):
+            np.save(os.path.join(tmp_dir, f"{column}.npy"), df[column].to_numpy())
+            numeric_columns.append(column)
+        else:
+            write_text_column(tmp_dir, column, df[column])
+            text_columns.append(column)
+
+    if 'RecipeIngredientParts' in df.columns:
+        IngredientIndex.build(df['RecipeIngredientParts']).save(tmp_dir)  # parsed once here instead of at every startup
+    TextIndex.build(frame_documents(df)).save(tmp_dir)  # memory-mapped at startup
+    SimilarityIndex.build(df).save(tmp_dir)  # built offline, memory-mapped at startup
+    ranges = range_columns(df)  # durations parsed to minutes once here
+    for column, values in ranges.items():
+        RangeFilter.build(values).save(tmp_dir, column)
+
+    meta = {
+        'version': STORE_VERSION,
+        'rows': len(df),
+        'columns': [c for c in df.columns if c not in ('meal_type', 'meal_types')],  # original column order
+        'numeric_columns': numeric_columns,
+        'text_columns': text_columns,
+        'meal_types': MEAL_TYPES,
+        'range_columns': list(ranges),
+        'sources': sources,
+    }
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    shutil.rmtree(store_dir, ignore_errors=True)
+    os.rename(tmp_dir, store_dir)
+    return store_dir
+
+
+def write_text_column(store_dir: str, column: str, values: pd.Series):
+    # concatenate utf-8 encoded values into one blob with an offsets array
+    nulls = values.isna().to_numpy()
+    encoded = [b'' if null else str(v).encode('utf-8') for v, null in zip(values.tolist(), nulls)]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    with open(os.path.join(store_dir, f"{column}.blob"), 'wb') as f:
+        f.write(b''.join(encoded))
+    np.save(os.path.join(store_dir, f"{column}.offsets.npy"), offsets)
+    np.save(os.path.join(store_dir, f"{column}.null.npy"), nulls)
+
+
+def store_is_current(data_dir: str, store_dir: Optional[str] = None) -> bool:
+    # true if a store exists and was built from the current category files
+    store_dir = store_dir or os.path.join(data_dir, STORE_DIRNAME)
+    meta_path = os.path.join(store_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    return meta.get('version') == STORE_VERSION and meta.get('sources') == source_stats(data_dir)
+
+
+def snapshot_key(data_dir: str) -> str:
+    # hash of the category files' names, sizes and mtimes and the layout versions
+    stats = json.dumps({'sources': source_stats(data_dir), 'store': STORE_VERSION, 'snapshot': SNAPSHOT_MAGIC.decode()}, sort_keys=True)
+    return hashlib.sha1(stats.encode('utf-8')).hexdigest()[:16]
+
+
+def snapshot_path(store_dir: str, key: str) -> str:
+    return os.path.join(store_dir, f"snapshot-{key}.bin")
+
+
+def write_snapshot(path: str, key: str, arrays: Dict[str, np.ndarray]):
+    # magic, header length, json header of (dtype, shape, offset) per array, then the arrays at aligned offsets
+    arrays = {name: np.ascontiguousarray(values) for name, values in arrays.items()}
+    layout, offset = {}, 0
+    for name, values in arrays.items():
+        layout[name] = [values.dtype.str, list(values.shape), offset]
+        offset += -(-values.nbytes // SNAPSHOT_ALIGN) * SNAPSHOT_ALIGN
+    header = json.dumps({'key': key, 'arrays': layout}).encode('utf-8')
+    start = -(-(len(SNAPSHOT_MAGIC) + 8 + len(header)) // SNAPSHOT_ALIGN) * SNAPSHOT_ALIGN  # first array offset
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"  # written aside and renamed, so readers never map a partial file
+    with open(tmp_path, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC + np.uint64(len(header)).tobytes() + header)
+        for name, values in arrays.items():
+            f.seek(start + layout[name][2])
+            f.write(values.tobytes())
+        f.truncate(start + offset)
+    os.replace(tmp_path, path)
+    for stale in os.listdir(os.path.dirname(path) or '.'):  # snapshots of older sources are never read again
+        if stale.startswith('snapshot-') and stale.endswith('.bin') and stale != os.path.basename(path):
+            os.unlink(os.path.join(os.path.dirname(path), stale))
+
+
+def read_snapshot(path: str, key: str) -> Optional[Dict[str, np.ndarray]]:
+    # arrays of a snapshot as read-only views of one shared memory map, None if missing or for other sources
+    if not os.path.exists(path) or os.path.getsize(path) < len(SNAPSHOT_MAGIC) + 8:
+        return None
+    buffer = np.memmap(path, dtype=np.uint8, mode='r')
+    if bytes(buffer[:len(SNAPSHOT_MAGIC)]) != SNAPSHOT_MAGIC:
+        return None
+    header_size = int(buffer[len(SNAPSHOT_MAGIC):len(SNAPSHOT_MAGIC) + 8].view(np.uint64)[0])
+    header = json.loads(bytes(buffer[len(SNAPSHOT_MAGIC) + 8:len(SNAPSHOT_MAGIC) + 8 + header_size]))
+    if header['key'] != key:
+        return None
+    start = -(-(len(SNAPSHOT_MAGIC) + 8 + header_size) // SNAPSHOT_ALIGN) * SNAPSHOT_ALIGN
+    arrays = {}
+    for name, (dtype, shape, offset) in header['arrays'].items():
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape, dtype=np.int64))
+        arrays[name] = buffer[start + offset:start + offset + count * dtype.itemsize].view(dtype).reshape(shape)
+    return arrays
+
+
+class RecipeStore:
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir  # directory holding the columnar files
+        with open(os.path.join(store_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)  # column lists and row count
+        self.rows = self.meta['rows']
+        self._numeric = {}  # memory-mapped numeric columns, opened on first use
+        self._text = {}  # (blob, offsets, nulls) per text column, opened on first use
+        self._meal_codes = None  # memory-mapped meal type codes
+        self._meal_masks = None  # memory-mapped meal type bitmasks
+
+    def column(self, column: str) -> np.ndarray:
+        # memory-mapped numeric column
+        if column not in self._numeric:
+            self._numeric[column] = np.load(os.path.join(self.store_dir, f"{column}.npy"), mmap_mode='r')
+        return self._numeric[column]
+
+    def meal_type_codes(self) -> np.ndarray:
+        # memory-mapped uint8 meal type codes
+        if self._meal_codes is None:
+            self._meal_codes = np.load(os.path.join(self.store_dir, 'meal_type.npy'), mmap_mode='r')
+        return self._meal_codes
+
+    def meal_type_masks(self) -> np.ndarray:
+        # memory-mapped uint8 bitmask of every recipe's meal types
+        if self._meal_masks is None:
+            self._meal_masks = np.load(os.path.join(self.store_dir, 'meal_types.npy'), mmap_mode='r')
+        return self._meal_masks
+
+    def meal_types(self) -> pd.Categorical:
+        # first meal type of every recipe as a categorical over the category names
+        return pd.Categorical.from_codes(np.asarray(self.meal_type_codes()), categories=self.meta['meal_types'])
+
+    def frame(self, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        # dataframe of just the columns scoring needs, backed by the mapped arrays
+        columns = columns or SCORING_COLUMNS
+        data = {column: self.column(column) for column in columns}
+        data['meal_type'] = self.meal_types()
+        data['meal_types'] = self.meal_type_masks()
+        return pd.DataFrame(data)
+
+    def _text_column(self, column: str):
+        if column not in self._text:
+            blob_path = os.path.join(self.store_dir, f"{column}.blob")
+            blob = np.memmap(blob_path, dtype=np.uint8, mode='r') if os.path.getsize(blob_path) else np.zeros(0, dtype=np.uint8)
+            offsets = np.load(os.path.join(self.store_dir, f"{column}.offsets.npy"), mmap_mode='r')
+            nulls = np.load(os.path.join(self.store_dir, f"{column}.null.npy"), mmap_mode='r')
+            self._text[column] = (blob, offsets, nulls)
+        return self._text[column]
+
+    def value(self, column: str, row: int):
+        # fetch a single value, decoding text columns on demand
+        if column in self.meta['numeric_columns']:
+            return self.column(column)[row].item()
+        blob, offsets, nulls = self._text_column(column)
+        if nulls[row]:
+            return np.nan  # same missing marker read_csv produces
+        return bytes(blob[offsets[row]:offsets[row + 1]]).decode('utf-8')
+
+    def ingredient_index(self) -> Optional[IngredientIndex]:
+        # the persisted ingredient index, None if the source had no ingredient column
+        if not os.path.exists(os.path.join(self.store_dir, 'ingredients.words.json')):
+            return None
+        return IngredientIndex.load(self.store_dir)
+
+    def text_index(self) -> Optional[TextIndex]:
+        # the persisted tf-idf index, None for stores built without one
+        if not os.path.exists(os.path.join(self.store_dir, 'text.terms.json')):
+            return None
+        return TextIndex.load(self.store_dir)
+
+    def similarity_index(self) -> Optional[SimilarityIndex]:
+        # the persisted nearest-neighbor index, None for stores built without one
+        if not os.path.exists(os.path.join(self.store_dir, 'similarity.json')):
+            return None
+        return SimilarityIndex.load(self.store_dir)
+
+    def range_filters(self) -> Dict[str, RangeFilter]:
+        # memory-mapped range filters of the duration and nutrition columns
+        return {column: RangeFilter.load(self.store_dir, column) for column in self.meta.get('range_columns', [])}
+
+    def record(self, row: int) -> Dict:
+        # full recipe row as a dictionary, in the original csv column order
+        record = {column: self.value(column, row) for column in self.meta['columns']}
+        record['meal_type'] = self.meta['meal_types'][int(self.meal_type_codes()[row])]
+        record['meal_types'] = int(self.meal_type_masks()[row])
+        return record
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the columnar recipe store")  # create an argument parser for the script
+    parser.add_argument('--data-dir', default='dataset/min', help="Directory with the category csv files")
+    parser.add_argument('--store-dir', default=None, help="Output directory (defaults to <data-dir>/store)")
+    args = parser.parse_args()
+
+    store_dir = build_store(args.data_dir, args.store_dir)
+    with open(os.path.join(store_dir, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    print(f"Built recipe store with {meta['rows']} rows at {store_dir}")
+
+
+if __name__ == "__main__":
+    main()
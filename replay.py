@@ -0,0 +1,234 @@
+import os
+import sys
+import json
+import time
+import zlib
+import queue
+import random
+import argparse  # arg parsing
+import threading
+import contextlib
+import multiprocessing
+from typing import Dict, List, Tuple  # for type hinting
+
+import numpy as np
+
+from main import RecipeSuggester, UserManager
+from benchmark import QUERIES
+
+# non-interactive session replay and concurrent load driver
+#
+#   python replay.py --events sessions.jsonl --output results.jsonl
+#   python replay.py --events sessions.jsonl --copies 50 --workers 8 --mode process --profiles sqlite
+#   python replay.py --generate 5000 --users 200 --workers 8
+#
+# one event per line, what a user typed at the prompts of main.py:
+#   {"username": "ann", "text": "dinner with chicken", "feedback": 2, "liked": true}
+# feedback is a recipe number, "n" for none or "more" for the next page, or a list of them in the order
+# typed (e.g. ["more", 1]); text "stats" reports the profile statistics instead.
+#
+# events are sharded by user, so a user's events run in order on one worker as they would in one session;
+# one result line per event is streamed as it completes, and a summary goes to stderr (or --report)
+
+SUGGESTIONS_PER_PAGE = 3  # suggestions per page, as the prompt shows them
+
+
+class TimedUserManager(UserManager):
+    # user manager recording how long every profile write to the backend took, to expose write contention
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.write_seconds = []  # seconds of every backend write
+        self.write_failures = 0  # writes the backend rejected, e.g. a locked sqlite database
+
+    def write_user_profile(self, profile) -> bool:
+        start = time.perf_counter()
+        written = super().write_user_profile(profile)
+        self.write_seconds.append(time.perf_counter() - start)
+        if not written:
+            self.write_failures += 1
+        return written
+
+
+def load_events(path: str) -> List[Dict]:
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def copy_events(events: List[Dict], copies: int) -> List[Dict]:
+    # every recorded user replayed as `copies` simulated users, each event followed by its copies
+    if copies <= 1:
+        return events
+    return [dict(event, username=f"{event['username']}-{copy}") for event in events for copy in range(copies)]
+
+
+def generate_sessions(events: int, users: int, seed: int = 0) -> List[Dict]:
+    # synthetic sessions: queries from the benchmark set, picks, 'more' pages and declines
+    rng = random.Random(seed)
+    answers = [1, 2, 3, 'n', ['more', 1], ['more', 'more', 2]]
+    return [{'username': f"user{rng.randrange(users)}", 'text': rng.choice(QUERIES + ['stats']),
+             'feedback': rng.choice(answers), 'liked': rng.random() < 0.7} for _ in range(events)]
+
+
+def worker_of(username: str, workers: int) -> int:
+    # stable worker of a user, the same in every process
+    return zlib.crc32(username.lower().encode('utf-8')) % workers
+
+
+def replay_event(suggester: RecipeSuggester, event: Dict, rng) -> Dict:
+    # one prompt of the interactive loop: suggestions for the text, then the typed feedback
+    profile = suggester.user_manager.load_user_profile(event['username'], login=False)
+    text = event.get('text', '')
+    if text.strip().lower() == 'stats':
+        return {'stats': {'total_suggestions_received': profile.total_suggestions_received, 'total_interactions': profile.total_interactions,
+                          'liked_recipes': len(profile.preferences['liked_recipes']), 'meal_type_preferences': profile.meal_type_weights()}}
+    cursor = suggester.suggestion_cursor(profile, text, rng=rng)
+    page = suggester.next_suggestions(profile, cursor, SUGGESTIONS_PER_PAGE)
+    pages = [[int(recipe['RecipeId']) for recipe in page]]
+    suggester.user_manager.save_user_profile(profile)  # interaction counters, as the service saves them
+    result = {'meal_type': cursor.meal_type, 'pages': pages, 'picked': None, 'liked': None}
+    if not page:
+        return result  # no matching recipes, the prompt asks for no feedback
+    answers = event.get('feedback', 'n')
+    for answer in answers if isinstance(answers, list) else [answers]:
+        if answer == 'more':
+            page = suggester.next_suggestions(profile, cursor, SUGGESTIONS_PER_PAGE)  # the next page of the same ranking
+            pages.append([int(recipe['RecipeId']) for recipe in page])
+            if page:
+                continue
+        elif str(answer).isdigit() and 1 <= int(answer) <= len(page):
+            recipe = page[int(answer) - 1]
+            liked = event.get('liked') in (True, 'yes')  # anything but yes is a dislike, as at the prompt
+            suggester.update_user_preference(profile, recipe['RecipeId'], recipe['Name'], liked=liked)
+            result.update(picked=int(recipe['RecipeId']), liked=liked)
+        elif answer != 'n':
+            result['error'] = f"Invalid feedback {answer!r}"
+        break  # a pick, 'n', an invalid answer or an exhausted ranking ends the prompt
+    return result
+
+
+def replay_worker(worker: int, events: List[Tuple[int, Dict]], options: Dict, sink, go, suggester: RecipeSuggester = None):
+    # replay one shard of events; a worker process builds its own suggester, worker threads share the caller's
+    own = suggester is None
+    error = None
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull) if own else contextlib.nullcontext():  # profile messages
+        try:
+            if own:
+                user_manager = TimedUserManager(options['users_dir'], backend=options['profiles'], cache_size=options['cache_size'])
+                suggester = RecipeSuggester(options['data_dir'], user_manager=user_manager, use_snapshot=True)  # warm start from the snapshot
+        except Exception as e:
+            error = str(e)
+        sink.put(('ready', worker, error))
+        go.wait()  # every worker starts at once, setup is not measured
+        try:
+            for index, event in events if error is None else []:
+                start = time.perf_counter()
+                try:
+                    record = replay_event(suggester, event, np.random.default_rng([options['seed'], index]))  # same draws for any worker count
+                except Exception as e:  # keep replaying the other events
+                    record = {'error': str(e)}
+                record.update(event=index, username=event['username'], text=event.get('text', ''), worker=worker,
+                              latency_ms=(time.perf_counter() - start) * 1000)
+                sink.put(('result', worker, record))
+        finally:
+            stats = None
+            if own and error is None:
+                suggester.user_manager.close()  # cached profiles are written inside the measured run
+                stats = {'write_seconds': suggester.user_manager.write_seconds, 'write_failures': suggester.user_manager.write_failures}
+            sink.put(('done', worker, stats))
+
+
+def replay(events: List[Dict], data_dir: str = 'dataset/min', users_dir: str = 'users', workers: int = 1, mode: str = 'thread',
+           profiles: str = 'json', cache_size: int = 0, seed: int = 0, output=None) -> Dict:
+    # replay events on `workers` threads or processes, streaming one json line per event to output; returns the summary
+    options = {'data_dir': data_dir, 'users_dir': users_dir, 'profiles': profiles, 'cache_size': cache_size, 'seed': seed}
+    shards = [[] for _ in range(workers)]
+    for index, event in enumerate(events):
+        shards[worker_of(event['username'], workers)].append((index, event))
+
+    user_manager = None
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):  # profile messages; output was opened before
+        if mode == 'thread':
+            sink, go = queue.Queue(), threading.Event()
+            user_manager = TimedUserManager(users_dir, backend=profiles, cache_size=cache_size)  # shared, like the service's
+            suggester = RecipeSuggester(data_dir, user_manager=user_manager, use_snapshot=True)
+            runners = [threading.Thread(target=replay_worker, args=(w, shards[w], options, sink, go, suggester)) for w in range(workers)]
+        else:
+            context = multiprocessing.get_context()
+            sink, go = context.Queue(), context.Event()
+            RecipeSuggester(data_dir, user_manager=UserManager(users_dir, backend=profiles), use_snapshot=True)  # store and snapshot exist before workers start
+            runners = [context.Process(target=replay_worker, args=(w, shards[w], options, sink, go)) for w in range(workers)]
+        for runner in runners:
+            runner.start()
+
+        errors = [payload for kind, _, payload in (sink.get() for _ in range(workers)) if payload]  # wait until every worker is ready
+        start = time.perf_counter()
+        go.set()
+        latencies, write_seconds, write_failures, failed, done = [], [], 0, 0, 0
+        while done < workers:
+            kind, worker, payload = sink.get()
+            if kind == 'result':
+                latencies.append(payload['latency_ms'])
+                failed += 'error' in payload
+                if output is not None:
+                    output.write(json.dumps(payload) + '\n')
+            elif kind == 'done':
+                done += 1
+                if payload:
+                    write_seconds += payload['write_seconds']
+                    write_failures += payload['write_failures']
+        if user_manager is not None:
+            user_manager.close()  # cached profiles are written inside the measured run
+            write_seconds, write_failures = user_manager.write_seconds, user_manager.write_failures
+        seconds = time.perf_counter() - start
+        for runner in runners:
+            runner.join()
+
+    return {
+        'events': len(latencies), 'workers': workers, 'mode': mode, 'profiles': profiles, 'seconds': seconds,
+        'requests_per_second': len(latencies) / seconds if seconds > 0 else 0.0,
+        'latency': percentiles_ms(np.array(latencies)), 'failed_events': failed, 'worker_errors': errors,
+        'profile_writes': dict(percentiles_ms(np.array(write_seconds) * 1000), failed=write_failures,
+                               busy_share=sum(write_seconds) / (seconds * workers) if seconds > 0 else 0.0),  # share of worker time spent writing
+    }
+
+
+def percentiles_ms(ms: np.ndarray) -> Dict:
+    if not len(ms):
+        return {'count': 0}
+    return {'count': len(ms), 'mean_ms': float(ms.mean()), 'p50_ms': float(np.percentile(ms, 50)), 'p90_ms': float(np.percentile(ms, 90)),
+            'p99_ms': float(np.percentile(ms, 99)), 'max_ms': float(ms.max())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded sessions against the recipe suggester")  # create an argument parser for the script
+    parser.add_argument('--events', default=None, help="JSONL session events to replay")
+    parser.add_argument('--copies', type=int, default=1, help="Replay every recorded user as this many simulated users")
+    parser.add_argument('--generate', type=int, default=0, help="Replay this many synthetic events instead of --events")
+    parser.add_argument('--users', type=int, default=100, help="Distinct users of the synthetic events")
+    parser.add_argument('--workers', type=int, default=1, help="Threads or processes replaying events concurrently")
+    parser.add_argument('--mode', choices=['thread', 'process'], default='thread', help="Workers share one suggester (thread) or load their own (process)")
+    parser.add_argument('--data-dir', default='dataset/min', help="Directory with the category csv files")
+    parser.add_argument('--users-dir', default='users', help="Where the replayed profiles are stored")
+    parser.add_argument('--profiles', choices=['json', 'sqlite'], default='json', help="Profile storage backend")
+    parser.add_argument('--cache-size', type=int, default=0, help="Profiles cached per user manager (0 writes every change)")
+    parser.add_argument('--output', default=None, help="Write result lines here instead of stdout")
+    parser.add_argument('--report', default=None, help="Also save the summary as JSON")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.generate:
+        events = generate_sessions(args.generate, args.users, args.seed)
+    elif args.events:
+        events = copy_events(load_events(args.events), args.copies)
+    else:
+        parser.error("Give --events or --generate")
+    with (open(args.output, 'w') if args.output else contextlib.nullcontext(sys.stdout)) as output:
+        summary = replay(events, args.data_dir, args.users_dir, args.workers, args.mode, args.profiles, args.cache_size, args.seed, output)
+    print(json.dumps(summary, indent=2), file=sys.stderr)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+import random
+from typing import Dict, List, Tuple  # for type hinting
+
+import numpy as np
+import pandas as pd
+
+from recipeindex import recipe_key
+
+# numpy scoring engine behind RecipeSuggester.get_recipe_suggestions
+
+
+PARTITION_ARRAYS = ['rows', 'recipe_ids', 'ratings', 'order']  # arrays a partition is rebuilt from, see MealTypePartition
+
+
+class MealTypePartition:
+    def __init__(self, rows: np.ndarray, recipe_ids: np.ndarray, ratings: np.ndarray, order: np.ndarray = None):
+        self.rows = rows  # row positions in the recipe table, in table order
+        self.recipe_ids = recipe_ids  # int64 RecipeId of every row
+        self.ratings = ratings  # float64 AggregatedRating, nan where missing
+        self._order = order  # positions sorted by RecipeId, built on first bulk lookup
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def sort_order(self) -> np.ndarray:
+        if self._order is None:
+            self._order = np.argsort(self.recipe_ids, kind='stable')
+        return self._order
+
+    def locate(self, ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # (index into ids, partition position) for every partition row holding one of ids
+        self.sort_order()
+        sorted_ids = self.recipe_ids[self._order]
+        left = np.searchsorted(sorted_ids, ids, side='left')
+        counts = np.searchsorted(sorted_ids, ids, side='right') - left  # rows per id, duplicates included
+        which = np.repeat(np.arange(len(ids)), counts)
+        slots = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(left, counts)
+        return which, self._order[slots]
+
+
+def build_partitions(recipes_df: pd.DataFrame, meal_types: List[str], start: int = 0) -> Dict[str, MealTypePartition]:
+    # split the recipe table into per-meal-type arrays once at load time; bit i of meal_types is meal_types[i]
+    # start is the table row of the frame's first row, for frames appended to a loaded table
+    recipe_ids = recipes_df['RecipeId'].to_numpy(dtype=np.int64)
+    ratings = recipes_df['AggregatedRating'].to_numpy(dtype=np.float64)
+    masks = recipes_df['meal_types'].to_numpy()
+    partitions = {}
+    for bit, meal_type in enumerate(meal_types):
+        rows = np.flatnonzero(masks & (1 << bit)).astype(np.int64)  # table order, so ties break like the dataframe did
+        if len(rows):
+            partitions[meal_type] = MealTypePartition(rows + start, recipe_ids[rows], ratings[rows])
+    return partitions
+
+
+def append_partitions(partitions: Dict[str, MealTypePartition], added: Dict[str, MealTypePartition]) -> Dict[str, MealTypePartition]:
+    # new partitions with the rows of later ones appended, the given ones are left untouched
+    merged = dict(partitions)
+    for meal_type, partition in added.items():
+        base = partitions.get(meal_type)
+        if base is not None:
+            partition = MealTypePartition(*(np.concatenate([getattr(base, name), getattr(partition, name)]) for name in ['rows', 'recipe_ids', 'ratings']))
+        merged[meal_type] = partition
+    return merged
+
+
+def profile_recipe_ids(ids: set) -> np.ndarray:
+    # int64 array of a profile's liked or disliked id set
+    return np.fromiter(ids, dtype=np.int64, count=len(ids))
+
+
+def profile_rating_arrays(recipe_ratings: Dict) -> Tuple[np.ndarray, np.ndarray]:
+    # sorted int64 ids and their ratings from a profile's recipe_ratings
+    pairs = [(recipe_key(k), v) for k, v in recipe_ratings.items() if str(recipe_key(k)) == str(k)]  # keys that match str(RecipeId)
+    pairs.sort()
+    ids = np.array([k for k, _ in pairs], dtype=np.int64)
+    values = np.array([v for _, v in pairs], dtype=np.float64)
+    return ids, values
+
+
+def draw_uniform(n: int, rng: np.random.Generator = None) -> np.ndarray:
+    # n uniform draws in one call; without an rng, consume the random module in the same order as before
+    if rng is not None:
+        return rng.random(n)
+    return np.fromiter((random.random() for _ in range(n)), dtype=np.float64, count=n)
+
+
+def top_k_positions(scores: np.ndarray, k: int) -> np.ndarray:
+    # positions of the k largest scores, highest first, ties broken by position like nlargest(keep='first')
+    n = len(scores)
+    if k <= 0 or n == 0:
+        return np.zeros(0, dtype=np.int64)
+    if k < n:
+        kth = scores[np.argpartition(-scores, k - 1)[k - 1]]  # k-th largest value without a full sort
+        above = np.flatnonzero(scores > kth)
+        ties = np.flatnonzero(scores == kth)[:k - len(above)]  # earliest rows win ties at the cut
+        selected = np.sort(np.concatenate([above, ties]))
+    else:
+        selected = np.arange(n)
+    return selected[np.argsort(-scores[selected], kind='stable')]
+
+
+def row_bitmap(mask: np.ndarray) -> np.ndarray:
+    # a boolean mask over table rows packed eight rows per byte
+    return np.packbits(mask)
+
+
+def bitmap_mask(bitmap: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    # boolean mask of the given rows' bits, without unpacking the whole bitmap
+    return (bitmap[rows >> 3] >> (7 - (rows & 7)).astype(np.uint8)) & 1 == 1
+
+
+def exclusion_candidates(partition: MealTypePartition, liked: np.ndarray, disliked: np.ndarray, include_liked_probability: float,
+                         rng: np.random.Generator = None, allowed: np.ndarray = None) -> np.ndarray:
+    # partition positions left after excluding disliked recipes and most liked ones
+    # liked and disliked mask the partition; allowed optionally masks it down to recipes matching the query
+    excluded = disliked if allowed is None else disliked | ~allowed  # recipes outside the query are dropped like disliked ones
+    liked = liked & ~excluded
+
+    # liked recipes reappear with the given probability, one draw per liked candidate
+    keep = ~excluded
+    liked_positions = np.flatnonzero(liked)
+    keep[liked_positions] = draw_uniform(len(liked_positions), rng) < include_liked_probability
+    return np.flatnonzero(keep)
+
+
+def base_scores(partition: MealTypePartition) -> np.ndarray:
+    # profile-independent factor of every partition score: the aggregated rating, missing counting as 1
+    base = np.where(np.isnan(partition.ratings), 1, partition.ratings)
+    base.flags.writeable = False  # shared by every request
+    return base
+
+
+def score_candidates(partition: MealTypePartition, candidates: np.ndarray, profile, meal_type: str, base: np.ndarray = None) -> np.ndarray:
+    # personal rating scaled by the meal type weight, then by the aggregated rating
+    base = base_scores(partition) if base is None else base
+    weight = 1 + profile.meal_type_weight(meal_type)  # decayed as of now
+    rated_ids, rated_values = profile_rating_arrays(profile.recipe_ratings)
+    which, positions = partition.locate(rated_ids)  # rated recipes in this partition
+    return scale_candidates(base, candidates, weight, positions, rated_values[which])
+
+
+def scale_candidates(base: np.ndarray, candidates: np.ndarray, weight: float, positions: np.ndarray, values: np.ndarray) -> np.ndarray:
+    # the base vector is scaled once for unrated recipes and only the rated positions are rescored
+    scores = base[candidates] * (0.5 * weight)  # never-rated recipes, same product as rating * weight * aggregated
+    slots = np.searchsorted(candidates, positions).clip(max=max(len(candidates) - 1, 0))
+    hit = candidates[slots] == positions if len(candidates) else np.zeros(len(positions), dtype=bool)
+    scores[slots[hit]] = (values[hit] * weight) * base[positions[hit]]
+    return scores
+
+
+def sparse_lookup(keys: np.ndarray, values: np.ndarray, queries: np.ndarray) -> np.ndarray:
+    # value of every query in sorted keys, 0 where it is missing
+    slots = np.searchsorted(keys, queries).clip(max=len(keys) - 1)
+    return np.where(keys[slots] == queries, values[slots], 0)
+
+
+class SuggestionCursor:
+    # ranked candidates of one query, paged without filtering or scoring again
+    # the ranking is a prefix extended lazily: every extension selects at least twice as many as before
+
+    def __init__(self, rows: np.ndarray, scores: np.ndarray, meal_type: str, version: int):
+        self.rows = rows.astype(np.int32)  # table rows of the candidates
+        self.scores = scores  # final score of every candidate
+        self.meal_type = meal_type
+        self.version = version  # profile version the scores were computed for
+        self.ranked = np.zeros(0, dtype=np.int64)  # candidate positions, best first, ties by position
+        self.served = 0  # candidates already returned
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def remaining(self) -> int:
+        return len(self.rows) - self.served
+
+    def is_current(self, profile) -> bool:
+        # false once feedback changed the profile the ranking was computed for
+        return profile.version == self.version
+
+    def next_page(self, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        # table rows and scores of the next k candidates
+        stop = min(self.served + max(k, 0), len(self.rows))
+        if stop > len(self.ranked):  # (score, position) is a total order, so a longer top-k extends the shorter one
+            self.ranked = top_k_positions(self.scores, min(max(stop, 2 * len(self.ranked)), len(self.rows)))
+        positions = self.ranked[self.served:stop]
+        self.served = stop
+        return self.rows[positions], self.scores[positions]
+
+
+def blend_similarity(scores: np.ndarray, similarity: np.ndarray, weight: float) -> np.ndarray:
+    # boost scores by a similarity in [0, 1]: score * (1 + weight * similarity)
+    return scores * (1 + weight * similarity)
+
+
+class ProfileBatch:
+    # many profiles scored against one meal-type partition as a users-by-recipes matrix
+
+    MAX_CELLS = 1 << 22  # users x recipes cells scored at once, bounds the score matrix memory
+
+    def __init__(self, partition: MealTypePartition, profiles: List, meal_type: str, allowed: List[np.ndarray] = None, base: np.ndarray = None):
+        self.partition = partition
+        self.base = base_scores(partition) if base is None else base  # aggregated rating factor shared by every profile
+        self.profiles = profiles
+        self.weights = np.array([1 + p.meal_type_weight(meal_type) for p in profiles], dtype=np.float64)
+        n = len(partition)
+
+        # disliked and liked (user, position) pairs, encoded as user * n + position
+        self.disliked = self._pair_keys([profile_recipe_ids(p.disliked_ids()) for p in profiles])
+        if allowed is not None:  # per-user query masks (None for no restriction), excluded like disliked recipes
+            blocked = [user * n + np.flatnonzero(~mask) for user, mask in enumerate(allowed) if mask is not None]
+            self.disliked = np.union1d(self.disliked, np.concatenate(blocked + [np.zeros(0, dtype=np.int64)]))
+        liked = self._pair_keys([profile_recipe_ids(p.liked_ids()) for p in profiles])
+        self.liked = liked[~np.isin(liked, self.disliked)]  # sorted by user, then position: the single-profile draw order
+        self.liked_counts = np.bincount(self.liked // max(n, 1), minlength=len(profiles))  # liked draws each user needs
+
+        # personal ratings as (key, value) pairs
+        rated = [profile_rating_arrays(p.recipe_ratings) for p in profiles]
+        users = np.repeat(np.arange(len(profiles)), [len(ids) for ids, _ in rated])
+        which, positions = partition.locate(np.concatenate([ids for ids, _ in rated] + [np.zeros(0, dtype=np.int64)]))
+        self.rated = users[which].astype(np.int64) * n + positions
+        self.rated_values = np.concatenate([values for _, values in rated] + [np.zeros(0)])[which]
+
+    def _pair_keys(self, id_arrays: List[np.ndarray]) -> np.ndarray:
+        users = np.repeat(np.arange(len(id_arrays)), [len(ids) for ids in id_arrays])
+        which, positions = self.partition.locate(np.concatenate(id_arrays + [np.zeros(0, dtype=np.int64)]))
+        return np.unique(users[which].astype(np.int64) * len(self.partition) + positions)
+
+    def score(self, liked_draws: np.ndarray, include_liked_probability: float) -> List[Tuple[np.ndarray, np.ndarray]]:
+        # candidate positions and scores per profile, liked_draws ordered like self.liked
+        n = len(self.partition)
+        aggregated = self.base
+        keep_liked = liked_draws < include_liked_probability
+        results = []
+        chunk = max(1, self.MAX_CELLS // max(n, 1))  # users per matrix block
+        for start in range(0, len(self.profiles), chunk):
+            stop = min(start + chunk, len(self.profiles))
+            lo, hi = start * n, stop * n  # key range of this block
+
+            keep = np.ones((stop - start, n), dtype=bool).reshape(-1)  # flat views index by key - lo
+            block = (self.disliked >= lo) & (self.disliked < hi)
+            keep[self.disliked[block] - lo] = False
+            block = (self.liked >= lo) & (self.liked < hi)
+            keep[self.liked[block] - lo] = keep_liked[block]
+
+            ratings = np.full((stop - start) * n, 0.5)
+            block = (self.rated >= lo) & (self.rated < hi)
+            ratings[self.rated[block] - lo] = self.rated_values[block]
+
+            scores = ratings.reshape(stop - start, n) * self.weights[start:stop, None]  # (rating * weight) * aggregated, the product scale_candidates computes
+            scores *= aggregated[None, :]
+            keep = keep.reshape(stop - start, n)
+            for row in range(stop - start):
+                candidates = np.flatnonzero(keep[row])
+                results.append((candidates, scores[row, candidates]))
+        return results
@@ -0,0 +1,152 @@
+import os
+import re
+import json
+import argparse  # arg parsing
+from typing import List, Optional, Tuple  # for type hinting
+
+import numpy as np
+import pandas as pd
+
+from filterdataset import CATEGORIES, MATCH_COLUMNS, CategoryClassifier
+from recipestore import MEAL_TYPES
+
+# append-only recipe ingestion without rebuilding the category files or the store
+#
+# every ingested file is classified with filterdataset's category rules and written as one immutable
+# segment; a running RecipeSuggester appends new segments to its table and indexes (refresh_segments),
+# and small neighbouring segments are merged in the background (compact_segments).
+#
+# layout inside a data directory:
+#   segments/segment-<first>-<last>.csv   source columns plus the meal_types bitmask, first and last are the
+#                                         ingest sequence numbers it holds (equal until segments are compacted)
+#
+# rows are appended after the store's rows in sequence order; a RecipeId already in the table keeps its first row
+
+SEGMENTS_DIRNAME = 'segments'  # segment directory inside the data directory
+SEGMENT_NAME = re.compile(r'^segment-(\d{6})-(\d{6})\.csv$')
+COMPACT_BYTES = 4 << 20  # segments smaller than this are merged with their small neighbours
+CLASSIFIER_BITS = [MEAL_TYPES.index(meal_type) for meal_type in CATEGORIES]  # classifier bit -> meal_types bit
+
+
+def segments_dir(data_dir: str) -> str:
+    return os.path.join(data_dir, SEGMENTS_DIRNAME)
+
+
+def list_segments(directory: str) -> List[Tuple[int, int, str]]:
+    # (first, last, path) of every segment in sequence order
+    if not os.path.isdir(directory):
+        return []
+    segments = []
+    for name in os.listdir(directory):
+        match = SEGMENT_NAME.match(name)
+        if match:
+            segments.append((int(match.group(1)), int(match.group(2)), os.path.join(directory, name)))
+    return sorted(segments)
+
+
+def r_vector(values: list) -> str:
+    # R character vector literal of a json list, the form the csv columns use
+    return 'c(' + ', '.join('"' + str(value).replace('"', '\\"') + '"' for value in values) + ')'
+
+
+def read_source(path: str) -> pd.DataFrame:
+    # rows of a csv or jsonl file as text, lists in jsonl written as R vectors like the csv files
+    if path.endswith(('.jsonl', '.json')):
+        with open(path, 'r') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        df = pd.DataFrame.from_records(records)
+        for column in df.columns:
+            df[column] = [r_vector(v) if isinstance(v, list) else '' if v is None else str(v) for v in df[column].tolist()]
+        return df
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+
+def classify_recipes(df: pd.DataFrame) -> pd.DataFrame:
+    # rows that match at least one meal type, with their meal_types bitmask; unmatched rows are dropped as filterdataset does
+    if 'RecipeId' not in df.columns:
+        raise ValueError("Recipes to ingest need a RecipeId column")
+    columns = [c for c in MATCH_COLUMNS if c in df.columns]
+    if not columns:
+        raise ValueError(f"Recipes to ingest need one of the columns {MATCH_COLUMNS}")
+    masks = CategoryClassifier(CATEGORIES).masks([df[c].tolist() for c in columns]) if len(df) else np.zeros(0, dtype=np.int64)
+    meal_types = np.zeros(len(df), dtype=np.uint8)
+    for bit, target in enumerate(CLASSIFIER_BITS):
+        meal_types |= (((masks >> bit) & 1) << target).astype(np.uint8)
+    valid = (meal_types > 0) & pd.to_numeric(df['RecipeId'], errors='coerce').notna().to_numpy()
+    df = df[valid].assign(meal_types=meal_types[valid])
+    return df.drop_duplicates('RecipeId').reset_index(drop=True)
+
+
+def write_segment(directory: str, df: pd.DataFrame, first: int, last: int) -> str:
+    # write a segment under its final name in one step, so readers never see a partial file
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"segment-{first:06d}-{last:06d}.csv")
+    tmp_path = path + '.tmp'
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    return path
+
+
+def ingest(data_dir: str, source: str) -> Tuple[Optional[str], int]:
+    # classify a csv or jsonl file and store its recipes as the next segment, (path, rows); (None, 0) when nothing matched
+    df = classify_recipes(read_source(source))
+    if not len(df):
+        return None, 0
+    directory = segments_dir(data_dir)
+    segments = list_segments(directory)
+    seq = segments[-1][1] + 1 if segments else 1
+    return write_segment(directory, df, seq, seq), len(df)
+
+
+def read_segment(path: str) -> pd.DataFrame:
+    # typed rows of one segment with meal_type set to its first meal type, as dedupe_recipes does
+    df = pd.read_csv(path)
+    masks = df['meal_types'].to_numpy(dtype=np.uint8)
+    first = np.argmax((masks[:, None] >> np.arange(len(MEAL_TYPES), dtype=np.uint8)) & 1, axis=1)
+    df['meal_type'] = pd.Categorical.from_codes(first, categories=MEAL_TYPES)
+    df['meal_types'] = masks
+    return df
+
+
+def compact_segments(data_dir: str, max_bytes: int = COMPACT_BYTES) -> int:
+    # merge every run of consecutive small segments into one, returns the number of segments removed
+    # the merged file is written before the old ones are deleted, so a reader sees every row at any time
+    directory = segments_dir(data_dir)
+    runs, run = [], []
+    for segment in list_segments(directory):
+        if os.path.getsize(segment[2]) < max_bytes:
+            run.append(segment)
+            continue
+        runs.append(run)
+        run = []
+    runs.append(run)
+    removed = 0
+    for run in runs:
+        if len(run) < 2:
+            continue
+        frames = [pd.read_csv(path, dtype=str, keep_default_na=False) for _, _, path in run]  # text as written, nothing re-parsed
+        merged = pd.concat(frames, ignore_index=True).drop_duplicates('RecipeId')
+        merged_path = write_segment(directory, merged, run[0][0], run[-1][1])
+        for _, _, path in run:
+            if path != merged_path:
+                os.remove(path)
+        removed += len(run) - 1
+    return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Add recipes to a data directory without rebuilding it")  # create an argument parser for the script
+    parser.add_argument('--data-dir', default='dataset/min', help="Directory with the category csv files")
+    parser.add_argument('--ingest', nargs='*', default=[], help="CSV or JSONL files of Food.com-shaped recipes, one segment each")
+    parser.add_argument('--compact', action='store_true', help="Merge small segments")
+    args = parser.parse_args()
+
+    for source in args.ingest:
+        path, rows = ingest(args.data_dir, source)
+        print(f"Ingested {rows} recipes from {source}" + (f" into {path}" if path else ""))
+    if args.compact:
+        print(f"Compaction removed {compact_segments(args.data_dir)} segments")
+
+
+if __name__ == "__main__":
+    main()
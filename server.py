@@ -0,0 +1,333 @@
+import re
+import json
+import math
+import time
+import asyncio
+import itertools
+import threading
+import contextlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Tuple  # for type hinting
+from urllib.parse import parse_qs, urlsplit
+
+from metrics import REGISTRY
+
+# asyncio http service around one shared RecipeSuggester
+#
+# endpoints (json in, json out):
+#   POST /suggest       {"username", "text", "num_suggestions"}  -> {"suggestions": [...], "cursor": <token>}
+#   POST /more          {"username", "cursor", "num_suggestions"} -> the next page of that ranking, {"suggestions": [...], "cursor"}
+#                                                                   (410 once feedback, a newer search or CURSOR_TTL_SECONDS expired it)
+#   POST /feedback      {"username", "recipe_id", "liked"}       -> {"ok": true}
+#   GET  /stats?username=<name>                                  -> profile statistics, 404 for a user never seen
+#   GET  /instructions?recipe_id=<id>                            -> {"recipe_id", "name", "instructions"}
+#   GET  /metrics[?format=json]                                  -> prometheus text (or json) of the metrics registry
+
+SUGGESTION_FIELDS = ['RecipeId', 'Name', 'meal_type', 'PrepTime', 'AggregatedRating', 'ReviewCount', 'score']  # fields returned per suggestion
+KIND_NAMES = {str: 'a string', int: 'an integer', bool: 'true or false'}  # json type names in 400 messages
+MAX_BODY_BYTES = 1 << 20  # largest request body accepted
+MAX_CURSORS = 1024  # users whose latest search is kept for /more, least recently used dropped first
+CURSOR_TTL_SECONDS = 600  # a search not paged for this long expires
+USERNAME_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,64}')  # names accepted from clients, safe as a profile file name
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status  # http status code sent to the client
+
+
+def json_value(value):
+    # json-safe scalar: nan becomes null, numpy scalars become python values
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+class RecipeService:
+    def __init__(self, suggester, workers: int = 4):
+        self.suggester = suggester  # loaded once and shared by every request
+        self.executor = ThreadPoolExecutor(max_workers=workers)  # scoring and profile i/o run off the event loop
+        self.user_locks = {}  # user -> [lock, holders and waiters]; one lock per active user so updates to a profile never interleave
+        self.cursors = OrderedDict()  # user -> (token, SuggestionCursor, last use) of the user's latest search, one per user
+        self.cursor_lock = threading.Lock()  # cursors are stored and taken from executor threads
+        self.cursor_tokens = itertools.count(1)
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    @contextlib.asynccontextmanager
+    async def user_lock(self, username: str):
+        # the user's lock, dropped once nobody holds or waits for it so idle users cost nothing
+        key = username.lower()
+        entry = self.user_locks.get(key)
+        if entry is None:
+            entry = self.user_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.user_locks[key]
+
+    def store_cursor(self, username: str, token: str, cursor):
+        # replaces the user's previous search, evicting the least recently used cursors past MAX_CURSORS
+        with self.cursor_lock:
+            self.cursors[username.lower()] = (token, cursor, time.monotonic())
+            self.cursors.move_to_end(username.lower())
+            while len(self.cursors) > MAX_CURSORS:
+                self.cursors.popitem(last=False)
+
+    def find_cursor(self, username: str, token: str):
+        # the user's cursor if token is still its latest, unexpired search, else None
+        with self.cursor_lock:
+            entry = self.cursors.get(username.lower())
+            if entry is None or entry[0] != token or time.monotonic() - entry[2] > CURSOR_TTL_SECONDS:
+                self.cursors.pop(username.lower(), None)
+                return None
+            self.cursors[username.lower()] = (token, entry[1], time.monotonic())
+            self.cursors.move_to_end(username.lower())
+            return entry[1]
+
+    def drop_cursor(self, username: str):
+        with self.cursor_lock:
+            self.cursors.pop(username.lower(), None)
+
+    def profile(self, username: str):
+        return self.suggester.user_manager.load_user_profile(username, login=False)  # cached when the manager has a cache
+
+    async def suggest(self, body: Dict) -> Dict:
+        username = require_username(body)
+        text = require(body, 'text')
+        num_suggestions = count_field(body, 'num_suggestions', 3)
+        async with self.user_lock(username):
+            suggestions, token = await self.run(self._suggest, username, text, num_suggestions)
+        return {'suggestions': suggestion_fields(suggestions), 'cursor': token}
+
+    def _suggest(self, username: str, text: str, num_suggestions: int):
+        profile = self.profile(username)
+        cursor = self.suggester.suggestion_cursor(profile, text)  # ranked once, later pages come from /more
+        suggestions = self.suggester.next_suggestions(profile, cursor, num_suggestions)
+        token = f"{next(self.cursor_tokens):x}"
+        self.store_cursor(username, token, cursor)  # replaces the user's previous search
+        self.suggester.user_manager.save_user_profile(profile)  # persist the interaction counters
+        return suggestions, token
+
+    async def more(self, body: Dict) -> Dict:
+        username = require_username(body)
+        token = str(require(body, 'cursor', (str, int)))
+        num_suggestions = count_field(body, 'num_suggestions', 3)
+        async with self.user_lock(username):
+            suggestions = await self.run(self._more, username, token, num_suggestions)
+        return {'suggestions': suggestion_fields(suggestions), 'cursor': token}
+
+    def _more(self, username: str, token: str, num_suggestions: int):
+        cursor = self.find_cursor(username, token)
+        profile = self.profile(username)
+        if cursor is None or not cursor.is_current(profile):  # a newer or expired search, or feedback changed the profile
+            self.drop_cursor(username)
+            raise HTTPError(410, "Cursor expired, search again")
+        suggestions = self.suggester.next_suggestions(profile, cursor, num_suggestions)
+        self.suggester.user_manager.save_user_profile(profile)
+        return suggestions
+
+    async def feedback(self, body: Dict) -> Dict:
+        username = require_username(body)
+        recipe_id = str(require(body, 'recipe_id', (str, int)))
+        liked = require(body, 'liked', (bool,))
+        recipe_name = await self.run(self.suggester.get_recipe_field, recipe_id, 'Name')
+        if recipe_name is None:
+            raise HTTPError(404, f"Recipe {recipe_id} not found")
+        async with self.user_lock(username):
+            await self.run(self._feedback, username, recipe_id, recipe_name, liked)
+        return {'ok': True}
+
+    def _feedback(self, username: str, recipe_id: str, recipe_name: str, liked: bool):
+        profile = self.profile(username)
+        self.suggester.update_user_preference(profile, recipe_id, recipe_name, liked=liked)  # saves the profile
+        self.drop_cursor(username)  # its ranking is out of date, free it now
+
+    async def stats(self, query: Dict) -> Dict:
+        username = require_username(query)
+        async with self.user_lock(username):
+            profile = await self.run(self.suggester.user_manager.find_user_profile, username)  # a read never creates a profile
+            if profile is None:
+                raise HTTPError(404, f"User {username} not found")
+            return {
+                'username': profile.user_id,
+                'total_suggestions_received': profile.total_suggestions_received,
+                'total_interactions': profile.total_interactions,
+                'liked_recipes': len(profile.preferences['liked_recipes']),
+                'disliked_recipes': len(profile.preferences['disliked_recipes']),
+                'meal_type_preferences': profile.meal_type_weights(),  # decayed as of now
+            }
+
+    async def instructions(self, query: Dict) -> Dict:
+        recipe_id = require(query, 'recipe_id')
+        name = await self.run(self.suggester.get_recipe_field, recipe_id, 'Name')
+        if name is None:
+            raise HTTPError(404, f"Recipe {recipe_id} not found")
+        instructions = await self.run(self.suggester.get_recipe_instructions, recipe_id)
+        return {'recipe_id': str(recipe_id), 'name': name, 'instructions': json_value(instructions)}
+
+    async def metrics(self, query: Dict):
+        if query.get('format') == 'json':
+            return dict(REGISTRY.to_dict(), profile_cache=self.suggester.user_manager.cache_stats(), suggester_caches=self.suggester.cache_stats())
+        return REGISTRY.to_prometheus()  # plain text response
+
+    async def dispatch(self, method: str, target: str, body: bytes):
+        url = urlsplit(target)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        routes = {
+            ('POST', '/suggest'): lambda: self.suggest(parse_body(body)),
+            ('POST', '/more'): lambda: self.more(parse_body(body)),
+            ('POST', '/feedback'): lambda: self.feedback(parse_body(body)),
+            ('GET', '/stats'): lambda: self.stats(query),
+            ('GET', '/instructions'): lambda: self.instructions(query),
+            ('GET', '/metrics'): lambda: self.metrics(query),
+        }
+        route = routes.get((method, url.path))
+        if route is None:
+            raise HTTPError(404 if all(path != url.path for _, path in routes) else 405, f"No route for {method} {url.path}")
+        return await route()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # serve requests on one connection until the client closes it or asks to
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, target, headers, body = request
+                REGISTRY.inc('http_requests', method=method)
+                try:
+                    status, payload = 200, await self.dispatch(method, target, body)
+                except HTTPError as e:
+                    status, payload = e.status, {'error': str(e)}
+                except Exception as e:  # keep serving other requests
+                    status, payload = 500, {'error': str(e)}
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                writer.write(encode_response(status, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except HTTPError as e:  # malformed request
+            writer.write(encode_response(e.status, {'error': str(e)}, keep_alive=False))
+        finally:
+            writer.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.suggester.user_manager.close()  # flush cached profiles
+        self.suggester.save_collaborative_model()  # likes received while serving
+        self.suggester.stop_watching_segments()
+        self.suggester.stop_sharding()  # scoring workers and their shared memory
+
+
+def suggestion_fields(suggestions) -> list:
+    return [{field: json_value(s.get(field)) for field in SUGGESTION_FIELDS} for s in suggestions]
+
+
+def require(data: Dict, key: str, kinds: Tuple = (str,)):
+    # a field of one of the json types kinds, 400 when it is missing or of another type
+    if key not in data:
+        raise HTTPError(400, f"Missing '{key}'")
+    value = data[key]
+    if not isinstance(value, kinds) or (isinstance(value, bool) and bool not in kinds):  # true is not a number
+        raise HTTPError(400, f"'{key}' must be {' or '.join(KIND_NAMES[kind] for kind in kinds)}")
+    return value
+
+
+def require_username(data: Dict) -> str:
+    username = require(data, 'username')
+    if not USERNAME_PATTERN.fullmatch(username):
+        raise HTTPError(400, "'username' must be 1 to 64 letters, digits, '_' or '-'")
+    return username
+
+
+def count_field(data: Dict, key: str, default: int) -> int:
+    # a positive integer field, 400 for anything else
+    value = data.get(key, default)
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise HTTPError(400, f"'{key}' must be a positive integer")
+    return value
+
+
+def parse_body(body: bytes) -> Dict:
+    try:
+        data = json.loads(body or b'{}')
+    except ValueError:
+        raise HTTPError(400, "Request body is not valid JSON")
+    if not isinstance(data, dict):
+        raise HTTPError(400, "Request body must be a JSON object")
+    return data
+
+
+async def read_request(reader: asyncio.StreamReader) -> Tuple:
+    # (method, target, headers, body) of the next request, None at end of stream
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    parts = request_line.decode('latin-1').split()
+    if len(parts) != 3:
+        raise HTTPError(400, "Malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = headers.get('content-length', '0')
+    if not length.isdigit():
+        raise HTTPError(400, "Invalid Content-Length")
+    length = int(length)
+    if length > MAX_BODY_BYTES:
+        raise HTTPError(413, "Request body too large")
+    body = await reader.readexactly(length) if length else b''
+    return parts[0].upper(), parts[1], headers, body
+
+
+def encode_response(status: int, payload, keep_alive: bool = True) -> bytes:
+    # json for dictionaries, plain text for strings
+    reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 410: 'Gone', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+    if isinstance(payload, str):
+        body, content_type = payload.encode('utf-8'), 'text/plain; version=0.0.4'
+    else:
+        body, content_type = json.dumps(payload).encode('utf-8'), 'application/json'
+    head = (f"HTTP/1.1 {status} {reasons.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    return head.encode('latin-1') + body
+
+
+async def start_server(service: RecipeService, host: str = '127.0.0.1', port: int = 8080) -> asyncio.AbstractServer:
+    return await asyncio.start_server(service.handle_connection, host, port)
+
+
+def serve(suggester, host: str = '127.0.0.1', port: int = 8080, workers: int = 4, segment_interval: float = None):
+    # run the http service until interrupted, picking up ingested recipes every segment_interval seconds
+    service = RecipeService(suggester, workers=workers)
+    if segment_interval:
+        suggester.watch_segments(segment_interval)
+
+    async def run():
+        server = await start_server(service, host, port)
+        print(f"Serving recipe suggestions on http://{host}:{server.sockets[0].getsockname()[1]}")
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
@@ -0,0 +1,186 @@
+import atexit
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Dict, List, Tuple  # for type hinting
+
+import numpy as np
+
+from scoring import MealTypePartition, blend_similarity, scale_candidates, sparse_lookup, top_k_positions
+
+# multi-core scoring of large meal-type partitions
+#
+# the partition arrays (rows, RecipeIds, base scores) are copied once into one shared memory block that every
+# pool worker maps, so nothing but the query is sent per request. each partition is split into contiguous
+# shards; a worker scores its shard exactly as the single-core path does and returns its local top-k, and
+# the parent merges them by (score, partition position), the order top_k_positions ranks by, so the merged
+# top-k is the single-core ranking.
+#
+# per-query inputs that only the parent can compute (the query's allowed mask, text similarity) are written to
+# scratch arrays in the same block before the shards run; queries on one scorer run one at a time.
+
+SHARD_MIN_ROWS = 200000  # partitions smaller than this are scored on one core, see benchmark.py --shards
+SHARD_FIRST_K = 30  # candidates ranked by the first dispatch, later pages ask the shards for twice as many
+ALIGNMENT = 64  # byte alignment of every array in the shared block
+
+_worker_memory = None  # the shared block mapped by a pool worker
+_worker_arrays = None  # name -> array view of the block in a pool worker
+
+
+def share_arrays(arrays: Dict[str, np.ndarray]) -> Tuple[shared_memory.SharedMemory, Dict]:
+    # copy arrays into one new shared memory block, (block, layout) where layout maps name -> (offset, dtype, length)
+    layout, size = {}, 0
+    for name, array in arrays.items():
+        layout[name] = (size, array.dtype.str, len(array))
+        size += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for name, view in attach_arrays(memory, layout).items():
+        view[:] = arrays[name]
+    return memory, layout
+
+
+def attach_arrays(memory: shared_memory.SharedMemory, layout: Dict) -> Dict[str, np.ndarray]:
+    # array views of a shared block, nothing is copied
+    return {name: np.ndarray((length,), dtype=np.dtype(dtype), buffer=memory.buf, offset=offset)
+            for name, (offset, dtype, length) in layout.items()}
+
+
+def shard_ranges(n: int, shards: int) -> List[Tuple[int, int]]:
+    # contiguous (lo, hi) position ranges of n rows, as equal as possible
+    bounds = np.linspace(0, n, max(1, min(shards, n)) + 1).astype(np.int64)
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+def score_shard(rows: np.ndarray, recipe_ids: np.ndarray, base: np.ndarray, lo: int, hi: int, query: Dict,
+                allowed: np.ndarray = None, text: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+    # partition positions lo:hi left as candidates and their final scores, the same operations as the single-core path
+    keep = allowed[lo:hi].copy() if allowed is not None else np.ones(hi - lo, dtype=bool)
+    excluded = query['excluded']  # sorted positions of disliked recipes and liked ones not reintroduced
+    keep[excluded[np.searchsorted(excluded, lo):np.searchsorted(excluded, hi)] - lo] = False
+    candidates = np.flatnonzero(keep)
+    rated = (query['rated_positions'] >= lo) & (query['rated_positions'] < hi)
+    scores = scale_candidates(base[lo:hi], candidates, query['weight'], query['rated_positions'][rated] - lo, query['rated_values'][rated])
+    candidate_rows = rows[lo:hi][candidates]
+    text_weight, neighbor_weight, collaborative_weight = query['boost_weights']
+    if text is not None:
+        scores = blend_similarity(scores, text[candidate_rows], text_weight)
+    if query['neighbors'] is not None:
+        scores = blend_similarity(scores, sparse_lookup(*query['neighbors'], candidate_rows), neighbor_weight)
+    if query['collaborative'] is not None:
+        scores = blend_similarity(scores, sparse_lookup(*query['collaborative'], recipe_ids[lo:hi][candidates]), collaborative_weight)
+    return candidates + lo, scores
+
+
+def local_top_k(rows: np.ndarray, recipe_ids: np.ndarray, base: np.ndarray, lo: int, hi: int, k: int, query: Dict,
+                allowed: np.ndarray = None, text: np.ndarray = None) -> Tuple[int, np.ndarray, np.ndarray]:
+    # (candidates in the shard, positions, scores) of the shard's k best candidates
+    positions, scores = score_shard(rows, recipe_ids, base, lo, hi, query, allowed, text)
+    top = top_k_positions(scores, k)
+    return len(positions), positions[top], scores[top]
+
+
+def merge_top_k(parts: List[Tuple[int, np.ndarray, np.ndarray]], k: int) -> Tuple[int, np.ndarray, np.ndarray]:
+    # global top-k of the shards' local top-k, highest score first and ties by partition position
+    positions = np.concatenate([part[1] for part in parts] + [np.zeros(0, dtype=np.int64)])
+    scores = np.concatenate([part[2] for part in parts] + [np.zeros(0)])
+    order = np.lexsort((positions, -scores))[:k]
+    return sum(part[0] for part in parts), positions[order], scores[order]
+
+
+def _attach_worker(name: str, layout: Dict):
+    # pool initializer: map the shared block once per worker process
+    global _worker_memory, _worker_arrays
+    _worker_memory = shared_memory.SharedMemory(name=name)
+    _worker_arrays = attach_arrays(_worker_memory, layout)
+
+
+def _shard_top_k(lo: int, hi: int, k: int, query: Dict, use_allowed: bool, use_text: bool):
+    meal_type = query['meal_type']
+    return local_top_k(_worker_arrays[f"{meal_type}.rows"], _worker_arrays[f"{meal_type}.recipe_ids"], _worker_arrays[f"{meal_type}.base"], lo, hi, k, query,
+                       _worker_arrays['allowed'] if use_allowed else None, _worker_arrays['text'] if use_text else None)
+
+
+class ShardedScorer:
+    # the meal-type partitions in shared memory and a process pool scoring them shard by shard
+
+    def __init__(self, partitions: Dict[str, MealTypePartition], bases: Dict[str, np.ndarray], table_rows: int, workers: int, shards: int = None):
+        self.partitions = partitions  # the partitions this scorer holds, replaced ones are scored by the caller
+        arrays = {}
+        for meal_type, partition in partitions.items():
+            arrays.update({f"{meal_type}.rows": partition.rows, f"{meal_type}.recipe_ids": partition.recipe_ids, f"{meal_type}.base": bases[meal_type]})
+        arrays['allowed'] = np.zeros(max((len(p) for p in partitions.values()), default=0), dtype=bool)  # scratch: the query's allowed mask
+        arrays['text'] = np.zeros(table_rows, dtype=np.float32)  # scratch: the query's text similarity per table row, as TextIndex computes it
+        self.memory, layout = share_arrays(arrays)
+        self.arrays = attach_arrays(self.memory, layout)
+        self.ranges = {meal_type: shard_ranges(len(partition), shards or workers) for meal_type, partition in partitions.items()}
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=_attach_worker, initargs=(self.memory.name, layout))
+        self.lock = threading.Lock()  # one query at a time uses the scratch arrays and the pool
+        atexit.register(self.close)
+
+    def top_k(self, partition: MealTypePartition, query: Dict, k: int, allowed: np.ndarray = None, text: np.ndarray = None):
+        # (candidates, positions, scores) of the k best candidates of a query, None once the scorer no longer holds the partition
+        with self.lock:
+            if self.pool is None or self.partitions.get(query['meal_type']) is not partition:
+                return None
+            if allowed is not None:
+                self.arrays['allowed'][:len(allowed)] = allowed
+            if text is not None:
+                rows = min(len(text), len(self.arrays['text']))  # the table may have grown, the partition's rows fit
+                self.arrays['text'][:rows] = text[:rows]
+            futures = [self.pool.submit(_shard_top_k, lo, hi, k, query, allowed is not None, text is not None)
+                       for lo, hi in self.ranges[query['meal_type']]]
+            return merge_top_k([future.result() for future in futures], k)
+
+    def close(self):
+        # stop the workers and release the shared block
+        with self.lock:
+            if self.pool is None:
+                return
+            self.pool.shutdown(wait=True)
+            self.pool = None
+            self.arrays = None
+            self.memory.close()
+            self.memory.unlink()
+        atexit.unregister(self.close)
+
+
+class ShardedCursor:
+    # a SuggestionCursor whose ranking prefix is merged from the shards, extended by asking them for twice as many
+
+    def __init__(self, scorer: ShardedScorer, partition: MealTypePartition, base: np.ndarray, query: Dict, version: int,
+                 allowed: np.ndarray = None, text: np.ndarray = None):
+        self.scorer = scorer
+        self.partition = partition  # the partition ranked, kept so later pages survive a segment swap
+        self.base = base
+        self.query = query  # everything drawn for the ranking, so extending it repeats the same scores
+        self.allowed = allowed
+        self.text = text
+        self.meal_type = query['meal_type']
+        self.version = version  # profile version the scores were computed for
+        self.served = 0  # candidates already returned
+        self.count, self.ranked, self.scores = self.top_k(SHARD_FIRST_K)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def remaining(self) -> int:
+        return self.count - self.served
+
+    def is_current(self, profile) -> bool:
+        # false once feedback changed the profile the ranking was computed for
+        return profile.version == self.version
+
+    def top_k(self, k: int) -> Tuple[int, np.ndarray, np.ndarray]:
+        result = self.scorer.top_k(self.partition, self.query, k, self.allowed, self.text)
+        if result is None:  # the scorer was rebuilt for new partitions, rank this one on the calling core
+            result = local_top_k(self.partition.rows, self.partition.recipe_ids, self.base, 0, len(self.partition), k, self.query, self.allowed, self.text)
+        return result
+
+    def next_page(self, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        # table rows and scores of the next k candidates
+        stop = min(self.served + max(k, 0), self.count)
+        if stop > len(self.ranked):  # the shards' total order is the single-core one, so a longer top-k extends the shorter one
+            _, self.ranked, self.scores = self.top_k(min(max(stop, 2 * len(self.ranked)), self.count))
+        positions, scores = self.ranked[self.served:stop], self.scores[self.served:stop]
+        self.served = stop
+        return self.partition.rows[positions], scores
@@ -0,0 +1,191 @@
+import os
+import json
+import zlib
+from typing import Dict, List, Tuple  # for type hinting
+
+import numpy as np
+import pandas as pd
+
+from recipeindex import ingredient_words, parse_r_vector
+from textsearch import text_terms
+
+# approximate "more like this" search over recipe content vectors
+#
+# every recipe becomes one unit-length vector made of three blocks: hashed ingredient words,
+# hashed keyword words and standardized nutrition values. random-projection lsh hashes the
+# vectors into buckets in several independent tables; a query collects the rows sharing its
+# bucket in each table (plus the buckets one bit away when probing) and ranks only those exactly.
+#
+# layout inside a store directory:
+#   similarity.json          dimensions, table count, bits per table
+#   similarity.vectors.npy   float16 content vectors, one row per recipe
+#   similarity.planes.npy    float32 random hyperplanes, tables * bits rows
+#   similarity.codes.npy     uint32 bucket codes per table, sorted
+#   similarity.order.npy     int32 rows per table in code order
+#   similarity.stats.npy     float64 mean and std of the log nutrition values, so added rows are standardized alike
+
+NUTRITION_COLUMNS = ['Calories', 'FatContent', 'SaturatedFatContent', 'CholesterolContent', 'SodiumContent',
+                     'CarbohydrateContent', 'FiberContent', 'SugarContent', 'ProteinContent']  # nutrition block
+HASH_DIMS = 112  # hashed word dimensions of the ingredient block and of the keyword block
+BLOCK_WEIGHTS = {'ingredients': 0.7, 'keywords': 0.2, 'nutrition': 0.1}  # share of each block in the squared norm
+TABLES = 8  # independent hash tables
+BUCKET_SIZE = 16  # rows per bucket the number of bits is chosen for
+CHUNK_ROWS = 65536  # rows projected at once while hashing
+
+
+def word_slot(word: str) -> int:
+    # stable hashed dimension of a word (python's hash() is salted per process)
+    return zlib.crc32(word.encode('utf-8')) % HASH_DIMS
+
+
+def hashed_block(word_lists: List[List[str]]) -> np.ndarray:
+    # unit-length bag-of-words vectors through feature hashing
+    block = np.zeros((len(word_lists), HASH_DIMS), dtype=np.float32)
+    for row, words in enumerate(word_lists):
+        for word in words:
+            block[row, word_slot(word)] += 1
+    return normalize(block)
+
+
+def normalize(block: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(block, axis=1, keepdims=True)
+    return np.divide(block, norms, out=np.zeros_like(block), where=norms > 0)
+
+
+def nutrition_values(df: pd.DataFrame) -> np.ndarray:
+    # log-scaled nutrition columns present in the frame
+    columns = [c for c in NUTRITION_COLUMNS if c in df.columns]
+    return np.log1p(np.clip(df[columns].to_numpy(dtype=np.float64), 0, None)) if columns else np.zeros((len(df), 0))
+
+
+def nutrition_stats(df: pd.DataFrame) -> np.ndarray:
+    # (2, columns) mean and std of the log nutrition values the nutrition block is standardized with
+    nutrition = nutrition_values(df)
+    if not len(nutrition):
+        return np.zeros((2, nutrition.shape[1]))
+    return np.vstack([np.nanmean(nutrition, axis=0), np.nanstd(nutrition, axis=0)])
+
+
+def content_vectors(df: pd.DataFrame, stats: np.ndarray = None) -> np.ndarray:
+    # float32 unit content vectors for every row of a recipe frame, standardized by the frame's own stats by default
+    ingredients = [[w for name in parse_r_vector(text) for w in ingredient_words(name)] for text in df.get('RecipeIngredientParts', pd.Series([''] * len(df))).tolist()]
+    keywords = [[w for value in parse_r_vector(text) for w in text_terms(value)] for text in df.get('Keywords', pd.Series([''] * len(df))).tolist()]
+    stats = nutrition_stats(df) if stats is None else stats
+    nutrition = np.nan_to_num((nutrition_values(df) - stats[0]) / (stats[1] + 1e-9)).astype(np.float32)
+    blocks = [hashed_block(ingredients) * np.sqrt(BLOCK_WEIGHTS['ingredients']),
+              hashed_block(keywords) * np.sqrt(BLOCK_WEIGHTS['keywords']),
+              normalize(nutrition) * np.sqrt(BLOCK_WEIGHTS['nutrition'])]
+    return normalize(np.hstack(blocks))
+
+
+class SimilarityIndex:
+    def __init__(self, vectors: np.ndarray, planes: np.ndarray, codes: np.ndarray, order: np.ndarray, stats: np.ndarray = None):
+        self.vectors = vectors  # float16 unit content vectors
+        self.planes = planes  # (tables * bits, dims) random hyperplanes
+        self.codes = codes  # (tables, rows) sorted bucket codes
+        self.order = order  # (tables, rows) row of each sorted code
+        self.stats = stats  # nutrition mean and std the vectors were standardized with
+        self.tables, self.bits = codes.shape[0], len(planes) // max(codes.shape[0], 1)
+
+    @classmethod
+    def build(cls, df: pd.DataFrame, tables: int = TABLES, seed: int = 0) -> 'SimilarityIndex':
+        stats = nutrition_stats(df)
+        vectors = content_vectors(df, stats)
+        bits = int(np.clip(np.round(np.log2(max(len(vectors), 1) / BUCKET_SIZE)), 1, 32))  # ~BUCKET_SIZE rows per bucket
+        planes = np.random.default_rng(seed).standard_normal((tables * bits, vectors.shape[1])).astype(np.float32)
+        codes = np.empty((tables, len(vectors)), dtype=np.uint32)
+        for start in range(0, len(vectors), CHUNK_ROWS):
+            codes[:, start:start + CHUNK_ROWS] = hash_codes(vectors[start:start + CHUNK_ROWS], planes, tables, bits).T
+        order = np.argsort(codes, axis=1, kind='stable').astype(np.int32)
+        return cls(vectors.astype(np.float16), planes, np.take_along_axis(codes, order, axis=1), order, stats)
+
+    def extend(self, df: pd.DataFrame) -> 'SimilarityIndex':
+        # new index with the frame's rows appended, hashed with the same planes and merged into every table's code order
+        vectors = content_vectors(df, self.stats)
+        start = len(self)
+        added = hash_codes(vectors, self.planes, self.tables, self.bits).T if len(vectors) else np.zeros((self.tables, 0), dtype=np.uint32)
+        codes, order = [], []
+        for table in range(self.tables):
+            new = np.argsort(added[table], kind='stable')
+            slots = np.searchsorted(self.codes[table], added[table][new], side='right')  # after equal codes, like a stable sort of all rows
+            codes.append(np.insert(self.codes[table], slots, added[table][new]))
+            order.append(np.insert(self.order[table], slots, (new + start).astype(np.int32)))
+        vectors = np.concatenate([self.vectors, vectors.astype(np.float16)])
+        return SimilarityIndex(vectors, self.planes, np.array(codes, dtype=np.uint32), np.array(order, dtype=np.int32), self.stats)
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    def candidates(self, vector: np.ndarray, probe: bool = True) -> np.ndarray:
+        # rows sharing a bucket with the vector in any table, and one bit away when probing
+        codes = hash_codes(vector[None, :], self.planes, self.tables, self.bits)[0]
+        flips = np.concatenate([[0], 1 << np.arange(self.bits, dtype=np.uint32)]) if probe else np.zeros(1, dtype=np.uint32)
+        found = []
+        for table, code in enumerate(codes.tolist()):
+            probes = np.bitwise_xor(np.uint32(code), flips.astype(np.uint32))
+            lo = np.searchsorted(self.codes[table], probes, side='left')
+            hi = np.searchsorted(self.codes[table], probes, side='right')
+            found.extend(self.order[table, a:b] for a, b in zip(lo.tolist(), hi.tolist()) if b > a)
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(found)).astype(np.int64)
+
+    def neighbors(self, row: int, k: int = 10, probe: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+        # approximate k nearest rows to a row by cosine similarity, the row itself excluded
+        vector = self.vectors[row].astype(np.float32)
+        rows = self.candidates(vector, probe)
+        rows = rows[rows != row]
+        return top_cosine(self.vectors[rows].astype(np.float32) @ vector, rows, k)
+
+    def exact_neighbors(self, row: int, k: int = 10) -> Tuple[np.ndarray, np.ndarray]:
+        # brute-force k nearest rows, the reference for recall measurements
+        vector = self.vectors[row].astype(np.float32)
+        sims = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), CHUNK_ROWS):  # bounded float32 copies of the float16 vectors
+            sims[start:start + CHUNK_ROWS] = self.vectors[start:start + CHUNK_ROWS].astype(np.float32) @ vector
+        sims[row] = -np.inf
+        return top_cosine(sims, np.arange(len(sims)), k)
+
+    def memory_per_recipe(self) -> Dict[str, float]:
+        # bytes each recipe costs in the index, by array
+        n = max(len(self), 1)
+        sizes = {'vectors': self.vectors.nbytes, 'codes': self.codes.nbytes, 'order': self.order.nbytes}
+        sizes = {name: size / n for name, size in sizes.items()}
+        sizes['total'] = sum(sizes.values()) + self.planes.nbytes / n
+        return sizes
+
+    def save(self, directory: str):
+        with open(os.path.join(directory, 'similarity.json'), 'w') as f:
+            json.dump({'dims': int(self.vectors.shape[1]), 'tables': self.tables, 'bits': self.bits, 'rows': len(self)}, f)
+        for name in ['vectors', 'planes', 'codes', 'order', 'stats']:
+            np.save(os.path.join(directory, f"similarity.{name}.npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, directory: str) -> 'SimilarityIndex':
+        # every array is memory-mapped
+        return cls(*[np.load(os.path.join(directory, f"similarity.{name}.npy"), mmap_mode='r') for name in ['vectors', 'planes', 'codes', 'order', 'stats']])
+
+
+def hash_codes(vectors: np.ndarray, planes: np.ndarray, tables: int, bits: int) -> np.ndarray:
+    # (rows, tables) uint32 bucket codes: one sign bit per hyperplane
+    signs = (vectors @ planes.T > 0).reshape(len(vectors), tables, bits)
+    return (signs.astype(np.uint32) << np.arange(bits, dtype=np.uint32)).sum(axis=2, dtype=np.uint32)
+
+
+def top_cosine(sims: np.ndarray, rows: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    # the k best (rows, similarities), highest first
+    if k <= 0:
+        return rows[:0], sims[:0]
+    if len(sims) > k:
+        best = np.argpartition(-sims, k - 1)[:k]
+    else:
+        best = np.arange(len(sims))
+    best = best[np.argsort(-sims[best], kind='stable')]
+    return rows[best], sims[best]
+
+
+def recall_at_k(approximate: np.ndarray, exact: np.ndarray) -> float:
+    # share of approximate neighbors at least as similar as the k-th exact one, so ties count as hits
+    if not len(exact):
+        return 1.0
+    return float(np.sum(approximate >= exact[-1] - 1e-4) / len(exact))
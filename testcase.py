@@ -1,7 +1,34 @@
+import io
 import os
 import json
+import random
+import shutil
+import asyncio
+import tempfile
+import warnings
+import threading
+import http.client
+import numpy as np
+import pandas as pd
 from datetime import datetime, timedelta
-from main import RecipeSuggester, UserManager, UserProfile, MAX_WEIGHT #from filename 
+from main import RecipeSuggester, UserManager, UserProfile, DECAY_FACTOR, MAX_WEIGHT #from filename 
+from recipestore import (
+    MEAL_TYPES, RecipeStore, build_store, load_recipe_table, memory_report, read_category_csvs,
+    store_is_current,
+)
+from scoring import bitmap_mask, build_partitions, score_candidates, top_k_positions
+from profilestore import ProfileCache, SQLiteProfileBackend, migrate_json_to_sqlite
+from server import MAX_CURSORS, RecipeService, start_server
+from benchmark import generate_profile, write_dataset
+from metrics import REGISTRY, NULL_TIMER
+from filterdataset import CATEGORIES, CategoryClassifier, build_category_files
+from recipeindex import IngredientIndex, RangeFilter, duration_minutes, ingredient_words, parse_r_vector
+from keywordmatcher import ingredient_terms, range_constraints
+from textsearch import TextIndex, text_terms
+from similarity import SimilarityIndex, recall_at_k
+from collaborative import CollaborativeModel
+from segments import compact_segments, ingest, list_segments, segments_dir
+from replay import generate_sessions, replay
 
 # Paths to data and user directories
 data_dir = 'dataset/min'
@@ -145,6 +172,871 @@ def test_statistics_tracking():
     print("\n--------------------------------------------------\n")
 
 
+def test_columnar_store():
+    """Test that the columnar store returns the same recipes as the CSV files."""
+    print("\n--- Test: Columnar Store ---")
+
+    csv_df = load_recipe_table(data_dir)
+    with tempfile.TemporaryDirectory() as tmp:
+        store = RecipeStore(build_store(data_dir, os.path.join(tmp, 'store')))
+        frame = store.frame()
+        assert len(frame) == len(csv_df), "Store row count does not match the CSV files."
+        assert (frame['RecipeId'].to_numpy() == csv_df['RecipeId'].to_numpy()).all(), "Store RecipeIds do not match."
+        assert list(frame['meal_type'].astype(str)) == list(csv_df['meal_type'].astype(str)), "Store meal types do not match."
+        assert (frame['meal_types'].to_numpy() == csv_df['meal_types'].to_numpy()).all(), "Store meal type masks do not match."
+
+        for row in [0, len(csv_df) // 2, len(csv_df) - 1]:
+            record = store.record(row)
+            for column, expected in csv_df.iloc[row].items():
+                if pd.isna(expected):
+                    assert pd.isna(record[column]), f"Column {column} should be missing in row {row}."
+                else:
+                    assert record[column] == expected, f"Column {column} differs in row {row}."
+
+    print("Columnar store test passed.")
+    print_separator()
+
+def test_recipe_id_index():
+    """Test RecipeId lookups through the primary-key index."""
+    print("\n--- Test: RecipeId Index ---")
+
+    df = suggester.recipes_df
+    for row in [0, len(df) // 3, len(df) - 1]:
+        recipe_id = df['RecipeId'].iat[row]
+        first_row = df.index[df['RecipeId'] == recipe_id][0]
+        assert suggester.get_recipe_row(str(recipe_id)) == first_row, "String id lookup returned the wrong row."
+        assert suggester.get_recipe_row(int(recipe_id)) == first_row, "Integer id lookup returned the wrong row."
+        assert suggester.get_recipe_field(recipe_id, 'meal_type') == df['meal_type'].iat[first_row], "meal_type lookup failed."
+
+    assert suggester.get_recipe_row("not-a-recipe") is None, "Unknown ids should not be found."
+    rows = suggester.recipe_index.rows([df['RecipeId'].iat[0], -1, "x"])
+    assert list(rows) == [0, -1, -1], "Bulk lookup should mark unknown ids with -1."
+
+    print("RecipeId index test passed.")
+    print_separator()
+
+def test_vectorized_scoring():
+    """Test that scoring is reproducible for a fixed seed and top-k matches a full sort."""
+    print("\n--- Test: Vectorized Scoring ---")
+
+    random.seed(42)
+    first = suggester.get_recipe_suggestions(profile, "dessert", num_suggestions=5, include_liked_probability=0.5)
+    random.seed(42)
+    second = suggester.get_recipe_suggestions(profile, "dessert", num_suggestions=5, include_liked_probability=0.5)
+    assert [r["RecipeId"] for r in first] == [r["RecipeId"] for r in second], "Same seed should give the same suggestions."
+    assert all(r["meal_type"] == "dessert" for r in first), "Suggestions should come from the requested meal type."
+    assert [r["score"] for r in first] == sorted((r["score"] for r in first), reverse=True), "Suggestions should be ordered by score."
+
+    scores = np.array([3.0, 1.0, 3.0, 2.0, 3.0, 0.5])
+    expected = pd.Series(scores).nlargest(2).index.tolist()
+    assert top_k_positions(scores, 2).tolist() == expected, "Top-k should break ties like nlargest."
+
+    print("Vectorized scoring test passed.")
+    print_separator()
+
+def test_keyword_matcher():
+    """Test the compiled keyword matcher, including multi-word keywords."""
+    print("\n--- Test: Keyword Matcher ---")
+
+    assert suggester.analyze_user_input("What's for the main course?") == "dinner", "Multi-word keyword was not matched."
+    assert suggester.analyze_user_input("A salad, then cake and a cookie") == "dessert", "Highest keyword count should win."
+    assert suggester.analyze_user_input("surprise me") == "dinner", "Unmatched input should default to dinner."
+    assert suggester.keyword_matcher.score("main") == {}, "A partial phrase should not match."
+
+    print("Keyword matcher test passed.")
+    print_separator()
+
+def test_batch_suggestions():
+    """Test that batch suggestions match one call per user for the same seed."""
+    print("\n--- Test: Batch Suggestions ---")
+
+    texts = ["something sweet", "lunch", "main course", "breakfast", "dessert"]
+    profiles = [UserProfile(f"batch{i}") for i in range(len(texts))]
+    profiles[0].preferences["liked_recipes"] = list(profile.preferences["liked_recipes"])
+    profiles[1].preferences["disliked_recipes"] = list(profile.preferences["disliked_recipes"])
+
+    random.seed(7)
+    single = [suggester.get_recipe_suggestions(p, t, num_suggestions=3, include_liked_probability=0.5) for p, t in zip(profiles, texts)]
+    random.seed(7)
+    batch = suggester.get_recipe_suggestions_batch(profiles, texts, num_suggestions=3, include_liked_probability=0.5)
+
+    assert len(batch) == len(texts), "Batch should return one list per user."
+    for one, many in zip(single, batch):
+        assert [r["RecipeId"] for r in one] == [r["RecipeId"] for r in many], "Batch results differ from single calls."
+    assert all(p.total_interactions == 2 for p in profiles), "Batch should update interaction metrics."
+
+    print("Batch suggestions test passed.")
+    print_separator()
+
+def test_sqlite_profiles():
+    """Test the SQLite profile backend and the JSON migration."""
+    print("\n--- Test: SQLite Profiles ---")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sqlite_manager = UserManager(tmp, backend="sqlite", batch_size=4)
+        sqlite_profile = sqlite_manager.load_user_profile("Sam")
+        suggester.update_user_preference(sqlite_profile, "3858", "Chicken Pot Pie Lasagna", liked=True)
+        sqlite_profile.recipe_ratings["3858"] += 1
+        sqlite_profile.preferences["dietary_restrictions"].add("vegetarian")
+        sqlite_manager.save_user_profile(sqlite_profile)
+        sqlite_manager.close()
+
+        reloaded = SQLiteProfileBackend(os.path.join(tmp, "profiles.db")).load("sam")
+        assert reloaded["recipe_ratings"]["3858"] == 2.0, "Rating delta was not stored."
+        assert [r["recipe_id"] for r in reloaded["preferences"]["liked_recipes"]] == ["3858"], "Liked recipe was not stored."
+        assert reloaded["preferences"]["dietary_restrictions"] == ["vegetarian"], "Dietary restrictions were not stored."
+
+        bounded = SQLiteProfileBackend(os.path.join(tmp, "bounded.db"), saved_size=2)
+        bounded_profiles = [UserProfile(f"bounded{i}") for i in range(3)]
+        for bounded_profile in bounded_profiles:
+            bounded.save(bounded_profile.to_dict())
+        assert list(bounded.saved) == ["bounded1", "bounded2"], "Only the most recent saved states should be kept."
+        bounded_profiles[0].add_recipe("liked_recipes", "3858", "Chicken Pot Pie Lasagna")
+        bounded.save(bounded_profiles[0].to_dict())  # its state was dropped, the delta is computed against the stored rows
+        bounded.close()
+        stored = SQLiteProfileBackend(os.path.join(tmp, "bounded.db")).load("bounded0")
+        assert [r["recipe_id"] for r in stored["preferences"]["liked_recipes"]] == ["3858"], "A save after eviction should still be stored."
+
+        json_dir = os.path.join(tmp, "json")
+        json_manager = UserManager(json_dir)
+        json_manager.save_user_profile(profile)
+        assert migrate_json_to_sqlite(json_dir, os.path.join(tmp, "migrated.db")) == 1, "Migration should import one profile."
+        migrated = SQLiteProfileBackend(os.path.join(tmp, "migrated.db")).load(profile.user_id)
+        assert migrated["preferences"]["liked_recipes"] == profile.preferences["liked_recipes"], "Migrated liked recipes differ."
+
+    print("SQLite profiles test passed.")
+    print_separator()
+
+def test_profile_cache():
+    """Test the LRU profile cache, dirty-write tracking and cache statistics."""
+    print("\n--- Test: Profile Cache ---")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cached_manager = UserManager(tmp, cache_size=2)
+        first = cached_manager.load_user_profile("ann")
+        assert cached_manager.load_user_profile("ann") is first, "Cached profile should be returned on a hit."
+
+        first.total_interactions = 5
+        cached_manager.save_user_profile(first)
+        assert not os.path.exists(os.path.join(tmp, "ann.json")), "Save should be deferred while cached."
+
+        cached_manager.load_user_profile("bob")
+        cached_manager.load_user_profile("cat")  # evicts ann, writing her dirty profile
+        assert json.load(open(os.path.join(tmp, "ann.json")))["total_interactions"] == 5, "Dirty profile should be written on eviction."
+
+        cat = cached_manager.load_user_profile("cat")
+        cat.total_interactions = 9
+        cached_manager.save_user_profile(cat)
+        cached_manager.close()
+        assert json.load(open(os.path.join(tmp, "cat.json")))["total_interactions"] == 9, "Close should flush dirty profiles."
+
+        stats = cached_manager.cache_stats()
+        assert (stats["hits"], stats["misses"], stats["evictions"]) == (2, 3, 1), f"Unexpected cache statistics: {stats}"
+
+        # a profile whose write is still running is served from memory, never reloaded from the old file
+        seen = []
+        cache = ProfileCache(1, lambda profile: seen.append(cache.get("dan")))
+        dan = UserProfile("dan")
+        cache.put("dan", dan, dirty=True)
+        cache.put("eve", UserProfile("eve"))  # evicts dan, whose write looks him up
+        assert seen == [dan] and cache.get("dan") is None, "An evicted profile should stay readable until written."
+        cache.put("eve", cache.get("eve"), dirty=True)
+        flushing = cache.take_dirty()
+        cache.put("fay", UserProfile("fay"))  # evicts eve while her flush is in progress
+        assert cache.get("eve") is flushing[0], "A profile being flushed should stay readable."
+        cache.written("eve", flushing[0])
+        assert cache.get("eve") is None, "Finished writes should be forgotten."
+
+    print("Profile cache test passed.")
+    print_separator()
+
+def test_http_service():
+    """Test the suggest, feedback, stats and instructions endpoints with a local client."""
+    print("\n--- Test: HTTP Service ---")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        service_suggester = RecipeSuggester(data_dir, user_manager=UserManager(tmp, cache_size=16))
+        service = RecipeService(service_suggester, workers=4)
+        loop = asyncio.new_event_loop()
+        server = loop.run_until_complete(start_server(service, '127.0.0.1', 0))
+        port = server.sockets[0].getsockname()[1]
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+
+        def request(method, path, body=None):
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+            conn.request(method, path, body=json.dumps(body) if body is not None else None)
+            response = conn.getresponse()
+            payload = json.loads(response.read())
+            conn.close()
+            return response.status, payload
+
+        status, payload = request('POST', '/suggest', {'username': 'web', 'text': 'dessert', 'num_suggestions': 2})
+        assert status == 200 and len(payload['suggestions']) == 2, "Suggest endpoint failed."
+        recipe_id = payload['suggestions'][0]['RecipeId']
+        status, more = request('POST', '/more', {'username': 'web', 'cursor': payload['cursor'], 'num_suggestions': 2})
+        assert status == 200 and recipe_id not in [s['RecipeId'] for s in more['suggestions']], "More endpoint should return the next page."
+
+        # concurrent feedback to the same profile must not lose updates
+        threads = [threading.Thread(target=request, args=('POST', '/feedback', {'username': 'web', 'recipe_id': recipe_id, 'liked': True})) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        status, stats = request('GET', '/stats?username=web')
+        assert status == 200 and stats['liked_recipes'] == 1, "Feedback was not recorded once."
+        assert stats['total_interactions'] == 2, "Stats endpoint returned wrong interaction count."
+        assert request('POST', '/more', {'username': 'web', 'cursor': payload['cursor']})[0] == 410, "Feedback should expire the cursor."
+        liked_meal_type = service_suggester.get_recipe_field(recipe_id, 'meal_type')
+        assert stats['meal_type_preferences'][liked_meal_type] == MAX_WEIGHT, "Concurrent likes should each raise the weight up to the cap."
+
+        status, payload = request('GET', f'/instructions?recipe_id={recipe_id}')
+        assert status == 200 and payload['instructions'], "Instructions endpoint failed."
+        assert request('GET', '/instructions?recipe_id=0')[0] == 404, "Unknown recipes should return 404."
+        status, payload = request('GET', '/metrics?format=json')
+        assert status == 200 and payload['profile_cache']['capacity'] == 16, "Metrics endpoint failed."
+
+        assert request('POST', '/feedback', {'username': 'web', 'recipe_id': recipe_id, 'liked': 'false'})[0] == 400, "'liked' must be a boolean."
+        assert request('POST', '/suggest', {'username': 'web', 'text': 'dessert', 'num_suggestions': '2'})[0] == 400, "Counts must be integers."
+        for body in [{'username': 42, 'text': 'dessert'}, {'username': 'web', 'text': ['dessert']}, {'username': '../../tmp/x', 'text': 'dessert'}]:
+            assert request('POST', '/suggest', body)[0] == 400, f"{body} should be rejected."
+        assert request('GET', '/stats?username=a/b')[0] == 400, "Unsafe names should be rejected."
+        assert request('GET', '/stats?username=stranger')[0] == 404, "Unknown users should return 404."
+        assert service_suggester.user_manager.backend.load('stranger') is None, "Reading stats should not create a profile."
+        assert not os.path.exists(os.path.normpath(os.path.join(tmp, '../../tmp/x.json'))), "No profile should be written outside the users directory."
+        try:
+            service_suggester.user_manager.backend.path("../escape")
+            assert False, "The backend should refuse names outside its directory."
+        except ValueError:
+            pass
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        conn.putrequest('POST', '/suggest')
+        conn.putheader('Content-Length', 'abc')
+        conn.endheaders()
+        assert conn.getresponse().status == 400, "A bad Content-Length should get a response."
+        conn.close()
+        assert not service.user_locks, "Idle users should not keep a lock."
+        status, payload = request('POST', '/suggest', {'username': 'web', 'text': 'dessert'})
+        request('POST', '/feedback', {'username': 'web', 'recipe_id': recipe_id, 'liked': False})
+        assert 'web' not in service.cursors, "Feedback should drop the user's cursor."
+        for i in range(MAX_CURSORS + 5):
+            service.store_cursor(f"user{i}", str(i), None)
+        assert len(service.cursors) == MAX_CURSORS and 'user0' not in service.cursors, "Cursors should be bounded."
+
+        loop.call_soon_threadsafe(server.close)  # the server belongs to the loop's thread
+        asyncio.run_coroutine_threadsafe(server.wait_closed(), loop).result(timeout=10)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        service.close()
+
+    print("HTTP service test passed.")
+    print_separator()
+
+def test_synthetic_dataset():
+    """Test that the benchmark's synthetic Food.com data loads and produces suggestions."""
+    print("\n--- Test: Synthetic Dataset ---")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        synthetic = RecipeSuggester(write_dataset(os.path.join(tmp, "data"), 500, seed=3), user_manager=UserManager(os.path.join(tmp, "users")))
+        assert len(synthetic.recipes_df) == 500, "Synthetic dataset should load every generated recipe."
+        heavy = generate_profile("heavy", synthetic.recipes_df["RecipeId"].to_numpy(), liked=200, disliked=100, seed=3)
+        suggestions = synthetic.get_recipe_suggestions(heavy, "dessert", num_suggestions=5, include_liked_probability=0.0)
+        liked_ids = {r["recipe_id"] for r in heavy.preferences["liked_recipes"]}
+        assert len(suggestions) == 5, "Synthetic dataset should produce suggestions."
+        assert all(str(s["RecipeId"]) not in liked_ids for s in suggestions), "Liked recipes should be excluded at probability 0."
+
+    print("Synthetic dataset test passed.")
+    print_separator()
+
+
+def test_metrics():
+    """Test that stage timers record only while the registry is enabled."""
+    print("\n--- Test: Metrics ---")
+
+    REGISTRY.reset()
+    assert REGISTRY.timer('suggest_seconds') is NULL_TIMER, "Disabled registry should hand back the no-op timer."
+    suggester.get_recipe_suggestions(profile, "breakfast please", num_suggestions=2)
+    assert REGISTRY.to_dict() == {'counters': [], 'timers': []}, "Disabled registry should record nothing."
+
+    REGISTRY.enabled = True
+    try:
+        suggester.get_recipe_suggestions(profile, "breakfast please", num_suggestions=2)
+        suggester.user_manager.save_user_profile(profile)
+        timers = {(t['name'], tuple(sorted(t['labels'].items()))): t for t in REGISTRY.to_dict()['timers']}
+        for stage in ['classify', 'filter', 'exclusion', 'scoring', 'topk', 'hydrate']:
+            assert timers[('suggest_stage_seconds', (('stage', stage),))]['count'] == 1, f"Stage {stage} was not timed."
+        assert timers[('profile_io_seconds', (('op', 'save'),))]['count'] == 1, "Profile save was not timed."
+        text = REGISTRY.to_prometheus()
+        assert 'suggest_stage_seconds_bucket{stage="scoring",le="+Inf"} 1' in text, "Prometheus output is missing histogram buckets."
+        assert 'suggest_requests_total 1' in text, "Prometheus output is missing counters."
+    finally:
+        REGISTRY.enabled = False
+        REGISTRY.reset()
+
+    print("Metrics test passed.")
+    print_separator()
+
+
+def test_streaming_dataset_builder():
+    """Test that the chunked single-pass builder writes the same files as one regex scan per meal type."""
+    print("\n--- Test: Streaming Dataset Builder ---")
+
+    classifier = CategoryClassifier({'a': ['main'], 'b': ['main course'], 'c': ['course']})
+    assert classifier.mask("MAIN COURSE") == 0b111, "Overlapping and prefix keywords should all match."
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = pd.concat([pd.read_csv(os.path.join(data_dir, f"{m}.csv"), dtype=str, keep_default_na=False) for m in CATEGORIES], ignore_index=True)
+        source_path = os.path.join(tmp, "recipes.csv")
+        source.to_csv(source_path, index=False)
+        for workers, limit in [(1, None), (2, 60)]:
+            output_dir = os.path.join(tmp, f"out{workers}")
+            os.makedirs(output_dir)
+            build_category_files(source_path, output_dir, limit=limit, chunk_size=37, workers=workers)
+            for meal_type, keywords in CATEGORIES.items():
+                pattern = '|'.join(keywords)
+                expected = source[source['RecipeCategory'].str.contains(pattern, case=False) | source['Keywords'].str.contains(pattern, case=False)]
+                expected = expected.head(limit) if limit else expected
+                written = pd.read_csv(os.path.join(output_dir, f"{meal_type}.csv"), dtype=str, keep_default_na=False)
+                assert written.equals(expected.reset_index(drop=True)), f"{meal_type} file differs from the multi-pass filter."
+
+    print("Streaming dataset builder test passed.")
+    print_separator()
+
+
+def test_ingredient_queries():
+    """Test ingredient-constrained suggestions through the inverted ingredient index."""
+    print("\n--- Test: Ingredient Queries ---")
+
+    assert parse_r_vector('c("chicken", "rice")') == ['chicken', 'rice'] and parse_r_vector('character(0)') == [], "R vectors should parse."
+    small_parts = ['c("chicken breast", "rice")', 'c("rice", "peas")', 'character(0)']
+    small = IngredientIndex.build(small_parts)
+    assert small.rows_with(['rice']).tolist() == [0, 1] and small.rows_with(['chicken breast']).tolist() == [0], "Postings should list matching rows."
+    assert small.rows_with(['chicken', 'peas']).tolist() == [], "Every ingredient should be required."
+    grown = small.extend(['c("chicken", "peas")'], len(small_parts))
+    rebuilt = IngredientIndex.build(small_parts + ['c("chicken", "peas")'])
+    assert grown.words == rebuilt.words and grown.postings.tolist() == rebuilt.postings.tolist(), "Extending should match a rebuild."
+    index = suggester.get_ingredient_index()
+    parts = suggester.recipes_df['RecipeIngredientParts']
+    for terms in [['eggs'], ['butter', 'brown sugar'], ['chicken', 'broccoli']]:
+        expected = [row for row, text in enumerate(parts)
+                    if all(set(ingredient_words(t)) <= {w for name in parse_r_vector(text) for w in ingredient_words(name)} for t in terms)]
+        assert index.rows_with(terms).tolist() == expected, f"Posting intersection for {terms} differs from a full scan."
+    assert index.rows_with(['kick']) is None and index.rows_with(['eggs', 'kick']).tolist() == index.rows_with(['eggs']).tolist(), "Unknown words should be ignored."
+    assert ingredient_terms("dinner from scratch") == [], "'from' does not start an ingredient list."
+    assert suggester.get_recipe_suggestions(UserProfile("kick_user"), "something with a kick", num_suggestions=3), "Non-ingredient words should not empty the results."
+
+    with tempfile.TemporaryDirectory() as tmp:
+        stored = RecipeStore(build_store(data_dir, os.path.join(tmp, 'store'))).ingredient_index()
+        assert stored.rows_with(['butter', 'eggs']).tolist() == index.rows_with(['butter', 'eggs']).tolist(), "Stored index differs."
+
+    query_user = UserProfile("ingredient_user")
+    suggestions = suggester.get_recipe_suggestions(query_user, "dinner with chicken and broccoli", num_suggestions=5)
+    assert suggestions, "Ingredient query should find recipes."
+    for recipe in suggestions:
+        words = {w for name in parse_r_vector(recipe['RecipeIngredientParts']) for w in ingredient_words(name)}
+        assert {'chicken', 'broccoli'} <= words and recipe['meal_type'] == 'dinner', f"{recipe['Name']} does not match the query."
+    assert suggester.get_recipe_suggestions(query_user, "dinner with unobtainium", num_suggestions=5), "Unknown ingredients should not filter."
+
+    print("Ingredient queries test passed.")
+    print_separator()
+
+
+def test_text_search():
+    """Test tf-idf cosine retrieval, its persisted form, incremental updates and score blending."""
+    print("\n--- Test: Text Search ---")
+
+    docs = ["Spicy Thai noodles with peanuts", "Thai green curry chicken", "Chocolate cake", "Spicy chicken wings", "Noodle soup", ""]
+    vocab = sorted({t for d in docs for t in text_terms(d)})
+    counts = np.array([[text_terms(d).count(t) for t in vocab] for d in docs], dtype=np.float64)
+    idf = np.log((1 + len(docs)) / (1 + (counts > 0).sum(axis=0))) + 1
+    dense = np.where(counts > 0, (1 + np.log(np.maximum(counts, 1))) * idf, 0)
+    norms = np.linalg.norm(dense, axis=1, keepdims=True)
+    dense = np.divide(dense, norms, out=np.zeros_like(dense), where=norms > 0)
+    index = TextIndex.build(docs)
+    for query in ["spicy thai noodle", "chicken", "cake"]:
+        q = np.array([text_terms(query).count(t) for t in vocab], dtype=np.float64)
+        q = np.where(q > 0, (1 + np.log(np.maximum(q, 1))) * idf, 0)
+        assert np.allclose(index.similarity(query), dense @ (q / np.linalg.norm(q)), atol=1e-6), f"Cosine scores for '{query}' are wrong."
+    assert index.similarity("unknown words") is None, "Queries without indexed terms should not score."
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index.save(tmp)
+        loaded = TextIndex.load(tmp)
+        assert np.allclose(loaded.similarity("thai chicken"), index.similarity("thai chicken")), "Loaded index scores differ."
+        loaded.add_documents(["Thai basil stir fry", "Mango sticky rice"])
+        similarity = loaded.similarity("thai mango")
+        assert len(similarity) == len(docs) + 2 and similarity[-1] > 0 and similarity[-2] > 0, "Added documents should be searchable."
+
+    query_user = UserProfile("text_user")
+    plain = suggester.get_recipe_suggestions(query_user, "dinner", num_suggestions=3)
+    mexican = suggester.get_recipe_suggestions(query_user, "spicy mexican dinner", num_suggestions=3)
+    assert all(s['score'] >= p['score'] for s, p in zip(mexican, plain)), "Text similarity should only boost scores."
+    assert 'mexican' in mexican[0]['Name'].lower(), "Text similarity should rank matching recipes first."
+
+    print("Text search test passed.")
+    print_separator()
+
+
+def test_similar_recipes():
+    """Test the LSH neighbor index against exact search and the boost for recipes like liked ones."""
+    print("\n--- Test: Similar Recipes ---")
+
+    index = suggester.get_similarity_index()
+    recalls = [recall_at_k(index.neighbors(row, 10)[1], index.exact_neighbors(row, 10)[1]) for row in range(0, len(index), 10)]
+    assert np.mean(recalls) > 0.9, "Probed LSH search should find most exact neighbors."
+    assert index.memory_per_recipe()['total'] < 1024, "Index should stay under 1 KB per recipe."
+
+    small = SimilarityIndex.build(suggester.recipes_df.iloc[:300])
+    assert len(small) == 300 and 7 not in small.exact_neighbors(7, 3)[0], "A recipe should not be its own neighbor."
+    grown = small.extend(suggester.recipes_df.iloc[[7]])  # a copy of row 7, hashed with the same planes
+    assert len(grown) == 301 and 7 in grown.candidates(grown.vectors[300].astype(np.float32)).tolist(), "Copies should share buckets."
+    rows, similarity = grown.neighbors(300, 3)
+    assert rows[0] == 7 and similarity[0] > 0.99 and rows.tolist() == grown.exact_neighbors(300, 3)[0].tolist(), "Appended rows should be searchable."
+
+    with tempfile.TemporaryDirectory() as tmp:
+        stored = RecipeStore(build_store(data_dir, os.path.join(tmp, 'store'))).similarity_index()
+        assert stored.neighbors(5, 10)[0].tolist() == index.neighbors(5, 10)[0].tolist(), "Stored index differs."
+
+    fan = UserProfile("similar_user")
+    rows = np.arange(len(suggester.recipes_df))
+    assert suggester.liked_neighbor_similarity(fan, rows) is None, "Users without likes get no neighbor boost."
+    liked_id = suggester.recipes_df['RecipeId'].iat[42]
+    fan.preferences['liked_recipes'].append({'recipe_id': str(liked_id), 'recipe_name': 'liked'})
+    neighbor_rows, _ = suggester.recipe_neighbors(42)
+    similarity = suggester.liked_neighbor_similarity(fan, rows)
+    assert (similarity[neighbor_rows] > 0).any() and (similarity[np.setdiff1d(rows, neighbor_rows)] == 0).all(), "Only neighbors should be boosted."
+    scores = np.ones(len(rows))
+    boosted = suggester.boost_scores(fan, "dessert", rows, scores)
+    assert (boosted >= scores).all() and (boosted[neighbor_rows] > 1).any(), "Neighbors of liked recipes should score higher."
+
+    print("Similar recipes test passed.")
+    print_separator()
+
+
+def test_range_filters():
+    """Test ISO-8601 duration parsing, sorted range filters and time/nutrition constrained queries."""
+    print("\n--- Test: Range Filters ---")
+
+    minutes = duration_minutes(pd.Series(['PT1H35M', 'PT20M', 'PT0S', None, 'P1DT2H', 'bad']))
+    assert minutes.dtype == np.int16 and minutes.tolist() == [95, 20, -1, -1, 1560, -1], "Durations should parse to int16 minutes."
+    assert range_constraints("dinner under 600 calories, over 30g protein") == [('Calories', None, 600.0), ('ProteinContent', 30.0, None)], "Range phrases should parse."
+    assert range_constraints("quick breakfast under 1 hour") == [('TotalTime', None, 60.0)], "Hours should convert to minutes."
+    durations = RangeFilter.build(np.array([30, -1, 10, 30, 5], dtype=np.int16))
+    assert durations.rows_between(10, 30).tolist() == [2, 0, 3] and durations.rows_between(None, 10).tolist() == [4, 2], "Bounds should be inclusive."
+    assert durations.mask(5).tolist() == [True, False, True, True, True], "Missing minutes should never match."
+    grown = durations.extend(np.array([20, -1], dtype=np.int16), 5)
+    assert grown.order.tolist() == RangeFilter.build(np.array([30, -1, 10, 30, 5, 20, -1], dtype=np.int16)).order.tolist(), "Extending should match a rebuild."
+    assert RangeFilter.build(np.array([1.5, np.nan, 0.5], dtype=np.float32)).rows_between().tolist() == [2, 0], "Missing nutrients should never match."
+
+    csv_df = load_recipe_table(data_dir)
+    filters = suggester.get_range_filters()
+    total = duration_minutes(csv_df['TotalTime'])
+    assert filters['TotalTime'].mask(len(total), None, 30).tolist() == ((total >= 0) & (total <= 30)).tolist(), "Duration filter differs from a scan."
+    calories = csv_df['Calories'].to_numpy(dtype=np.float32)
+    assert filters['Calories'].mask(len(calories), 200, 600).tolist() == ((calories >= 200) & (calories <= 600)).tolist(), "Nutrient filter differs from a scan."
+
+    with tempfile.TemporaryDirectory() as tmp:
+        stored = RecipeStore(build_store(data_dir, os.path.join(tmp, 'store'))).range_filters()
+        assert stored['ProteinContent'].rows_between(30, None).tolist() == filters['ProteinContent'].rows_between(30, None).tolist(), "Stored filter differs."
+
+    query_user = UserProfile("range_user")
+    suggestions = suggester.get_recipe_suggestions(query_user, "dinner under 600 calories, over 30g protein", num_suggestions=5)
+    assert suggestions, "Range query should find recipes."
+    assert all(r['Calories'] <= 600 and r['ProteinContent'] >= 30 for r in suggestions), "Suggestions should meet the nutrition limits."
+    quick = suggester.get_recipe_suggestions(query_user, "quick breakfast under 20 minutes", num_suggestions=5)
+    assert quick and all(0 <= duration_minutes(pd.Series([r['TotalTime']]))[0] <= 20 for r in quick), "Suggestions should meet the time limit."
+
+    print("Range filters test passed.")
+    print_separator()
+
+
+def test_compact_profiles():
+    """Test int id sets on profiles, cached exclusion bitmaps and the unchanged JSON format."""
+    print("\n--- Test: Compact Profiles ---")
+
+    compact_user = UserProfile("compact_user")
+    recipe_ids = suggester.recipes_df['RecipeId'].astype(str).tolist()[:4]
+    assert compact_user.add_recipe('liked_recipes', recipe_ids[0], "first"), "A new recipe should be added."
+    assert not compact_user.add_recipe('liked_recipes', recipe_ids[0], "first"), "A repeated recipe should not be added twice."
+    version = compact_user.version
+    compact_user.add_recipe('disliked_recipes', recipe_ids[1], "second")
+    assert compact_user.version > version, "Changes should bump the profile version."
+    assert compact_user.liked_ids() == {int(recipe_ids[0])} and compact_user.disliked_ids() == {int(recipe_ids[1])}, "Id sets should follow the lists."
+
+    compact_user.preferences['disliked_recipes'].append({"recipe_id": recipe_ids[2], "recipe_name": "third"})  # direct list edits are picked up too
+    liked_bits, disliked_bits = suggester.profile_bitmaps(compact_user)
+    rows = np.arange(len(suggester.recipes_df))
+    expected = suggester.recipes_df['RecipeId'].isin([int(recipe_ids[1]), int(recipe_ids[2])]).to_numpy()
+    assert bitmap_mask(disliked_bits, rows).tolist() == expected.tolist(), "Disliked bitmap should match a scan."
+    assert suggester.profile_bitmaps(compact_user)[1] is disliked_bits, "Bitmaps should be cached until the profile changes."
+    suggester.table_generation += 1  # what a segment swap does, the new table may reuse the old one's id()
+    assert suggester.profile_bitmaps(compact_user)[1] is not disliked_bits, "Bitmaps should be rebuilt after a table swap."
+
+    restored = UserProfile.from_dict(json.loads(json.dumps(compact_user.to_dict())))
+    assert restored.to_dict()['preferences'] == compact_user.to_dict()['preferences'], "JSON format should be unchanged."
+    assert restored.disliked_ids() == compact_user.disliked_ids(), "Id sets should rebuild from stored lists."
+
+    for meal_type in ['breakfast', 'lunch', 'dinner']:
+        for r in suggester.get_recipe_suggestions(restored, f"{meal_type} please", num_suggestions=20):
+            assert int(r['RecipeId']) not in restored.disliked_ids(), "Disliked recipes should never be suggested."
+
+    print("Compact profiles test passed.")
+    print_separator()
+
+
+def test_lazy_decay():
+    """Test closed-form decay on read and the bulk decay sweep over stored profiles."""
+    print("\n--- Test: Lazy Decay ---")
+
+    stale = UserProfile("stale_user")
+    stale.preferences['meal_type_preferences']['dinner'] = 4.0
+    stale.last_decay_date = (datetime.now() - timedelta(days=95)).isoformat()
+    expected = 4.0 * DECAY_FACTOR ** 3  # three whole intervals, not one step
+    assert abs(stale.meal_type_weight('dinner') - expected) < 1e-9, "Reads should apply every elapsed interval."
+    assert stale.preferences['meal_type_preferences']['dinner'] == 4.0, "Reads should not modify the profile."
+    assert stale.apply_decay() and abs(stale.preferences['meal_type_preferences']['dinner'] - expected) < 1e-9, "Decay should fold into the weights."
+    assert abs(stale.meal_type_weight('dinner') - expected) < 1e-9 and not stale.apply_decay(), "Decay should apply once."
+
+    for backend in ['json', 'sqlite']:
+        with tempfile.TemporaryDirectory() as tmp:
+            manager = UserManager(users_dir=tmp, backend=backend)
+            for name, days in [('fresh', 0), ('old', 65), ('older', 400)]:
+                user = UserProfile(name)
+                user.preferences['meal_type_preferences']['lunch'] = 2.0
+                user.last_decay_date = (datetime.now() - timedelta(days=days)).isoformat()
+                manager.write_user_profile(user)
+            manager.flush()
+            report = manager.decay_all_profiles(workers=2, chunk_size=1)
+            assert report['profiles'] == 3 and report['rewritten'] == 2, f"Only stale profiles should be rewritten ({backend})."
+            older = UserProfile.from_dict(manager.backend.load('older'))
+            assert abs(older.preferences['meal_type_preferences']['lunch'] - 2.0 * DECAY_FACTOR ** 13) < 1e-9, "Stored weights should be decayed."
+            assert manager.decay_all_profiles(workers=2)['rewritten'] == 0, "A second sweep should change nothing."
+            manager.close()
+
+    print("Lazy decay test passed.")
+    print_separator()
+
+
+def test_suggestion_cursor():
+    """Test that paging a suggestion cursor matches one large ranking and expires on feedback."""
+    print("\n--- Test: Suggestion Cursor ---")
+
+    cursor_user = UserProfile("cursor_user")
+    expected = suggester.get_recipe_suggestions(cursor_user, "dinner", num_suggestions=10, rng=np.random.default_rng(5))
+    cursor = suggester.suggestion_cursor(cursor_user, "dinner", rng=np.random.default_rng(5))
+    pages = [suggester.next_suggestions(cursor_user, cursor, 3) for _ in range(4)]
+    assert [len(page) for page in pages] == [3, 3, 3, 3], "Every page should be full."
+    paged = [(r['RecipeId'], r['score']) for page in pages for r in page]
+    assert paged[:10] == [(r['RecipeId'], r['score']) for r in expected], "Pages should follow the single ranking."
+    while suggester.next_suggestions(cursor_user, cursor, 50):
+        pass
+    assert cursor.remaining() == 0 and suggester.next_suggestions(cursor_user, cursor, 3) == [], "An exhausted cursor should return nothing."
+
+    cursor = suggester.suggestion_cursor(cursor_user, "dinner")
+    suggester.update_user_preference(cursor_user, pages[0][0]['RecipeId'], pages[0][0]['Name'], liked=False)
+    try:
+        suggester.next_suggestions(cursor_user, cursor, 3)
+        assert False, "Feedback should invalidate the cursor."
+    except ValueError:
+        pass
+
+    print("Suggestion cursor test passed.")
+    print_separator()
+
+
+def test_collaborative_filtering():
+    """Test the item-item co-like model: build from profiles, incremental likes, pruning and the score blend."""
+    print("\n--- Test: Collaborative Filtering ---")
+
+    ids = suggester.recipes_df['RecipeId'].astype(str).tolist()
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = UserManager(users_dir=tmp)
+        for i, liked in enumerate([[ids[0], ids[1]], [ids[0], ids[1], ids[2]], [ids[1], ids[3]]]):
+            user = UserProfile(f"cf{i}")
+            for recipe_id in liked:
+                user.add_recipe('liked_recipes', recipe_id, "")
+            manager.write_user_profile(user)
+        model = CollaborativeModel.from_profiles(manager.backend)
+        related, similarity = model.related(np.array([int(ids[0])]))
+        expected = {int(ids[1]): 2 / np.sqrt(2 * 3), int(ids[2]): 1 / np.sqrt(2 * 1)}  # co-likes / sqrt(likes * likes)
+        assert dict(zip(related.tolist(), similarity.round(9).tolist())) == {k: round(v, 9) for k, v in expected.items()}, "Similarities should be co-like cosines."
+        assert np.diff(CollaborativeModel.from_profiles(manager.backend, top_n=1).offsets).max() == 1, "Rows should be pruned to top_n."
+        model.save(tmp)
+        with open(os.path.join(tmp, "notes.json"), "w") as f:
+            json.dump({"users": 3}, f)  # a json file that is not a profile
+        assert manager.backend.list_users() == ["cf0", "cf1", "cf2"], "Only profile files should be listed."
+        assert len(CollaborativeModel.from_profiles(manager.backend)) == len(model), "Rebuilding next to a saved model should work."
+        assert manager.decay_all_profiles(workers=1)['profiles'] == 3, "The decay sweep should skip the model."
+
+        cf_suggester = RecipeSuggester(data_dir, user_manager=manager)
+        newcomer = UserProfile("cf_new")
+        cf_suggester.update_user_preference(newcomer, ids[0], "", liked=True)
+        rows = cf_suggester.recipe_index.rows([ids[1], ids[4]])
+        boost = cf_suggester.collaborative_similarity(newcomer, rows)
+        assert boost[0] > 0 and boost[1] == 0, "Recipes co-liked by other users should be boosted."
+
+        cf_suggester.update_user_preference(newcomer, ids[4], "", liked=True)  # a new co-like, recorded without a rebuild
+        assert int(ids[4]) in cf_suggester.get_collaborative_model().related(np.array([int(ids[0])]))[0], "Likes should update the model."
+        cf_suggester.save_collaborative_model()
+        reloaded = CollaborativeModel.load(tmp)
+        assert int(ids[4]) in reloaded.related(np.array([int(ids[0])]))[0] and reloaded.likes.sum() == 9, "Saved model should include new likes."
+
+        errors = []
+        def hammer(offset):  # likes and lookups from service threads at once
+            try:
+                for i in range(200):
+                    reloaded.add_like(ids[(offset + i) % 20], {int(ids[(offset + i + 1) % 20]), int(ids[(offset + i + 2) % 20])})
+                    reloaded.related(np.array([int(ids[i % 20])]))
+                    if i % 50 == 0:
+                        reloaded.merge()
+            except Exception as e:
+                errors.append(e)
+        workers = [threading.Thread(target=hammer, args=(offset,)) for offset in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        assert not errors and reloaded.likes.sum() + sum(reloaded.pending_likes.values()) == 9 + 800, "Concurrent likes were lost."
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")  # a zero like count would divide by zero
+            early = CollaborativeModel.build([[ids[0], ids[1]], [ids[0], ids[1]]])
+            for _ in range(3):  # ids[5] was liked before the model existed, only the pairs with it were recorded
+                early.add_like(ids[6], {int(ids[5])})
+            early.merge()
+            for item in early.items.tolist():
+                similarity = early.related(np.array([item]))[1]
+                assert np.isfinite(similarity).all() and (similarity <= 1).all(), "Similarities should be finite cosines."
+        assert int(ids[1]) in early.related(np.array([int(ids[0])]))[0], "Real pairs should survive the merge."
+        manager.close()
+
+    print("Collaborative filtering test passed.")
+    print_separator()
+
+
+def test_compact_recipe_table():
+    """Test that recipes in several category files load once with a meal type bitmask and compact dtypes."""
+    print("\n--- Test: Compact Recipe Table ---")
+
+    raw = read_category_csvs(data_dir)
+    table = suggester.recipes_df
+    assert len(table) == raw['RecipeId'].nunique() and table['RecipeId'].is_unique, "Each recipe should be loaded once."
+    expected = raw.groupby('RecipeId')['meal_type'].agg(lambda types: sum(1 << MEAL_TYPES.index(t) for t in set(types)))
+    assert (table['meal_types'].to_numpy() == expected.loc[table['RecipeId']].to_numpy()).all(), "Meal type masks should cover every file."
+    for meal_type, partition in suggester.partitions.items():
+        assert set(partition.recipe_ids.tolist()) == set(raw.loc[raw['meal_type'] == meal_type, 'RecipeId'].tolist()), f"{meal_type} partition misses recipes."
+
+    csv_table = load_recipe_table(data_dir)
+    assert csv_table['RecipeId'].dtype == np.int32 and csv_table['Calories'].dtype == np.float32, "Numeric columns should be downcast."
+    assert isinstance(csv_table['RecipeCategory'].dtype, pd.CategoricalDtype), "Repetitive text columns should be categorical."
+    report = memory_report(csv_table)
+    assert report['total'] == sum(v for k, v in report.items() if k != 'total'), "Report should add up by column."
+    assert report['total'] < memory_report(raw)['total'], "The compact table should be smaller than the raw frames."
+    assert suggester.memory_usage_report()['total'] > 0, "Suggester should report its table memory."
+
+    print("Compact recipe table test passed.")
+    print_separator()
+
+
+def test_warm_start_snapshot():
+    """Test that a snapshot restores the prepared state and is rebuilt when the CSV files change."""
+    print("\n--- Test: Warm Start Snapshot ---")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot_dir = os.path.join(tmp, 'data')
+        shutil.copytree(data_dir, snapshot_dir, ignore=shutil.ignore_patterns('store', 'combine'))
+        users = UserManager(os.path.join(tmp, 'users'))
+        cold = RecipeSuggester(snapshot_dir, user_manager=users, use_snapshot=True)  # builds the store, then the snapshot
+        warm = RecipeSuggester(snapshot_dir, user_manager=users, use_snapshot=True)
+        assert (cold.start_type, warm.start_type) == ('cold', 'warm'), "The second start should map the snapshot."
+        assert isinstance(warm.recipe_ids, np.memmap) or isinstance(warm.recipe_ids.base, np.memmap), "Warm state should be memory-mapped."
+        assert (warm.recipe_ids == cold.recipe_ids).all() and warm.get_recipe_row(cold.recipe_ids[7]) == 7, "RecipeId index differs."
+        for meal_type, partition in cold.partitions.items():
+            assert (warm.partitions[meal_type].rows == partition.rows).all(), f"{meal_type} partition differs."
+        user = UserProfile("snapshot_user")
+        first = cold.get_recipe_suggestions(user, "dinner with chicken", num_suggestions=5, rng=np.random.default_rng(1))
+        second = warm.get_recipe_suggestions(user, "dinner with chicken", num_suggestions=5, rng=np.random.default_rng(1))
+        assert [(r['RecipeId'], r['score']) for r in first] == [(r['RecipeId'], r['score']) for r in second], "Warm suggestions differ."
+
+        path = os.path.join(snapshot_dir, 'dinner.csv')
+        os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 10 ** 9))  # the csv files changed
+        changed = RecipeSuggester(snapshot_dir, user_manager=users, use_snapshot=True)
+        assert changed.start_type == 'cold' and store_is_current(snapshot_dir), "A changed CSV should rebuild the store and snapshot."
+        assert RecipeSuggester(snapshot_dir, user_manager=users, use_snapshot=True).start_type == 'warm', "The rebuilt snapshot should be used."
+        assert len([f for f in os.listdir(os.path.join(snapshot_dir, 'store')) if f.startswith('snapshot-')]) == 1, "Old snapshots should be removed."
+
+    print("Warm start snapshot test passed.")
+    print_separator()
+
+
+def test_segment_ingestion():
+    """Test that ingested recipes are appended to a running suggester's table and indexes, and survive compaction."""
+    print("\n--- Test: Segment Ingestion ---")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        segment_dir = os.path.join(tmp, 'data')
+        shutil.copytree(data_dir, segment_dir, ignore=shutil.ignore_patterns('store', 'combine'))
+        users = UserManager(os.path.join(tmp, 'users'))
+        running = RecipeSuggester(segment_dir, user_manager=users, use_snapshot=True)
+        running.get_ingredient_index(), running.get_range_filters(), running.get_text_index(), running.get_similarity_index()  # loaded before the swap
+        base_rows = len(running.recipe_ids)
+
+        new = pd.read_csv(os.path.join(segment_dir, 'dinner.csv'), dtype=str, keep_default_na=False).head(40)
+        new['RecipeId'] = (new['RecipeId'].astype(int) + 10 ** 7).astype(str)  # copies of known recipes under new ids
+        new.head(20).to_csv(os.path.join(tmp, 'new.csv'), index=False)
+        with open(os.path.join(tmp, 'new.jsonl'), 'w') as f:
+            for record in new.iloc[20:].to_dict('records'):
+                record['Keywords'] = parse_r_vector(record['Keywords'])  # json lists instead of R vectors
+                f.write(json.dumps(record) + '\n')
+        assert ingest(segment_dir, os.path.join(tmp, 'new.csv'))[1] == 20 and running.refresh_segments() == 20, "CSV recipes not appended."
+        assert ingest(segment_dir, os.path.join(tmp, 'new.jsonl'))[1] == 20 and running.refresh_segments() == 20, "JSONL recipes not appended."
+        assert running.refresh_segments() == 0, "Segments should only be appended once."
+
+        recipe_id = int(new['RecipeId'].iloc[25])
+        row = running.get_recipe_row(recipe_id)
+        assert row == base_rows + 25 and running.get_recipe_field(recipe_id, 'Name') == new['Name'].iloc[25], "New recipe not found by id."
+        assert running.get_recipe_records([row])[0]['RecipeInstructions'] == new['RecipeInstructions'].iloc[25], "New recipe not hydrated."
+        original = running.get_recipe_row(recipe_id - 10 ** 7)
+        assert running.get_similarity_index().neighbors(row, 1)[0][0] == original, "A copied recipe should be nearest to its original."
+        assert running.text_similarity("dinner " + new['Name'].iloc[25])[row] > 0, "New recipe not in the text index."
+
+        restarted = RecipeSuggester(segment_dir, user_manager=users, use_snapshot=True)  # segments applied at startup
+        from_csv = RecipeSuggester(segment_dir, user_manager=users, use_store=False)
+        assert (restarted.recipe_ids == running.recipe_ids).all() and (from_csv.recipe_ids == running.recipe_ids).all(), "Row order differs."
+        swapped, loaded = running.get_ingredient_index(), restarted.get_ingredient_index()
+        assert all((swapped.rows_for_word(w) == loaded.rows_for_word(w)).all() for w in loaded.words), "Extended ingredient index differs."
+        for column, range_filter in restarted.get_range_filters().items():
+            assert (running.get_range_filters()[column].rows_between(10, 60) == range_filter.rows_between(10, 60)).all(), f"{column} filter differs."
+        for meal_type, partition in restarted.partitions.items():
+            assert (running.partitions[meal_type].rows == partition.rows).all(), f"{meal_type} partition differs."
+
+        assert compact_segments(segment_dir, max_bytes=1 << 30) == 1 and len(list_segments(segments_dir(segment_dir))) == 1, "Segments not merged."
+        assert running.refresh_segments() == 0, "Compacted segments hold no new recipes."
+        compacted = RecipeSuggester(segment_dir, user_manager=users, use_snapshot=True)
+        assert (compacted.recipe_ids == running.recipe_ids).all(), "Compaction changed the row order."
+
+    print("Segment ingestion test passed.")
+    print_separator()
+
+
+def test_session_replay():
+    """Test that replayed sessions give the same results on any number of threads or processes."""
+    print("\n--- Test: Session Replay ---")
+
+    events = generate_sessions(120, users=12, seed=3)
+    events.append({'username': 'user0', 'text': 'dinner', 'feedback': 9})  # past the end of the page
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        replay_dir = os.path.join(tmp, 'data')
+        shutil.copytree(data_dir, replay_dir, ignore=shutil.ignore_patterns('store', 'combine'))  # replay builds a store and snapshot
+        for workers, mode in [(1, 'thread'), (3, 'thread'), (2, 'process')]:
+            output = io.StringIO()
+            summary = replay(events, replay_dir, os.path.join(tmp, f"{mode}{workers}"), workers=workers, mode=mode, output=output)
+            records = [json.loads(line) for line in output.getvalue().splitlines()]
+            assert summary['events'] == len(records) == len(events) and summary['requests_per_second'] > 0, "Every event needs one result."
+            errors = [r['error'] for r in records if 'error' in r]
+            assert summary['failed_events'] == 1 and errors[0].startswith('Invalid feedback'), "Bad feedback should be reported."
+            assert summary['profile_writes']['count'] > 0 and summary['latency']['p99_ms'] >= summary['latency']['p50_ms'], "Summary incomplete."
+            for username in {event['username'] for event in events}:
+                indexes = [r['event'] for r in records if r['username'] == username]
+                assert indexes == sorted(indexes), f"{username}'s events ran out of order."
+            results[(workers, mode)] = {r['event']: (r.get('pages'), r.get('picked'), r.get('stats')) for r in records}
+
+            profile = UserManager(os.path.join(tmp, f"{mode}{workers}")).load_user_profile('user1', login=False)
+            searches = [e for e in events if e['username'] == 'user1' and e['text'] != 'stats']
+            assert profile.total_interactions >= len(searches), "Replayed interactions were not saved."
+
+    first = results[(1, 'thread')]
+    assert all(result == first for result in results.values()), "Concurrent replay changed the results."
+
+    print("Session replay test passed.")
+    print_separator()
+
+
+def test_query_caches():
+    """Test the query classification and base score caches, their hit rates and invalidation."""
+    print("\n--- Test: Query Caches ---")
+
+    cached = RecipeSuggester(data_dir)
+    assert cached.analyze_user_input("Dinner  with CHICKEN") == cached.analyze_user_input("dinner with chicken") == "dinner"
+    stats = cached.cache_stats()['query_classification']
+    assert stats['hits'] == 1 and stats['misses'] == 1 and stats['hit_rate'] == 0.5, "Normalized repeats should hit the cache."
+    assert cached.analyze_user_inputs(["dinner with chicken", "a sweet treat", "A sweet  treat"]) == ["dinner", "dessert", "dessert"]
+    assert cached.query_cache.stats()['size'] == 2, "Batch classification should fill the same cache."
+
+    cached.meal_keywords = dict(cached.meal_keywords, breakfast=['breakfast', 'chicken'])
+    assert cached.analyze_user_input("chicken") == "breakfast", "Changed keywords should invalidate cached meal types."
+    assert cached.query_cache.stats()['size'] == 1, "The old entries should be dropped."
+    cached.meal_keywords['lunch'].append('chicken')  # edits in place, without assigning meal_keywords
+    cached.meal_keywords['breakfast'].remove('chicken')
+    assert cached.analyze_user_input("chicken") == "lunch", "Keywords edited in place should invalidate cached meal types."
+
+    profile = UserProfile("cache_user")
+    partition = cached.partitions['dessert']
+    rated = partition.recipe_ids[:3]
+    profile.recipe_ratings.update({str(rated[0]): 1.0, str(rated[1]): 0.0, str(rated[2]): 0.8})
+    cached.get_recipe_suggestions(profile, "dessert", num_suggestions=3)
+    cached.get_recipe_suggestions(profile, "a dessert please", num_suggestions=3)
+    stats = cached.cache_stats()['base_scores']
+    assert stats['misses'] == 1 and stats['hits'] == 1, "The dessert base vector should be computed once."
+    base = cached.base_scores('dessert', partition)
+    assert not base.flags.writeable, "Cached base scores must be read-only."
+
+    candidates = np.arange(0, len(partition), 2)
+    weight = 1 + profile.meal_type_weight('dessert')
+    expected = [profile.recipe_ratings.get(str(partition.recipe_ids[i]), 0.5) * weight
+                * (1 if np.isnan(partition.ratings[i]) else partition.ratings[i]) for i in candidates]
+    assert score_candidates(partition, candidates, profile, 'dessert', base).tolist() == expected, "Cached scores changed."
+
+    swapped = build_partitions(cached.recipes_df, MEAL_TYPES)['dessert']  # what a reload or segment swap installs
+    assert cached.base_scores('dessert', swapped) is not base, "A new partition should not reuse the old vector."
+
+    print("Query caches test passed.")
+    print_separator()
+
+
+def test_sharded_scoring():
+    """Test that scoring partitions in shards on a process pool ranks exactly like the single-core path."""
+    print("\n--- Test: Sharded Scoring ---")
+
+    ids = suggester.recipes_df['RecipeId'].to_numpy()
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = UserManager(users_dir=tmp)
+        for i in range(3):  # other users' likes, so the collaborative boost takes part
+            user = UserProfile(f"shard{i}")
+            for recipe_id in ids[i:i + 4].tolist():
+                user.add_recipe('liked_recipes', str(recipe_id), "")
+            manager.write_user_profile(user)
+        CollaborativeModel.from_profiles(manager.backend).save(tmp)
+        single = RecipeSuggester(data_dir, user_manager=manager)
+        sharded = RecipeSuggester(data_dir, user_manager=manager, shards=2)
+        sharded.shard_min_rows = 0  # shard even the small test partitions
+        profile = generate_profile('shard_user', ids, 30, 20, seed=4)
+        profile.add_recipe('liked_recipes', str(ids[1]), "")
+
+        for text in ["dessert", "dinner with chicken", "spicy thai noodles for dinner", "breakfast under 30 minutes"]:
+            expected = single.suggestion_cursor(profile, text, 0.5, rng=np.random.default_rng(9))
+            cursor = sharded.suggestion_cursor(profile, text, 0.5, rng=np.random.default_rng(9))
+            assert type(cursor).__name__ == 'ShardedCursor' and len(cursor) == len(expected), "Shards should see every candidate."
+            for k in [3, 3, 40, len(expected)]:  # past the first dispatch, the shards are asked again
+                rows, scores = cursor.next_page(k)
+                expected_rows, expected_scores = expected.next_page(k)
+                assert rows.tolist() == expected_rows.tolist() and scores.tolist() == expected_scores.tolist(), f"Sharded ranking differs for '{text}'."
+
+        stale = sharded.suggestion_cursor(profile, "dessert", 0.5, rng=np.random.default_rng(2))
+        expected = single.suggestion_cursor(profile, "dessert", 0.5, rng=np.random.default_rng(2))
+        first = sharded.sharded_scorer
+        sharded.partitions = dict(sharded.partitions)  # what a segment swap installs
+        sharded.suggestion_cursor(profile, "dessert", 0.5)
+        assert sharded.sharded_scorer is not first and first.pool is None, "New partitions should get a new scorer."
+        assert stale.next_page(60)[0].tolist() == expected.next_page(60)[0].tolist(), "Older cursors should keep paging."
+        sharded.stop_sharding()
+        manager.close()
+
+    print("Sharded scoring test passed.")
+    print_separator()
+
 
 def run_all_tests():
     """Run all test functions for comprehensive testing."""
@@ -153,6 +1045,31 @@ def run_all_tests():
     test_get_recipe_suggestions()
     test_nlp_analysis()
     test_statistics_tracking()
+    test_columnar_store()
+    test_recipe_id_index()
+    test_vectorized_scoring()
+    test_keyword_matcher()
+    test_batch_suggestions()
+    test_sqlite_profiles()
+    test_profile_cache()
+    test_http_service()
+    test_synthetic_dataset()
+    test_metrics()
+    test_streaming_dataset_builder()
+    test_ingredient_queries()
+    test_text_search()
+    test_similar_recipes()
+    test_range_filters()
+    test_compact_profiles()
+    test_lazy_decay()
+    test_suggestion_cursor()
+    test_collaborative_filtering()
+    test_compact_recipe_table()
+    test_warm_start_snapshot()
+    test_segment_ingestion()
+    test_session_replay()
+    test_query_caches()
+    test_sharded_scoring()
 
 
 # Run all tests
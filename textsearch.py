@@ -0,0 +1,209 @@
+import os
+import copy
+import json
+from collections import Counter
+from typing import Dict, Iterable, List, Optional  # for type hinting
+
+import numpy as np
+import pandas as pd
+
+from keywordmatcher import tokenize
+from recipeindex import parse_r_vector, stem
+
+# sparse tf-idf retrieval over recipe text
+#
+# the matrix is stored term-major (one posting list of rows and weights per term), so a query
+# is a sparse matrix-vector product that only touches the postings of its own terms.
+# document vectors are l2-normalized at build time, so the product is the cosine similarity.
+#
+# layout inside a store directory:
+#   text.terms.json     vocabulary in term id order and the document count
+#   text.idf.npy        float32 idf per term
+#   text.offsets.npy    int64 posting offsets per term (terms + 1 entries)
+#   text.rows.npy       int32 row positions, ascending within each term
+#   text.weights.npy    float32 normalized tf-idf weights aligned with rows
+
+TEXT_COLUMNS = ['Name', 'Description', 'Keywords', 'RecipeCategory']  # columns indexed for retrieval
+R_VECTOR_COLUMNS = {'Keywords'}  # columns holding R character vectors
+STOPWORDS = {
+    'a', 'about', 'all', 'an', 'and', 'any', 'are', 'as', 'at', 'be', 'but', 'by', 'can', 'com', 'could', 'do', 'food',
+    'for', 'from', 'get', 'give', 'have', 'i', 'im', 'in', 'is', 'it', 'just', 'like', 'make', 'me', 'my', 'need', 'of',
+    'on', 'or', 'please', 'recipe', 'share', 'show', 'some', 'something', 'that', 'the', 'this', 'to', 'today', 'tonight',
+    'want', 'what', 'with', 'would', 'you', 'your',
+}  # words too common in recipe text or queries to rank by
+REBUILD_FRACTION = 0.25  # merge added documents into the main postings once they reach this share of the index
+
+
+def text_terms(text: str) -> List[str]:
+    # stemmed index terms of a piece of text
+    return [stem(token) for token in tokenize(text) if len(token) > 1 and token not in STOPWORDS]
+
+
+def document_text(values: Dict) -> str:
+    # the indexed text of one recipe from its column values
+    parts = []
+    for column in TEXT_COLUMNS:
+        value = values.get(column)
+        if not isinstance(value, str):
+            continue
+        parts.append(' '.join(parse_r_vector(value)) if column in R_VECTOR_COLUMNS else value)
+    return '\n'.join(parts)
+
+
+def frame_documents(df: pd.DataFrame) -> Iterable[str]:
+    # indexed text of every row of a recipe frame
+    columns = [c for c in TEXT_COLUMNS if c in df.columns]
+    for values in zip(*(df[c].tolist() for c in columns)):
+        yield document_text(dict(zip(columns, values)))
+
+
+class TextIndex:
+    def __init__(self, terms: List[str], idf: np.ndarray, offsets: np.ndarray, rows: np.ndarray, weights: np.ndarray, documents: int):
+        self.terms = {term: i for i, term in enumerate(terms)}  # term -> term id
+        self.idf = idf  # float32 idf per term, fixed when the postings were built
+        self.offsets = offsets  # postings of term i are rows[offsets[i]:offsets[i + 1]]
+        self.rows = rows
+        self.weights = weights
+        self.documents = documents  # rows covered, including added ones
+        self.base_documents = documents  # rows covered by the main postings
+        self.added = {}  # term id -> list of (rows, weights) for documents added since the last merge
+        self.added_df = Counter()  # document frequency of terms first seen in added documents
+
+    @classmethod
+    def build(cls, documents: Iterable[str]) -> 'TextIndex':
+        # tokenize every document once and invert the counts into term-major postings
+        terms, doc_ids, term_ids, counts = {}, [], [], []
+        n = 0
+        for n, text in enumerate(documents, 1):
+            for term, count in Counter(text_terms(text)).items():
+                doc_ids.append(n - 1)
+                term_ids.append(terms.setdefault(term, len(terms)))
+                counts.append(count)
+        doc_ids = np.array(doc_ids, dtype=np.int32)
+        term_ids = np.array(term_ids, dtype=np.int64)
+        df = np.bincount(term_ids, minlength=len(terms))
+        idf = (np.log((1 + n) / (1 + df)) + 1).astype(np.float32)  # smoothed idf
+        weights = tf_idf(np.array(counts, dtype=np.float32), idf[term_ids])
+        norms = np.sqrt(np.bincount(doc_ids, weights=weights.astype(np.float64) ** 2, minlength=n)).astype(np.float32)
+        weights /= norms[doc_ids]  # unit-length document vectors
+
+        order = np.argsort(term_ids, kind='stable')  # term-major, rows stay ascending within a term
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(df, out=offsets[1:])
+        return cls(list(terms), idf, offsets, doc_ids[order], weights[order], n)
+
+    def __len__(self) -> int:
+        return self.documents
+
+    def copy(self) -> 'TextIndex':
+        # an index sharing the main postings but with its own added postings, so add_documents on the
+        # copy never changes what concurrent queries of this one see
+        index = copy.copy(self)
+        index.terms = dict(self.terms)
+        index.idf = np.array(self.idf)
+        index.added = {term_id: list(postings) for term_id, postings in self.added.items()}
+        index.added_df = Counter(self.added_df)
+        return index
+
+    def query_vector(self, terms: List[str]) -> Dict[int, float]:
+        # normalized tf-idf weights of the query's known terms
+        counts = Counter(self.terms[t] for t in terms if t in self.terms)
+        if not counts:
+            return {}
+        ids = np.array(list(counts), dtype=np.int64)
+        weights = tf_idf(np.array(list(counts.values()), dtype=np.float32), self.idf[ids])
+        weights /= np.sqrt((weights.astype(np.float64) ** 2).sum())
+        return dict(zip(ids.tolist(), weights.tolist()))
+
+    def similarity(self, text: str, terms: Optional[List[str]] = None) -> Optional[np.ndarray]:
+        # cosine similarity of the query to every row, None when no query term is indexed
+        query = self.query_vector(text_terms(text) if terms is None else terms)
+        if not query:
+            return None
+        scores = np.zeros(self.documents, dtype=np.float32)
+        for term_id, weight in query.items():
+            if term_id < len(self.offsets) - 1:
+                lo, hi = self.offsets[term_id], self.offsets[term_id + 1]
+                scores[self.rows[lo:hi]] += self.weights[lo:hi] * weight  # rows are unique within a term
+            for rows, weights in self.added.get(term_id, ()):
+                scores[rows] += weights * weight
+        return scores
+
+    def add_documents(self, documents: Iterable[str]):
+        # index new rows after the existing ones without re-tokenizing the old documents
+        # existing idf values are kept; a term first seen here is weighted by its frequency among added documents
+        doc_terms = [Counter(text_terms(text)) for text in documents]
+        for counts in doc_terms:
+            for term in counts:
+                if term not in self.terms:
+                    self.terms[term] = len(self.terms)
+                    self.idf = np.append(self.idf, np.float32(0))
+                if self.terms[term] >= len(self.offsets) - 1:
+                    self.added_df[term] += 1
+        for term, df in self.added_df.items():
+            self.idf[self.terms[term]] = np.log((1 + self.documents + len(doc_terms)) / (1 + df)) + 1
+
+        doc_ids = np.array([row for row, counts in enumerate(doc_terms, self.documents) for _ in counts], dtype=np.int32)
+        term_ids = np.array([self.terms[t] for counts in doc_terms for t in counts], dtype=np.int64)
+        weights = tf_idf(np.array([c for counts in doc_terms for c in counts.values()], dtype=np.float32), self.idf[term_ids])
+        norms = np.sqrt(np.bincount(doc_ids - self.documents, weights=weights.astype(np.float64) ** 2, minlength=len(doc_terms))).astype(np.float32)
+        weights /= norms[doc_ids - self.documents]
+        order = np.argsort(term_ids, kind='stable')
+        term_ids, doc_ids, weights = term_ids[order], doc_ids[order], weights[order]
+        bounds = np.flatnonzero(np.diff(term_ids)) + 1
+        for ids, rows, values in zip(np.split(term_ids, bounds), np.split(doc_ids, bounds), np.split(weights, bounds)):
+            if len(ids):
+                self.added.setdefault(int(ids[0]), []).append((rows, values))
+        self.documents += len(doc_terms)
+        if self.documents - self.base_documents > REBUILD_FRACTION * max(self.base_documents, 1):
+            self.merge()
+
+    def merge(self):
+        # fold the added postings into the main term-major arrays
+        if not self.added:
+            self.base_documents = self.documents
+            return
+        old_terms = len(self.offsets) - 1
+        lengths = np.zeros(len(self.terms), dtype=np.int64)
+        lengths[:old_terms] = np.diff(self.offsets)
+        for term_id, postings in self.added.items():
+            lengths[term_id] += sum(len(rows) for rows, _ in postings)
+        offsets = np.zeros(len(self.terms) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        rows = np.empty(offsets[-1], dtype=np.int32)
+        weights = np.empty(offsets[-1], dtype=np.float32)
+        for term_id in range(len(self.terms)):
+            # old postings first, added rows are all larger so each list stays ascending
+            parts = [(self.rows[self.offsets[term_id]:self.offsets[term_id + 1]], self.weights[self.offsets[term_id]:self.offsets[term_id + 1]])] if term_id < old_terms else []
+            parts += self.added.get(term_id, [])
+            if parts:
+                rows[offsets[term_id]:offsets[term_id + 1]] = np.concatenate([r for r, _ in parts])
+                weights[offsets[term_id]:offsets[term_id + 1]] = np.concatenate([w for _, w in parts])
+        self.offsets, self.rows, self.weights = offsets, rows, weights
+        self.idf = np.asarray(self.idf, dtype=np.float32)
+        self.added, self.added_df = {}, Counter()
+        self.base_documents = self.documents
+
+    def save(self, directory: str):
+        self.merge()
+        with open(os.path.join(directory, 'text.terms.json'), 'w') as f:
+            json.dump({'documents': self.documents, 'terms': sorted(self.terms, key=self.terms.get)}, f)
+        np.save(os.path.join(directory, 'text.idf.npy'), self.idf)
+        np.save(os.path.join(directory, 'text.offsets.npy'), self.offsets)
+        np.save(os.path.join(directory, 'text.rows.npy'), self.rows)
+        np.save(os.path.join(directory, 'text.weights.npy'), self.weights)
+
+    @classmethod
+    def load(cls, directory: str) -> 'TextIndex':
+        # postings are memory-mapped, only the vocabulary is read into memory
+        with open(os.path.join(directory, 'text.terms.json'), 'r') as f:
+            meta = json.load(f)
+        arrays = [np.load(os.path.join(directory, f"text.{name}.npy"), mmap_mode='r') for name in ['idf', 'offsets', 'rows', 'weights']]
+        index = cls(meta['terms'], *arrays, meta['documents'])
+        index.idf = np.array(index.idf)  # grows when documents with new terms are added
+        return index
+
+
+def tf_idf(counts: np.ndarray, idf: np.ndarray) -> np.ndarray:
+    # sublinear term frequency times idf
+    return ((1 + np.log(counts)) * idf).astype(np.float32)